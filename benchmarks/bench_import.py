@@ -0,0 +1,33 @@
+"""
+Measure the import time of the modules loaded by master startup and by
+``bbtravis run``, in a fresh interpreter each time.
+
+usage: python benchmarks/bench_import.py [repeat]
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import subprocess
+import sys
+import timeit
+
+MODULES = ["buildbot_travis.travisyml", "buildbot_travis.runner"]
+
+
+def bench(module, repeat):
+    cmd = [sys.executable, "-c", "import " + module]
+    subprocess.check_call(cmd)  # warm up the filesystem caches
+    t = min(timeit.repeat(lambda: subprocess.check_call(cmd), number=1, repeat=repeat))
+    print("%-30s %8.1f ms" % (module, t * 1000))
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    bench("buildbot.plugins", repeat)
+    for module in MODULES:
+        bench(module, repeat)
+
+
+if __name__ == '__main__':
+    main()
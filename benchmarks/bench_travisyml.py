@@ -0,0 +1,79 @@
+"""
+Compare .travis.yml parse time with the libyaml accelerated loader and the
+pure python one.
+
+usage: python benchmarks/bench_travisyml.py [repeat]
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import timeit
+
+import yaml
+
+from buildbot_travis.travisyml import PureTravisLoader, TravisLoader
+
+SMALL = """
+language: python
+python:
+  - "2.7"
+env:
+  global:
+      - CI=true
+  matrix:
+      - TWISTED=11.1.0 SQLALCHEMY=latest SQLALCHEMY_MIGRATE=0.7.1
+      - TWISTED=latest SQLALCHEMY=latest SQLALCHEMY_MIGRATE=latest
+matrix:
+  include:
+    - python: "2.7"
+      env: TWISTED=12.0.0 SQLALCHEMY=0.6.0 SQLALCHEMY_MIGRATE=0.7.1
+before_install:
+  - echo doing before install
+install:
+  - echo doing install
+script:
+  - echo doing scripts
+notifications:
+  email: false
+"""
+
+
+def make_large(cells=200, commands=100):
+    lines = ["language: python", "env:"]
+    lines += ["  - TESTS=t%d TWISTED=latest SQLALCHEMY=latest" % i for i in range(cells)]
+    lines += ["matrix:", "  include:"]
+    for i in range(cells):
+        lines += ['    - python: "3.%d"' % (i % 8),
+                  "      env: TESTS=i%d TWISTED=%d.0.0" % (i, i)]
+    lines += ["script:"]
+    for i in range(commands):
+        lines += ["  - title: command %d" % i,
+                  "    condition: TESTS == 't%d'" % i,
+                  '    cmd: !i "make REVISION=%%(prop:got_revision)s target%d"' % i]
+        lines += ["  - step: !ShellCommand",
+                  "        command: make target%d" % i]
+    return "\n".join(lines) + "\n"
+
+
+def bench(name, data, repeat):
+    results = []
+    for loader in (PureTravisLoader, TravisLoader):
+        t = min(timeit.repeat(lambda: yaml.load(data, Loader=loader), number=1, repeat=repeat))
+        results.append(t)
+        print("%-6s %-20s %8.2f ms" % (name, loader.__mro__[1].__name__, t * 1000))
+    if TravisLoader is not PureTravisLoader:
+        print("%-6s speedup: x%.1f" % (name, results[0] / results[1]))
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    if TravisLoader is PureTravisLoader:
+        print("libyaml is not available, TravisLoader falls back to the pure python loader")
+    bench("small", SMALL, repeat)
+    bench("large", make_large(), repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Compare the time needed to create the buildsets of a matrix, one trigger() per
+cell versus TravisTriggerable.addMatrixBuildsets, against a sqlite database.
+
+usage: python benchmarks/bench_trigger.py [cells...]
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from twisted.internet import defer, reactor, task
+
+from buildbot.data.connector import DataConnector
+from buildbot.db.connector import DBConnector
+from buildbot.mq.simple import SimpleMQ
+from buildbot.process.properties import Properties
+from buildbot.test.fake import fakemaster
+from buildbot_travis.schedulers import TravisTriggerable
+
+SOURCESTAMPS = [dict(codebase="project", repository="git://example.com/project",
+                     branch="master", revision="abcd" * 10, project="project")]
+
+
+@defer.inlineCallbacks
+def makeMaster(basedir):
+    master = fakemaster.make_master(None, wantRealReactor=True)
+    master.config.db['db_url'] = "sqlite:///" + os.path.join(basedir, "state.sqlite")
+    master.db = DBConnector(basedir)
+    yield master.db.setServiceParent(master)
+    yield master.db.setup(check_version=False)
+    yield master.db.model.upgrade()
+    master.mq = SimpleMQ()
+    yield master.mq.setServiceParent(master)
+    master.data = DataConnector()
+    yield master.data.setServiceParent(master)
+    yield master.data.updates.findBuilderId(u"project-job")
+    scheduler = TravisTriggerable(
+        name="project-job", builderNames=["project-job"],
+        codebases={"project": {"repository": "git://example.com/project"}})
+    yield scheduler.setServiceParent(master)
+    defer.returnValue((master, scheduler))
+
+
+def makeProperties(cells):
+    matrix = []
+    for i in range(cells):
+        props = Properties()
+        props.setProperty("TESTS", "t%d" % i, ".travis.yml")
+        props.setProperty("python", "3.%d" % (i % 8), ".travis.yml")
+        props.setProperty("virtual_builder_name", "project py:3.%d TESTS:t%d" % (i % 8, i),
+                          "spawner")
+        matrix.append(props)
+    return matrix
+
+
+@defer.inlineCallbacks
+def perCell(scheduler, matrix):
+    for props in matrix:
+        ids, _ = scheduler.trigger(False, sourcestamps=SOURCESTAMPS, set_props=props,
+                                   parent_buildid=None)
+        yield ids
+
+
+@defer.inlineCallbacks
+def batched(scheduler, matrix):
+    yield scheduler.addMatrixBuildsets(False, SOURCESTAMPS, matrix)
+    for props in matrix:
+        ids, _ = scheduler.trigger(False, sourcestamps=SOURCESTAMPS, set_props=props,
+                                   parent_buildid=None)
+        yield ids
+
+
+@defer.inlineCallbacks
+def bench(cells):
+    for name, method in (("per cell", perCell), ("batched", batched)):
+        basedir = tempfile.mkdtemp()
+        try:
+            master, scheduler = yield makeMaster(basedir)
+            matrix = makeProperties(cells)
+            start = time.time()
+            yield method(scheduler, matrix)
+            t = time.time() - start
+            print("%5d cells %-10s %9.1f ms" % (cells, name, t * 1000))
+            # let the pending notifications go before closing the database
+            yield task.deferLater(reactor, 0.5, lambda: None)
+            yield master.db.pool.shutdown()
+        finally:
+            shutil.rmtree(basedir, ignore_errors=True)
+
+
+@defer.inlineCallbacks
+def main(reactor, *args):
+    for cells in [int(a) for a in args] or [10, 100, 1000]:
+        yield bench(cells)
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
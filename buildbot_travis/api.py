@@ -24,6 +24,8 @@ from twisted.internet import threads
 import yaml
 import json
 
+from .timing import getPhaseDurations
+
 
 def getDbConfigObjectId(master, name="config"):
     return master.db.state.getObjectId(name, "DbConfig")
@@ -115,3 +117,16 @@ class Api(object):
 
         yield self.ep.master.reconfig()
         defer.returnValue(json.dumps({'success': True}))
+
+    @app.route("/phases", methods=['GET'])
+    @defer.inlineCallbacks
+    def getPhases(self, request):
+        """I return the percentiles of the durations of the jobs phases"""
+        res = yield self.assertAllowed(request)
+        if res:
+            defer.returnValue(res)
+        request.setHeader('Content-Type', 'application/json')
+        args = dict((k, request.args[k.encode()][0].decode("utf-8"))
+                    for k in ("project", "label") if k.encode() in request.args)
+        durations = yield getPhaseDurations(self.ep.master, **args)
+        defer.returnValue(json.dumps(durations))
@@ -0,0 +1,57 @@
+# Copyright 2012-2013 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+try:
+    import builtins
+except ImportError:  # python 2
+    import __builtin__ as builtins
+
+# the compiled conditions, shared by all the builds
+_compiled = {}
+MAX_COMPILED = 1000
+
+
+def compileCondition(condition):
+    """ compile the python expression of a command's condition, once """
+    code = _compiled.get(condition)
+    if code is None:
+        code = compile(condition, "<condition>", "eval")
+        if len(_compiled) >= MAX_COMPILED:
+            _compiled.clear()
+        _compiled[condition] = code
+    return code
+
+
+class ConditionEvaluator(object):
+
+    """
+    Evaluates the conditions of the commands against the variables of a build
+    (its properties, or the matrix cell for bbtravis run).
+
+    The namespace is built once for all the conditions of the build. It is the
+    globals of the expressions, rather than their locals, so that the variables
+    are visible from the comprehensions too.
+    """
+
+    def __init__(self, variables):
+        self.namespace = dict(variables)
+        # eval() would add it to the namespace otherwise
+        self.namespace['__builtins__'] = builtins
+
+    def __call__(self, condition):
+        return bool(eval(compileCondition(condition), self.namespace))
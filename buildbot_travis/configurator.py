@@ -20,12 +20,18 @@ from buildbot.plugins import util, worker
 from buildbot.plugins.db import get_plugins
 from buildbot.process import factory
 from buildbot.schedulers.forcesched import StringParameter
-from buildbot.schedulers.triggerable import Triggerable
 from buildbot.www.authz.endpointmatchers import EndpointMatcherBase, Match
 from buildbot.www.authz.roles import RolesFromBase
 
 from .important import ImportantManager
+from .reuse import MatrixResultCache
+from .schedulers import TravisTriggerable
+from .throttle import JobThrottle, prioritizeBuilders
+from .timing import PhaseHistory
 from .steps import TravisSetupSteps, TravisTrigger
+from .steps.cache import CacheStore
+from .steps.create_steps import PropertiesEnvironment, VirtualEnvCache
+from .tracker import MatrixTracker
 from .vcs import addRepository, getSupportedVCSTypes
 
 
@@ -51,6 +57,10 @@ class TravisConfigurator(object):
         self.cfgdict = {}
         self.importantManager = None
         self.change_hook_dialects = {}
+        self.trackedBuilders = []
+        self.reuseResults = False
+        self.virtualenvCache = None
+        self.cacheStore = None
         config.setdefault("builders", [])
         config.setdefault("schedulers", [])
         config.setdefault("change_source", [])
@@ -77,6 +87,9 @@ class TravisConfigurator(object):
         buildbot_travis.api.setCfg(y)
         self.cfgdict = y
         self.createWorkerConfig()
+        self.createVirtualEnvCacheConfig()
+        self.createCacheStoreConfig()
+        self.createFairShareConfig()
         self.importantManager = ImportantManager(
             y.setdefault("not_important_files", []))
         self.defaultEnv = y.setdefault("env", {})
@@ -86,6 +99,11 @@ class TravisConfigurator(object):
                     "'env' values must be strings or lists ; key %s is incorrect: %s" % (k, type(v)))
         for p in y.setdefault("projects", []):
             self.define_travis_builder(**p)
+        if self.trackedBuilders:
+            self.config['services'].append(MatrixTracker(self.trackedBuilders))
+        if self.reuseResults:
+            self.config['services'].append(MatrixResultCache())
+        self.config['services'].append(PhaseHistory())
         self.defaultStages = y.setdefault("stages", [])
         for s in self.defaultStages:
             if not isinstance(s, string_types):
@@ -299,6 +317,64 @@ class TravisConfigurator(object):
                     name = name + "_" + str(i + 1)  # count one based
                 self.config['workers'].append(getattr(self, createWorkerConfigMethod)(_worker, name))
 
+    def createFairShareConfig(self):
+        fair_share = self.cfgdict.get('fair_share', False)
+        if not isinstance(fair_share, bool):
+            config_error("fair_share should be true or false")
+        if fair_share:
+            # the workers go first to the projects running the fewest jobs
+            self.config.setdefault("prioritizeBuilders", prioritizeBuilders)
+
+    def createVirtualEnvCacheConfig(self):
+        cachecfg = self.cfgdict.get('virtualenv_cache')
+        if not cachecfg:
+            return
+        if cachecfg is True:
+            cachecfg = {}
+        if not isinstance(cachecfg, dict):
+            config_error("virtualenv_cache should be true or a mapping")
+            return
+        unknown = set(cachecfg) - set(['path', 'max_size', 'requirements'])
+        if unknown:
+            config_error("virtualenv_cache does not support {}".format(", ".join(sorted(unknown))))
+            return
+        if not isinstance(cachecfg.get('path', ""), string_types):
+            config_error("virtualenv_cache path should be a string")
+            return
+        max_size = cachecfg.get('max_size', VirtualEnvCache.DEFAULT_MAX_SIZE)
+        if not isinstance(max_size, (int, float)) or isinstance(max_size, bool) or max_size <= 0:
+            config_error("virtualenv_cache max_size should be a positive number of MB")
+            return
+        requirements = cachecfg.get('requirements', [])
+        if not isinstance(requirements, list) or not all(
+                isinstance(r, string_types) for r in requirements):
+            config_error("virtualenv_cache requirements should be a list of globs")
+            return
+        self.virtualenvCache = VirtualEnvCache(**cachecfg)
+
+    def createCacheStoreConfig(self):
+        storecfg = self.cfgdict.get('cache_store')
+        if not storecfg:
+            return
+        if not isinstance(storecfg, dict):
+            config_error("cache_store should be a mapping")
+            return
+        unknown = set(storecfg) - set(['path', 'max_size'])
+        if unknown:
+            config_error("cache_store does not support {}".format(", ".join(sorted(unknown))))
+            return
+        path = storecfg.get('path', "cache_store")
+        if not isinstance(path, string_types):
+            config_error("cache_store path should be a string")
+            return
+        max_size = storecfg.get('max_size', CacheStore.DEFAULT_MAX_SIZE)
+        if not isinstance(max_size, (int, float)) or isinstance(max_size, bool) or max_size <= 0:
+            config_error("cache_store max_size should be a positive number of MB")
+            return
+        # relative to the master directory
+        self.cacheStore = CacheStore(os.path.join(self.vardir, os.path.expanduser(path)),
+                                     max_size=max_size)
+
     def fromDb(self):
         buildbot_travis.api.useDbConfig()
         dbConfig = util.DbConfig(self.config, self.vardir)
@@ -343,6 +419,27 @@ class TravisConfigurator(object):
             return list(set(tags))
 
         tags = [formatTag(tag) for tag in tags]
+        # spawners finish once the matrix is triggered, and MatrixTracker
+        # collects the results of the jobs
+        fire_and_track = kwargs.pop('fire_and_track', False)
+        if fire_and_track:
+            self.trackedBuilders.extend([spawner_name, try_name])
+        max_parallel_jobs = kwargs.pop('max_parallel_jobs', None)
+        # default for the projects which don't set matrix.fast_finish
+        fast_finish = kwargs.pop('fast_finish', False)
+        # green matrix jobs are not run again on the same source tree
+        reuse_results = kwargs.pop('reuse_results', False)
+        self.reuseResults = self.reuseResults or reuse_results
+        # which properties are exported to the environment of the hooks
+        env_properties = kwargs.pop('env_properties', {})
+        if not isinstance(env_properties, dict) or not all(
+                k in ("allow", "deny") and isinstance(v, list) and
+                all(isinstance(glob, string_types) for glob in v)
+                for k, v in env_properties.items()):
+            config_error("'env_properties' of project %s should only have 'allow' and 'deny' "
+                         "lists of globs" % (name,))
+            env_properties = {}
+        environment = PropertiesEnvironment(**env_properties)
         if 'username' not in kwargs and 'password' not in kwargs:
             p = urlparse(repository)
             k = (p.scheme, p.netloc)
@@ -357,23 +454,27 @@ class TravisConfigurator(object):
         vcsManager = addRepository(
             name, dict(name=name, repository=repository, **kwargs))
         vcsManager.vardir = self.vardir
+        vcsManager.trackedBuilders = self.trackedBuilders
 
         # Define the builder for the main job
         f = factory.BuildFactory()
         vcsManager.addSourceSteps(f)
-        f.addStep(TravisSetupSteps())
+        f.addStep(TravisSetupSteps(environment=environment,
+                                   virtualenvCache=self.virtualenvCache,
+                                   cacheStore=self.cacheStore))
 
         self.config['builders'].append(BuilderConfig(
             name=job_name,
             workernames=self.get_runner_workers(),
             properties=self.properties,
             collapseRequests=False,
+            canStartBuild=JobThrottle(max_parallel_jobs),
             env=self.defaultEnv,
             tags=uniq(["job", name] + tags),
             factory=f
         ))
 
-        self.config['schedulers'].append(Triggerable(
+        self.config['schedulers'].append(TravisTriggerable(
             name=job_name,
             builderNames=[job_name],
             codebases=codebases,
@@ -381,9 +482,12 @@ class TravisConfigurator(object):
 
         # Define the builder for a spawner
         f = factory.BuildFactory()
-        vcsManager.addSourceSteps(f)
+        vcsManager.addSpawnerSourceSteps(f)
         f.addStep(TravisTrigger(
             scheduler=job_name,
+            waitForFinish=not fire_and_track,
+            fastFinish=fast_finish,
+            reuseResults=reuse_results,
         ))
         properties = dict(TRAVIS_PULL_REQUEST=False)
         properties.update(self.properties)
@@ -400,7 +504,9 @@ class TravisConfigurator(object):
             # Define the builder for the deployment of the project
             f = factory.BuildFactory()
             vcsManager.addSourceSteps(f)
-            f.addStep(TravisSetupSteps())
+            f.addStep(TravisSetupSteps(environment=environment,
+                                       virtualenvCache=self.virtualenvCache,
+                                       cacheStore=self.cacheStore))
 
             # To manage deployment properly (with change traceability),
             # we need the version and the target deployment environment or "stage"
@@ -436,6 +542,9 @@ class TravisConfigurator(object):
             vcsManager.addSourceSteps(f)
             f.addStep(TravisTrigger(
                 scheduler=job_name,
+                waitForFinish=not fire_and_track,
+                fastFinish=fast_finish,
+                reuseResults=reuse_results,
             ))
 
             self.config['builders'].append(BuilderConfig(
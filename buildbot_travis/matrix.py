@@ -0,0 +1,237 @@
+# Copyright 2012-2013 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import fnmatch
+import re
+from collections import OrderedDict
+
+
+def cell_signature(cell):
+    """
+    Canonical, hashable, form of a matrix cell: the frozenset of its
+    "key=value" components, with the env dictionary flattened into the cell
+    """
+    components = set()
+    for k, v in cell.items():
+        if k == "env":
+            components.update("{}={}".format(ek, ev) for ek, ev in v.items())
+        else:
+            components.add("{}={}".format(k, v))
+    return frozenset(components)
+
+
+class MatrixExcluder(object):
+    """
+    Matches cell signatures against a list of exclude signatures.
+
+    A cell is excluded if its signature is a superset of one of the excludes.
+    Excludes are indexed by component, so that matching a cell only costs the
+    number of its components, whatever the number of excludes.
+    """
+
+    def __init__(self, signatures):
+        self.sizes = []
+        self.index = {}
+        self.excludeAll = False
+        for i, signature in enumerate(signatures):
+            if not signature:
+                self.excludeAll = True
+            self.sizes.append(len(signature))
+            for component in signature:
+                self.index.setdefault(component, []).append(i)
+
+    def advance(self, matched, components):
+        """
+        Account for more components of a partial cell.
+
+        matched maps exclude indexes to their number of components already
+        matched. returns the updated copy, or None if an exclude is now fully
+        matched.
+        """
+        matched = dict(matched)
+        for component in components:
+            for i in self.index.get(component, ()):
+                matched[i] = matched.get(i, 0) + 1
+                if matched[i] == self.sizes[i]:
+                    return None
+        return matched
+
+    def matches(self, signature):
+        return self.excludeAll or self.advance({}, signature) is None
+
+    def matching(self, signature):
+        """ indexes of all the signatures matched by signature """
+        matched = {}
+        for component in signature:
+            for i in self.index.get(component, ()):
+                matched[i] = matched.get(i, 0) + 1
+        return [i for i, size in enumerate(self.sizes) if matched.get(i, 0) == size]
+
+
+class CellPaths(object):
+    """
+    The paths: globs of the matrix cells.
+
+    A cell is affected by a change if one of the changed files matches the
+    globs of an entry matching the cell. Cells matched by no entry are
+    affected by any change.
+    """
+
+    def __init__(self, entries=()):
+        entries = list(entries)
+        self.matcher = MatrixExcluder([signature for signature, _ in entries])
+        self.regexes = [re.compile("|".join(fnmatch.translate(g) for g in globs))
+                        for _, globs in entries]
+
+    def __bool__(self):
+        return bool(self.regexes)
+    __nonzero__ = __bool__
+
+    def predicate(self, files):
+        """ returns a function telling whether a cell is affected by files """
+        hits = {}
+
+        def affected(cell):
+            entries = self.matcher.matching(cell_signature(cell))
+            if not entries:
+                return True
+            for i in entries:
+                if i not in hits:
+                    hits[i] = any(self.regexes[i].match(f) for f in files)
+                if hits[i]:
+                    return True
+            return False
+        return affected
+
+
+class TravisMatrix(object):
+    """
+    Lazily generated build matrix: the cartesian product of the axes, minus the
+    excludes, plus the includes.
+
+    Cells are generated on every iteration, and never kept; len() counts them
+    without generating them. Excludes are checked as soon as a partial
+    combination matches them, so that excluded combinations are never
+    generated.
+    """
+
+    def __init__(self, axes, excludes=(), includes=(), predicates=()):
+        # canonicalize every axis value only once
+        self.axes = []
+        for name, values in axes:
+            signatures = OrderedDict()
+            for value in values:
+                signature = cell_signature({name: value})
+                signatures.setdefault(signature, value)
+            self.axes.append((name, signatures))
+        self.excluder = MatrixExcluder([cell_signature(cell) for cell in excludes])
+        self.includes = []
+        signatures = set()
+        for cell in includes:
+            signature = cell_signature(cell)
+            if signature not in signatures and not self._generates(cell, signature):
+                self.includes.append(cell)
+                signatures.add(signature)
+        self.predicates = tuple(predicates)
+
+    def _generates(self, cell, signature):
+        """ whether the cartesian product generates this cell """
+        if set(cell) != set(name for name, _ in self.axes):
+            return False
+        for name, signatures in self.axes:
+            if cell_signature({name: cell[name]}) not in signatures:
+                return False
+        return not self.excluder.matches(signature)
+
+    def _product(self, depth, cell, matched):
+        if depth == len(self.axes):
+            yield dict(cell)
+            return
+        name, signatures = self.axes[depth]
+        for signature, value in signatures.items():
+            submatched = self.excluder.advance(matched, signature)
+            if submatched is None:
+                continue
+            cell[name] = value
+            for c in self._product(depth + 1, cell, submatched):
+                yield c
+        cell.pop(name, None)
+
+    def _count(self, depth, matched):
+        """ number of cells generated by _product, without generating them """
+        if depth == len(self.axes):
+            return 1
+        count = 0
+        for signature in self.axes[depth][1]:
+            submatched = self.excluder.advance(matched, signature)
+            if submatched is not None:
+                count += self._count(depth + 1, submatched)
+        return count
+
+    def _generate(self):
+        if self.axes and not self.excluder.excludeAll:
+            cells = self._product(0, {}, {})
+        else:
+            cells = iter(())
+        for cell in cells:
+            if all(predicate(cell) for predicate in self.predicates):
+                yield cell
+        for cell in self.includes:
+            if all(predicate(cell) for predicate in self.predicates):
+                yield cell
+
+    def __iter__(self):
+        return self._generate()
+
+    def filter(self, predicate):
+        """ returns a new matrix, restricted to the cells matching predicate """
+        matrix = TravisMatrix([], predicates=self.predicates + (predicate,))
+        matrix.axes, matrix.excluder, matrix.includes = self.axes, self.excluder, self.includes
+        return matrix
+
+    def __len__(self):
+        if self.predicates:
+            # the predicates need the cells
+            return sum(1 for _ in self._generate())
+        count = len(self.includes)
+        if self.axes and not self.excluder.excludeAll:
+            count += self._count(0, {})
+        return count
+
+    def __bool__(self):
+        for _ in self:
+            return True
+        return False
+    __nonzero__ = __bool__
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple, TravisMatrix)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    # compared by content, which is not hashable
+    __hash__ = None
+
+    def __repr__(self):
+        return "TravisMatrix(%r)" % (list(self),)
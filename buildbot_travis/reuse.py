@@ -0,0 +1,166 @@
+# Copyright 2012-2013 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+
+import sqlalchemy as sa
+import yaml
+from twisted.internet import defer
+from twisted.python import log
+
+from buildbot.process.results import SUCCESS
+from buildbot.util import service
+
+from .matrix import cell_signature
+from .travisyml import TRAVIS_HOOKS, TravisLoader
+
+# set by the git source steps, and by the poller: {codebase: tree hash}
+TREE_HASH_PROPERTY = "tree_hash"
+# set by the spawner on the jobs whose green result can be reused
+REUSE_KEY_PROPERTY = "matrix_reuse_key"
+
+STATE_NAME, STATE_CLASS = "TravisMatrixResults", "MatrixResultCache"
+# the number of green jobs which are remembered, the oldest are forgotten
+MAX_RESULTS = 10000
+# how many jobs are recorded between the removals of the oldest ones
+PRUNE_INTERVAL = 100
+
+
+def yamlNodeData(node):
+    """ the tags and values of a yaml node, as they are written """
+    if isinstance(node, yaml.MappingNode):
+        return [node.tag, [[yamlNodeData(k), yamlNodeData(v)] for k, v in node.value]]
+    if isinstance(node, yaml.SequenceNode):
+        return [node.tag, [yamlNodeData(n) for n in node.value]]
+    return [node.tag, node.value]
+
+
+def hooksSignature(travis_yml):
+    """ hash of the parts of the .travis.yml which are not in the cells
+
+    The yaml is composed, but not constructed: the steps of the plugins would
+    not have a stable representation.
+    """
+    hooks = {}
+    root = yaml.compose(travis_yml, Loader=TravisLoader)
+    if isinstance(root, yaml.MappingNode):
+        for key, value in root.value:
+            if key.value in TRAVIS_HOOKS + ("language",):
+                hooks[key.value] = yamlNodeData(value)
+    text = json.dumps(hooks, sort_keys=True)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def cellReuseKey(builderName, treeHashes, cell, hooks):
+    """ key of the result of a matrix cell, for a given source tree """
+    text = json.dumps([builderName, sorted(treeHashes.items()),
+                       sorted(cell_signature(cell)), hooks],
+                      default=repr)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+@defer.inlineCallbacks
+def getReusableResults(master, keys, pullRequest=False):
+    """ returns {key: build} for the keys which had a green build
+
+    The results of the pull requests are only trusted by the other pull
+    requests.
+    """
+    objectid = yield master.db.state.getObjectId(STATE_NAME, STATE_CLASS)
+
+    def thd(conn):
+        tbl = master.db.model.object_state
+        found = {}
+        keys_list = list(keys)
+        # stay below the sqlite limit on query parameters
+        for i in range(0, len(keys_list), 500):
+            q = sa.select([tbl.c.name, tbl.c.value_json])
+            q = q.where((tbl.c.objectid == objectid) & tbl.c.name.in_(keys_list[i:i + 500]))
+            for row in conn.execute(q):
+                build = json.loads(row.value_json)
+                if build.get('pull_request') and not pullRequest:
+                    continue
+                found[row.name] = build
+        return found
+    found = yield master.db.pool.do(thd)
+    defer.returnValue(found)
+
+
+@defer.inlineCallbacks
+def pruneResults(master, maxResults=MAX_RESULTS):
+    """ forget the oldest green jobs, but the last maxResults ones """
+    objectid = yield master.db.state.getObjectId(STATE_NAME, STATE_CLASS)
+
+    def thd(conn):
+        tbl = master.db.model.object_state
+        q = sa.select([tbl.c.name, tbl.c.value_json]).where(tbl.c.objectid == objectid)
+        rows = [(json.loads(row.value_json).get('buildid', 0), row.name)
+                for row in conn.execute(q)]
+        if len(rows) <= maxResults:
+            return 0
+        rows.sort()
+        names = [name for _, name in rows[:len(rows) - maxResults]]
+        for i in range(0, len(names), 500):
+            conn.execute(tbl.delete().where(
+                (tbl.c.objectid == objectid) & tbl.c.name.in_(names[i:i + 500])))
+        return len(names)
+    removed = yield master.db.pool.do(thd)
+    defer.returnValue(removed)
+
+
+class MatrixResultCache(service.BuildbotService):
+
+    """
+    Records the green matrix jobs, so that the spawners can reuse their result
+    when the same cell is built again on the same source tree. Only the last
+    MAX_RESULTS ones are kept.
+    """
+    name = "TravisMatrixResultCache"
+    recorded = 0
+
+    @defer.inlineCallbacks
+    def startService(self):
+        yield service.BuildbotService.startService(self)
+        self.consumer = yield self.master.mq.startConsuming(
+            self.buildFinished, ('builds', None, 'finished'))
+
+    def stopService(self):
+        self.consumer.stopConsuming()
+        return service.BuildbotService.stopService(self)
+
+    @defer.inlineCallbacks
+    def buildFinished(self, key, build):
+        if build['results'] != SUCCESS:
+            return
+        try:
+            # the jobs run on virtual builders, so only their properties tell them
+            properties = yield self.master.data.get(('builds', build['buildid'], 'properties'))
+            if REUSE_KEY_PROPERTY not in properties:
+                return
+            objectid = yield self.master.db.state.getObjectId(STATE_NAME, STATE_CLASS)
+            yield self.master.db.state.setState(
+                objectid, properties[REUSE_KEY_PROPERTY][0],
+                dict(buildid=build['buildid'], builderid=build['builderid'],
+                     number=build['number'],
+                     pull_request=bool(properties.get("TRAVIS_PULL_REQUEST", (False, ))[0])))
+            self.recorded += 1
+            if self.recorded % PRUNE_INTERVAL == 0:
+                yield pruneResults(self.master, MAX_RESULTS)
+        except Exception:
+            log.err(None, "while recording the result of build {}".format(build['buildid']))
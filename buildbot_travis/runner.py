@@ -4,11 +4,13 @@ from __future__ import print_function
 from builtins import range
 
 import argparse
+import codecs
 import hashlib
 import math
 import os
 import re
 import readline
+from collections import deque
 from subprocess import PIPE, STDOUT, Popen
 from threading import Lock
 
@@ -16,6 +18,7 @@ import urwid
 from twisted.internet import reactor
 from twisted.internet.threads import deferToThread
 
+from buildbot_travis.conditions import ConditionEvaluator
 from buildbot_travis.steps.create_steps import SetupVirtualEnv
 from buildbot_travis.travisyml import TRAVIS_HOOKS, TravisYml
 # Fix Python 2.x.
@@ -24,6 +27,15 @@ except NameError: pass
 
 [readline]  # is imported for side effect (i.e get decent raw_input)
 
+# the output of the commands is read by chunks of at most that size
+OUTPUT_CHUNK_SIZE = 64 * 1024
+# what is kept of the output of the commands whose output is needed
+CAPTURED_SIZE = 64 * 1024
+# the output waiting for the next redraw of a window; the terminal would not
+# keep more than its scrollback anyway
+MAX_PENDING_SIZE = 1024 * 1024
+REDRAW_INTERVAL = 0.1
+
 
 def loadTravisYml():
     yml = TravisYml()
@@ -41,23 +53,40 @@ class Runner(object):
         self.window = window
         self.pwd = os.getcwd()
 
-    def runAndSendOutput(self, cmd):
+    def runAndSendOutput(self, cmd, capture=False):
+        """run cmd, sending its output to our window as it comes
+
+        The output is only returned if capture is set, and then only its last
+        CAPTURED_SIZE characters, so that verbose commands run in constant memory.
+        """
         if reactor._stopped:
             return 1, ""
         popen = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-        all_text = ""
-        for stdout_line in iter(lambda: popen.stdout.readline(), ""):
-            all_text += stdout_line
+        # the commands are not interactive
+        popen.stdin.close()
+        captured = ""
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        fd = popen.stdout.fileno()
+        while True:
+            # whatever output is available, rather than line by line
+            data = os.read(fd, OUTPUT_CHUNK_SIZE)
+            # at the end of the output, flush an incomplete last character
+            text = decoder.decode(data, final=not data)
+            if capture:
+                captured = (captured + text)[-CAPTURED_SIZE:]
             if reactor._stopped:
                 popen.terminate()
-            self.ui.addTextForWindow(self.window, stdout_line)
+            if text:
+                self.ui.addTextForWindow(self.window, text)
+            if not data:
+                break
         popen.stdout.close()
         return_code = popen.wait()
-        return return_code, all_text
+        return return_code, captured
 
-    def run(self, shellscript):
+    def run(self, shellscript, capture=False):
         cmd = ["bash", "-c", shellscript]
-        return self.runAndSendOutput(cmd)
+        return self.runAndSendOutput(cmd, capture=capture)
 
     def close(self):
         pass
@@ -75,16 +104,16 @@ class DockerRunner(Runner):
             if env in os.environ:
                 cmd.extend(['-e', env + '=' + os.environ[env]])
         cmd.extend([image, "sleep", "200000"])
-        rv, self.containerid = self.runAndSendOutput(cmd)
+        rv, self.containerid = self.runAndSendOutput(cmd, capture=True)
         self.containerid = self.containerid.strip()
         self.ui.addTextForWindow(
             self.window,
             "started container " + image + " " + self.containerid[:10] + "\n")
 
-    def run(self, shellscript):
+    def run(self, shellscript, capture=False):
         cmd = ['docker', 'exec', '-t', self.containerid, "bash", "-c",
                shellscript]
-        return self.runAndSendOutput(cmd)
+        return self.runAndSendOutput(cmd, capture=capture)
 
     def close(self):
         self.runAndSendOutput(['docker', 'rm', '-f', self.containerid])
@@ -156,6 +185,12 @@ class Ui(object):
         self.lock = Lock()
         self.curwindow = 0
         self.redrawing = False
+        self.resetPending()
+
+    def resetPending(self):
+        self.pending = [deque() for i in range(self.maxwindow)]
+        self.pendingSizes = [0] * self.maxwindow
+        self.skipped = [0] * self.maxwindow
 
     def registerWindow(self, title):
         with self.lock:
@@ -166,42 +201,63 @@ class Ui(object):
         return n
 
     def addTextForWindow(self, n, text):
+        """buffer the text of a window, until the next redraw tick
+
+        This is called from the runner threads, so it must stay cheap whatever
+        the rate of the output.
+        """
         with self.lock:
-            output_widget = self.windows[n]
-            output_widget.add_text(text)
-        self.redraw()
+            pending = self.pending[n]
+            pending.append(text)
+            self.pendingSizes[n] += len(text)
+            while self.pendingSizes[n] > MAX_PENDING_SIZE and len(pending) > 1:
+                dropped = len(pending.popleft())
+                self.pendingSizes[n] -= dropped
+                self.skipped[n] += dropped
+            scheduled, self.redrawing = self.redrawing, True
+        if not scheduled:
+            reactor.callFromThread(reactor.callLater, REDRAW_INTERVAL, self._redraw)
 
     def redraw(self):
         # redraw with 100ms debounce
         with self.lock:
-            if not self.redrawing:
-                self.redrawing = True
-                reactor.callLater(0.1, self._redraw)
+            scheduled, self.redrawing = self.redrawing, True
+        if not scheduled:
+            reactor.callFromThread(reactor.callLater, REDRAW_INTERVAL, self._redraw)
 
     def _redraw(self):
+        # the text arriving from now on waits for the next tick
+        with self.lock:
+            pending, skipped = self.pending, self.skipped
+            self.resetPending()
+            self.redrawing = False
+        for n, chunks in enumerate(pending):
+            if skipped[n]:
+                self.windows[n].add_text("\n[... %d characters skipped ...]\n" % skipped[n])
+            if chunks:
+                self.windows[n].add_text("".join(chunks))
         self.loop.draw_screen()
-        self.redrawing = False
 
 
 def filter_config(config, args):
     if not args.filters:
         return
-    new_matrix = []
-    for env in config.matrix:
+
+    def predicate(env):
         final_env = flatten_env(env)
-        for f in args.filters:
-            k, op, v = f
-            res = False
-            if k in final_env:
-                if op == '==' or op == '=':
-                    res = str(final_env[k]) == v
-                if op == '!=':
-                    res = str(final_env[k]) != v
-            if not res:
-                break
-        if res:
-            new_matrix.append(env)
-    config.matrix = new_matrix
+        for k, op, v in args.filters:
+            if k not in final_env:
+                return False
+            if op == '==' or op == '=':
+                if str(final_env[k]) != v:
+                    return False
+            elif op == '!=':
+                if str(final_env[k]) == v:
+                    return False
+            else:
+                return False
+        return True
+    config.matrix = config.matrix.filter(predicate)
 
 
 def flatten_env(env):
@@ -260,11 +316,12 @@ def run(args):
             ve.sandboxname = "sandbox" + hashlib.sha1(matrix).hexdigest()
             vecmd = ve.buildCommand()
             if not args.dryrun:
-                rc, out = runner.run(vecmd)
-                _, path = runner.run("echo -n $PATH")
+                runner.run(vecmd)
+                _, path = runner.run("echo -n $PATH", capture=True)
                 script += 'export PATH="{}/{}/bin:{}"'.format(
                     runner.pwd, ve.sandboxname, path)
 
+        testCondition = ConditionEvaluator(final_env)
         print_to_window("running matrix", matrix)
         print_to_window("========================")
         for k in TRAVIS_HOOKS:
@@ -279,12 +336,12 @@ def run(args):
                     command = command['cmd']
                 if title:
                     print_to_window("title:", title)
-                if condition and not eval(condition, final_env):
+                if condition and not testCondition(condition):
                     print_to_window("not run because of", condition)
                     continue
                 print_to_window(command)
                 if not args.dryrun:
-                    rc, out = runner.run(script + "\n" + command)
+                    rc, _ = runner.run(script + "\n" + command)
                     print_to_window("results:", rc)
                     if rc:
                         results = rc
@@ -0,0 +1,83 @@
+# Copyright 2012-2013 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from twisted.internet import defer
+from twisted.python import log
+
+from buildbot.schedulers.triggerable import Triggerable
+
+
+class TravisTriggerable(Triggerable):
+
+    """
+    Triggerable scheduler which can create the buildsets of many matrix cells at
+    once.
+
+    Each matrix cell gets its own buildset, as the cells have different
+    properties. The buildsets are all requested at the same time, through the
+    public Triggerable.trigger(), rather than one after the other as the
+    Trigger step does. The Trigger step then picks them up one by one, through
+    the usual trigger() method.
+    """
+
+    def __init__(self, name, builderNames, **kwargs):
+        Triggerable.__init__(self, name, builderNames, **kwargs)
+        # id(set_props) -> (set_props, idsDeferred, resultsDeferred). The entry
+        # keeps set_props alive, so that its id is not reused meanwhile
+        self._matrix = {}
+
+    def trigger(self, waited_for, sourcestamps=None, set_props=None,
+                parent_buildid=None, parent_relationship=None):
+        entry = self._matrix.get(id(set_props))
+        if entry is not None and entry[0] is set_props:
+            del self._matrix[id(set_props)]
+            return entry[1], entry[2]
+        return Triggerable.trigger(self, waited_for, sourcestamps=sourcestamps,
+                                   set_props=set_props, parent_buildid=parent_buildid,
+                                   parent_relationship=parent_relationship)
+
+    def forgetMatrix(self, propertiesList):
+        for set_props in propertiesList:
+            self._matrix.pop(id(set_props), None)
+
+    @defer.inlineCallbacks
+    def addMatrixBuildsets(self, waited_for, sourcestamps, propertiesList,
+                           parent_buildid=None, parent_relationship=None):
+        """ Create a buildset for each of propertiesList, to be picked up by
+        trigger() calls with the same Properties objects
+
+        returns the (bsid, brids) of each buildset, in propertiesList order
+        """
+        triggered = []
+        for set_props in propertiesList:
+            idsDeferred, resultsDeferred = Triggerable.trigger(
+                self, waited_for, sourcestamps=sourcestamps, set_props=set_props,
+                parent_buildid=parent_buildid, parent_relationship=parent_relationship)
+            triggered.append((idsDeferred, resultsDeferred))
+        # all the buildsets are requested before waiting for any of them
+        results = yield defer.DeferredList([idsDeferred for idsDeferred, _ in triggered],
+                                           consumeErrors=True)
+        ids = []
+        for set_props, (ok, value), (_, resultsDeferred) in zip(
+                propertiesList, results, triggered):
+            if not ok:
+                value.raiseException()
+            ids.append(value)
+            self._matrix[id(set_props)] = (set_props, defer.succeed(value), resultsDeferred)
+        log.msg("added %d matrix buildsets to database" % len(ids))
+        defer.returnValue(ids)
@@ -16,12 +16,16 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import base64
+import posixpath
+import zlib
+
 from twisted.internet import defer
 
-from buildbot.process import buildstep
+from buildbot.process import buildstep, remotecommand
 from buildbot.steps.worker import CompositeStepMixin
 
-from ..travisyml import TravisYml, TravisYmlInvalid
+from ..travisyml import TravisYmlInvalid, parse_cache
 
 
 HOW_TO_DEBUG = """
@@ -33,6 +37,45 @@ pip install buildbot_travis
 bbtravis run
 """
 
+# property used by the spawner to ship the .travis.yml it used to the jobs
+TRAVIS_CONFIG_PROPERTY = "travis_config"
+TRAVIS_CONFIG_VERSION = 1
+# set by the spawner on the jobs matching matrix.allow_failures
+ALLOW_FAILURE_PROPERTY = "allow_failure"
+
+# prints the name, then the content, of the first existing file
+FETCH_CONFIG_SCRIPT = ('for f in {0}; do '
+                       'if [ -f "$f" ]; then echo "$f"; exec cat "$f"; fi; '
+                       'done; exit {1}')
+NO_CONFIG_RC = 3
+
+
+def packConfig(filename, travis_yml, revisions):
+    """ Serialize a .travis.yml into a compact, json compatible, property value """
+    if not isinstance(travis_yml, bytes):
+        travis_yml = travis_yml.encode("utf-8")
+    return dict(
+        version=TRAVIS_CONFIG_VERSION,
+        filename=filename,
+        revisions=revisions,
+        digest=parse_cache.digest(travis_yml),
+        content=base64.b64encode(zlib.compress(travis_yml)).decode("ascii"))
+
+
+def unpackConfig(payload):
+    """ returns the (filename, travis_yml, revisions) shipped by packConfig,
+    or None if the payload is not usable
+    """
+    if not isinstance(payload, dict) or payload.get("version") != TRAVIS_CONFIG_VERSION:
+        return None
+    try:
+        travis_yml = zlib.decompress(base64.b64decode(payload["content"]))
+        if parse_cache.digest(travis_yml) != payload["digest"]:
+            return None
+        return payload["filename"], travis_yml.decode("utf-8"), payload["revisions"]
+    except Exception:
+        return None
+
 
 class ConfigurableStepMixin(CompositeStepMixin):
 
@@ -50,29 +93,89 @@ class ConfigurableStepMixin(CompositeStepMixin):
     def addHelpLog(self):
         self.addCompleteLog("help.txt", HOW_TO_DEBUG)
 
+    def getGotRevisions(self):
+        got_revisions = self.getProperty("got_revision", {})
+        if not isinstance(got_revisions, dict):
+            got_revisions = {'': got_revisions}
+        return got_revisions
+
+    def getShippedConfig(self):
+        """ Get the .travis.yml shipped by the spawner, unless it is stale,
+        i.e. we did not checkout the revision it was read from
+        """
+        shipped = unpackConfig(self.getProperty(TRAVIS_CONFIG_PROPERTY))
+        if shipped is None:
+            return None, None
+        filename, travis_yml, revisions = shipped
+        got_revisions = self.getGotRevisions()
+        for codebase, revision in revisions.items():
+            if got_revisions.get(codebase) != revision:
+                return None, None
+        return filename, travis_yml
+
     @defer.inlineCallbacks
-    def getStepConfig(self):
-        travis_yml = None
-        for filename in self.TRAVIS_FILENAMES:
-            try:
-                travis_yml = yield self.getFileContentFromWorker(filename, abandonOnFailure=True)
-                break
-            except buildstep.BuildStepFailed as e:
-                continue
+    def catConfigFromWorker(self):
+        """ Fetch the first of TRAVIS_FILENAMES found on the worker, in a single
+        remote command. returns (filename, travis_yml), (None, None) if there
+        is none, or None if the worker could not tell
+        """
+        if (getattr(self.worker, "path_module", posixpath) is not posixpath or
+                not self.workerVersion("shell")):
+            defer.returnValue(None)
+        script = FETCH_CONFIG_SCRIPT.format(
+            " ".join('"%s"' % f for f in self.TRAVIS_FILENAMES), NO_CONFIG_RC)
+        cmd = remotecommand.RemoteShellCommand(
+            self.workdir, ["/bin/sh", "-c", script], want_stderr=False,
+            logEnviron=False, collectStdout=True)
+        yield self.runCommand(cmd)
+        if cmd.rc == NO_CONFIG_RC:
+            defer.returnValue((None, None))
+        if cmd.rc != 0 or "\n" not in cmd.stdout:
+            defer.returnValue(None)
+        filename, travis_yml = cmd.stdout.split("\n", 1)
+        if filename not in self.TRAVIS_FILENAMES:
+            defer.returnValue(None)
+        defer.returnValue((filename, travis_yml))
+
+    @defer.inlineCallbacks
+    def getConfigFromWorker(self):
+        found = yield self.catConfigFromWorker()
+        if found is not None and found[0] is not None:
+            defer.returnValue(found)
+
+        error = None
+        if found is None:
+            # fallback to uploading the candidates one by one
+            for filename in self.TRAVIS_FILENAMES:
+                try:
+                    travis_yml = yield self.getFileContentFromWorker(
+                        filename, abandonOnFailure=True)
+                    defer.returnValue((filename, travis_yml))
+                except buildstep.BuildStepFailed as e:
+                    error = e
+        if error is None or not str(error):
+            error = buildstep.BuildStepFailed("none of {0} found in {1}".format(
+                ", ".join(self.TRAVIS_FILENAMES), self.workdir))
+
+        self.descriptionDone = u"unable to fetch .travis.yml"
+        self.addCompleteLog(
+            "error",
+            "Please put a file named .travis.yml at the root of your repository:\n{0}".format(
+                error))
+        self.addHelpLog()
+        raise error
 
+    @defer.inlineCallbacks
+    def getStepConfig(self):
+        filename, travis_yml = self.getShippedConfig()
         if travis_yml is None:
-            self.descriptionDone = u"unable to fetch .travis.yml"
-            self.addCompleteLog(
-                "error",
-                "Please put a file named .travis.yml at the root of your repository:\n{0}".format(e))
-            self.addHelpLog()
-            raise
+            filename, travis_yml = yield self.getConfigFromWorker()
+        self.configFilename, self.configContent = filename, travis_yml
 
         self.addCompleteLog(filename, travis_yml)
 
-        config = TravisYml()
         try:
-            config.parse(travis_yml)
+            config = parse_cache.parse(travis_yml)
         except TravisYmlInvalid as e:
             self.descriptionDone = u"bad .travis.yml"
             self.addCompleteLog(
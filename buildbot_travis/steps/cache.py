@@ -0,0 +1,368 @@
+# Copyright 2012-2013 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import re
+import textwrap
+
+from twisted.internet import defer, threads
+from twisted.python import log
+
+from buildbot.process import remotetransfer
+from buildbot.process.buildstep import BuildStep, ShellMixin
+from buildbot.process.results import FAILURE, SKIPPED, SUCCESS, WARNINGS
+from buildbot.steps.worker import CompositeStepMixin
+from buildbot.util import ComparableMixin, unicode2bytes
+
+try:
+    from shlex import quote
+except ImportError:  # python 2
+    from pipes import quote
+
+DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+
+# sha256 of stdin, with either GNU coreutils or perl's shasum
+SHA256 = """{ sha256sum 2>/dev/null || shasum -a 256; } | cut -d" " -f1"""
+
+KEY_SCRIPT = textwrap.dedent("""\
+    for f in {globs}; do
+        if test -f "$f"; then echo "$f"; cat "$f"; fi
+    done | {sha256}
+    """)
+
+# without key files, the content of the directories is summarized by the
+# listing of their files: names, modes and sizes, but not the mtimes, which
+# differ from one build to the other
+LISTING_SCRIPT = textwrap.dedent("""\
+    for d in {directories}; do
+        if test -e "$d"; then
+            echo "$d"; LC_ALL=C ls -lRn "$d" | awk '{{ $6 = $7 = $8 = ""; print }}'
+        fi
+    done | {sha256}
+    """)
+
+# the tarballs hold paths relative to the $HOME and build directories, linked
+# from a root directory as home/ and build/, so that they can be restored in
+# another home or build directory
+LINK_ROOT_SCRIPT = textwrap.dedent("""\
+    ROOT={root}
+    rm -rf "$ROOT" && mkdir "$ROOT" &&
+        ln -s "$HOME" "$ROOT/home" && ln -s "$PWD" "$ROOT/build" || exit 1
+    """)
+
+SAVE_SCRIPT = LINK_ROOT_SCRIPT + textwrap.dedent("""\
+    members=()
+    for d in {members}; do
+        if test -e "$ROOT/$d"; then members+=("$d"); fi
+    done
+    if test ${{#members[@]}} -eq 0; then
+        echo "None of the cached directories exist"
+        rm -rf "$ROOT"
+        exit 3
+    fi
+    tar -czf {tarball} -C "$ROOT" "${{members[@]}}"
+    rc=$?
+    rm -rf "$ROOT"
+    exit $rc
+    """)
+
+RESTORE_SCRIPT = LINK_ROOT_SCRIPT + textwrap.dedent("""\
+    tar -xzf {tarball} -C "$ROOT"
+    rc=$?
+    rm -rf "$ROOT" {tarball}
+    exit $rc
+    """)
+
+NOTHING_TO_CACHE = 3
+# bump when the content of the tarballs changes
+LAYOUT_VERSION = 2
+
+
+def shellPath(path):
+    """ quote a path for the shell, but still expand ~/ """
+    if path.startswith("~/"):
+        return '"$HOME"/' + quote(path[2:])
+    return quote(path)
+
+
+def memberPath(path):
+    """ the path of a cached directory in the tarballs, quoted for the shell """
+    if path.startswith("~/"):
+        return "home/" + quote(path[2:])
+    return "build/" + quote(path)
+
+
+def cacheScope(buildername, label, directories):
+    """ The caches are not shared between the jobs, nor their matrix cells """
+    scope = json.dumps([LAYOUT_VERSION, buildername, label, sorted(directories)])
+    return hashlib.sha1(unicode2bytes(scope)).hexdigest()
+
+
+class CacheStore(ComparableMixin):
+
+    """
+    A content-addressed store of the tarballs of the cached directories, on
+    the master's filesystem: <path>/<scope>/<digest>.tar.gz
+
+    The digest is the hash of the key files, so that a tarball is only saved
+    when they change. The least recently used tarballs are removed when the
+    store is bigger than max_size MB.
+
+    The methods do blocking I/O: the steps call them in a thread.
+    """
+    compare_attrs = ("path", "max_size")
+    DEFAULT_MAX_SIZE = 10240
+    suffix = ".tar.gz"
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+    def entryPath(self, scope, digest):
+        return os.path.join(self.path, scope, digest + self.suffix)
+
+    def hasEntry(self, scope, digest):
+        return os.path.exists(self.entryPath(scope, digest))
+
+    def listEntries(self, scope=None):
+        """ (mtime, size, path) of the tarballs of a scope, or of the whole store """
+        if scope is None:
+            scopes = os.listdir(self.path) if os.path.isdir(self.path) else []
+        else:
+            scopes = [scope]
+        entries = []
+        for scope in scopes:
+            directory = os.path.join(self.path, scope)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if not name.endswith(self.suffix):
+                    # uploads in progress
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def lookup(self, scope, digest=None):
+        """ The tarball of the digest, else the most recent one of the scope """
+        path = None
+        if digest is not None and self.hasEntry(scope, digest):
+            path = self.entryPath(scope, digest)
+        else:
+            entries = self.listEntries(scope)
+            if entries:
+                path = max(entries)[2]
+        if path is not None:
+            try:
+                # the mtime orders the eviction
+                os.utime(path, None)
+            except OSError:
+                return None
+        return path
+
+    def evict(self, keep=None):
+        """ remove the least recently used tarballs, but the one just saved """
+        total = 0
+        entries = sorted(self.listEntries(), key=lambda e: (e[2] == keep, e[0]), reverse=True)
+        for mtime, size, path in entries:
+            total += size
+            if path == keep or total <= self.max_size * 1024 * 1024:
+                continue
+            log.msg("Removing cache tarball {}".format(path))
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class CacheStep(ShellMixin, CompositeStepMixin, BuildStep):
+
+    """ Base class of the steps restoring and saving the cached directories """
+    flunkOnFailure = False
+    warnOnFailure = True
+    logEnviron = False
+    tarball = ".travis-cache.tar.gz"
+    root = ".travis-cache-root"
+    blockSize = 256 * 1024
+
+    def __init__(self, store, directories, key=None, **kwargs):
+        self.store = store
+        self.directories = directories
+        self.key = key or []
+        kwargs = self.setupShellMixin(kwargs)
+        BuildStep.__init__(self, **kwargs)
+
+    def getScope(self):
+        return cacheScope(self.getProperty("buildername"), self.getProperty("matrix_label"),
+                          self.directories)
+
+    def shellDirectories(self):
+        return " ".join(shellPath(d) for d in self.directories)
+
+    def shellMembers(self):
+        return " ".join(memberPath(d) for d in self.directories)
+
+    @defer.inlineCallbacks
+    def runShell(self, script, collectStdout=False):
+        cmd = yield self.makeRemoteShellCommand(command=["bash", "-c", script],
+                                                collectStdout=collectStdout)
+        yield self.runCommand(cmd)
+        defer.returnValue(cmd)
+
+    @defer.inlineCallbacks
+    def computeDigest(self, script):
+        cmd = yield self.runShell(script, collectStdout=True)
+        digest = cmd.stdout.strip()
+        if cmd.didFail() or not DIGEST_RE.match(digest):
+            defer.returnValue(None)
+        defer.returnValue(digest)
+
+    def computeKeyDigest(self):
+        return self.computeDigest(KEY_SCRIPT.format(globs=" ".join(self.key), sha256=SHA256))
+
+    def transferArgs(self, command, direction):
+        args = {
+            'workdir': self.workdir,
+            'maxsize': None,
+            'blocksize': self.blockSize,
+        }
+        if self.workerVersionIsOlderThan(command, '3.0'):
+            args['slave' + direction] = self.tarball
+        else:
+            args['worker' + direction] = self.tarball
+        return args
+
+
+class RestoreCache(CacheStep):
+
+    """
+    Restore the cached directories, from the tarball of the key files, or
+    else from the most recent one of the job.
+    """
+    name = "restore cache"
+
+    @defer.inlineCallbacks
+    def run(self):
+        scope = self.getScope()
+        digest = None
+        if self.key:
+            digest = yield self.computeKeyDigest()
+        path = yield threads.deferToThread(self.store.lookup, scope, digest)
+        if path is None:
+            self.descriptionDone = u"cache miss"
+            defer.returnValue(SUCCESS)
+
+        self.checkWorkerHasCommand("downloadFile")
+        try:
+            fp = open(path, "rb")
+        except (IOError, OSError):
+            # evicted since the lookup
+            self.descriptionDone = u"cache miss"
+            defer.returnValue(SUCCESS)
+        with fp:
+            args = self.transferArgs("downloadFile", "dest")
+            args.update(reader=remotetransfer.FileReader(fp), mode=None)
+            ok = yield self.runRemoteCommand('downloadFile', args, abandonOnFailure=False,
+                                             evaluateCommand=lambda cmd: not cmd.didFail())
+        if not ok:
+            self.descriptionDone = u"cache download failed"
+            defer.returnValue(FAILURE)
+        cmd = yield self.runShell(RESTORE_SCRIPT.format(root=self.root, tarball=self.tarball))
+        if cmd.didFail():
+            self.descriptionDone = u"cache extraction failed"
+            defer.returnValue(FAILURE)
+        if digest is not None and path == self.store.entryPath(scope, digest):
+            self.descriptionDone = u"restored cache"
+        else:
+            self.descriptionDone = u"restored previous cache"
+        defer.returnValue(SUCCESS)
+
+
+class SaveCache(CacheStep):
+
+    """
+    Save the cached directories, unless the store has their tarball already.
+
+    The pull requests only restore the caches: their changes are not trusted
+    to poison the caches of the branches.
+    """
+    name = "save cache"
+    alwaysRun = True
+
+    @defer.inlineCallbacks
+    def run(self):
+        if self.getProperty("TRAVIS_PULL_REQUEST"):
+            self.descriptionDone = u"cache not saved for pull requests"
+            defer.returnValue(SKIPPED)
+        scope = self.getScope()
+        if self.key:
+            digest = yield self.computeKeyDigest()
+        else:
+            digest = yield self.computeDigest(LISTING_SCRIPT.format(
+                directories=self.shellDirectories(), sha256=SHA256))
+        if digest is None:
+            self.descriptionDone = u"could not compute the cache key"
+            defer.returnValue(WARNINGS)
+        exists = yield threads.deferToThread(self.store.hasEntry, scope, digest)
+        if exists:
+            self.descriptionDone = u"cache unchanged"
+            defer.returnValue(SUCCESS)
+
+        cmd = yield self.runShell(SAVE_SCRIPT.format(root=self.root, members=self.shellMembers(),
+                                                     tarball=self.tarball))
+        if cmd.rc == NOTHING_TO_CACHE:
+            self.descriptionDone = u"nothing to cache"
+            defer.returnValue(SUCCESS)
+        if cmd.didFail():
+            self.descriptionDone = u"cache archiving failed"
+            defer.returnValue(FAILURE)
+
+        path = self.store.entryPath(scope, digest)
+        ok = yield self.uploadTarball(path)
+        yield self.runRmFile(self.build.path_module.join(self.workdir, self.tarball),
+                             abandonOnFailure=False)
+        if not ok:
+            self.descriptionDone = u"cache upload failed"
+            defer.returnValue(FAILURE)
+        yield threads.deferToThread(self.store.evict, keep=path)
+        self.descriptionDone = u"saved cache"
+        defer.returnValue(SUCCESS)
+
+    @defer.inlineCallbacks
+    def uploadTarball(self, path):
+        self.checkWorkerHasCommand("uploadFile")
+        # the tarball is renamed in the store once complete, and removed if
+        # the upload fails
+        writer = remotetransfer.FileWriter(path, None, None)
+        args = self.transferArgs("uploadFile", "src")
+        args['writer'] = writer
+        try:
+            ok = yield self.runRemoteCommand('uploadFile', args, abandonOnFailure=False,
+                                             evaluateCommand=lambda cmd: not cmd.didFail())
+        except Exception:
+            writer.cancel()
+            raise
+        if not ok:
+            writer.cancel()
+        defer.returnValue(ok)
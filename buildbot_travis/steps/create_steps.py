@@ -14,27 +14,156 @@
 
 from __future__ import absolute_import, division, print_function
 
+import fnmatch
 import os
 import re
 import textwrap
 import traceback
 
+from future.utils import string_types
 from twisted.internet import defer
 
 from buildbot.process.buildstep import (SUCCESS, BuildStep, LoggingBuildStep,
                                         ShellMixin)
+from buildbot.process.logobserver import LogLineObserver
 from buildbot.steps import shell
+from buildbot.util import ComparableMixin
 
+from ..conditions import ConditionEvaluator
+from ..reuse import REUSE_KEY_PROPERTY, TREE_HASH_PROPERTY
+from ..throttle import MAX_PARALLEL_JOBS_PROPERTY
+from ..timing import PHASES_PROPERTY, compressPhases
 from ..travisyml import TRAVIS_HOOKS
-from .base import ConfigurableStep
+from .base import ALLOW_FAILURE_PROPERTY, TRAVIS_CONFIG_PROPERTY, ConfigurableStep
+from .cache import RestoreCache, SaveCache, shellPath
+from .reports import REPORT_PARSERS, ParseTestReports
+
+
+class VirtualEnvCache(ComparableMixin):
+
+    """
+    A cache of virtualenvs on the workers, keyed by the python version and the
+    content of the requirements files, which are installed in the cached
+    virtualenvs.
+
+    The builds get a copy of the cached virtualenv, copy-on-write where the
+    filesystem supports it, so that what they install does not end up in the
+    cache. The least recently used virtualenvs are removed when the cache is
+    bigger than max_size MB.
+    """
+    compare_attrs = ('path', 'max_size', 'requirements')
+    # bump when the layout of the cached virtualenvs changes
+    VERSION = 1
+    DEFAULT_MAX_SIZE = 2048
+
+    def __init__(self, path="~/.cache/buildbot_travis/virtualenvs", max_size=DEFAULT_MAX_SIZE,
+                 requirements=("requirements*.txt", )):
+        self.path = path
+        self.max_size = max_size
+        self.requirements = list(requirements)
+
+    def buildCommand(self, python, sandboxname):
+        return VIRTUALENV_CACHE_SCRIPT.format(
+            virtualenv_python=python, sandboxname=sandboxname, version=self.VERSION,
+            cache=shellPath(self.path), max_kb=int(self.max_size * 1024),
+            key_script=VIRTUALENV_KEY_SCRIPT,
+            # globs, expanded by the shell
+            requirements=" ".join(self.requirements))
+
+
+# the cache key: a digest of the python version and the requirements, on stdin
+VIRTUALENV_KEY_SCRIPT = ("import hashlib, sys; "
+                         "print(hashlib.sha1(getattr(sys.stdin, 'buffer', sys.stdin).read())"
+                         ".hexdigest()[:16])")
+
+VIRTUALENV_CACHE_SCRIPT = textwrap.dedent("""\
+    PYTHON='python{virtualenv_python}'
+    VE='{sandboxname}'
+    CACHE={cache}
+
+    KEY=$({{ echo {version}; "$PYTHON" -c 'import sys; print(sys.version)' || exit 1
+           for f in {requirements}; do
+               if [ -f "$f" ]; then echo "$f"; cat "$f"; fi
+           done; }} | "$PYTHON" -c "{key_script}") || exit 1
+    ENTRY="$CACHE/$PYTHON-$KEY"
+
+    install_requirements() {{
+        for f in {requirements}; do
+            if [ -f "$f" ]; then "$1" -m pip install -r "$f" || return 1; fi
+        done
+    }}
+
+    setup_entry() {{
+        if test -f "$ENTRY/ready"; then
+            echo "Using cached virtualenv $ENTRY"
+        else
+            echo "Setting up cached virtualenv $ENTRY"
+            mkdir -p "$CACHE" || return 1
+            TMP=$(mktemp -d "$CACHE/.tmp.XXXXXX") || return 1
+            {{ virtualenv -p $PYTHON "$TMP/venv" &&
+              echo "Upgrading pip" &&
+              "$TMP/venv/bin/python" -m pip install -U pip &&
+              install_requirements "$TMP/venv/bin/python" &&
+              echo "$TMP/venv" > "$TMP/origin" &&
+              touch "$TMP/ready"; }} || {{ rm -rf "$TMP"; return 1; }}
+            # another build might have been faster, then mv nests ours in its entry
+            if ! test -e "$ENTRY"; then mv "$TMP" "$ENTRY"; fi
+            rm -rf "$TMP" "$ENTRY/${{TMP##*/}}"
+        fi
+        touch "$ENTRY/ready"
+    }}
+
+    # the jobs get a real copy (or a copy-on-write one, where the filesystem
+    # can), so that what they install does not end up in the cache. The entry
+    # may be evicted by another build while it is copied: set it up again then
+    ORIGIN=
+    for attempt in 1 2 3; do
+        setup_entry || exit 1
+        rm -rf "$VE"
+        test -d "$VE" && {{ echo "$VE couldn't be removed"; exit 1; }}
+        if {{ cp -a --reflink=auto "$ENTRY/venv" "$VE" 2>/dev/null ||
+              {{ rm -rf "$VE"; cp -a "$ENTRY/venv" "$VE"; }}; }} &&
+            ORIGIN=$(cat "$ENTRY/origin"); then
+            break
+        fi
+        ORIGIN=
+        echo "Cached virtualenv $ENTRY went away while copying it"
+    done
+    test -n "$ORIGIN" || exit 1
+
+    # the scripts refer to the cached virtualenv, point them to ours
+    DEST=$(cd "$VE" && pwd)
+    for f in "$VE"/bin/*; do
+        if test -f "$f" && ! test -L "$f" && grep -qF "$ORIGIN" "$f"; then
+            sed "s|$ORIGIN|$DEST|g" "$f" > "$f.relocated" && chmod 755 "$f.relocated" &&
+                mv -f "$f.relocated" "$f" || exit 1
+        fi
+    done
+
+    # evict the least recently used virtualenvs. They are renamed first, which
+    # is atomic, so that the other builds see either the whole entry or none
+    total=0
+    ls -td "$CACHE"/*/ready 2>/dev/null | while read -r ready; do
+        entry=$(dirname "$ready")
+        total=$((total + $(du -sk "$entry" | cut -f1)))
+        if [ "$total" -gt {max_kb} ] && [ "$entry" != "$ENTRY" ]; then
+            echo "Removing cached virtualenv $entry"
+            trash=$(mktemp -d "$CACHE/.tmp.XXXXXX") &&
+                mv "$entry" "$trash/" && rm -rf "$trash"
+        fi
+    done
+    find "$CACHE" -maxdepth 1 -name '.tmp.*' -mmin +1440 -exec rm -rf {{}} + 2>/dev/null
+    exit 0
+    """)
 
 
 class SetupVirtualEnv(ShellMixin, LoggingBuildStep):
     name = "setup virtualenv"
     sandboxname = "sandbox"
 
-    def __init__(self, python, **kwargs):
+    def __init__(self, python, cache=None, **kwargs):
         self.python = python
+        self.cache = cache
         super(SetupVirtualEnv, self).__init__(haltOnFailure=True, **kwargs)
 
     @defer.inlineCallbacks
@@ -50,6 +179,8 @@ class SetupVirtualEnv(ShellMixin, LoggingBuildStep):
         defer.returnValue(cmd.results())
 
     def buildCommand(self):
+        if self.cache is not None:
+            return self.cache.buildCommand(self.python, self.sandboxname)
         # set up self.command as a very long sh -c invocation
         command = textwrap.dedent("""\
         PYTHON='python{virtualenv_python}'
@@ -75,21 +206,199 @@ class SetupVirtualEnv(ShellMixin, LoggingBuildStep):
         return command
 
 
+def compileGlobs(globs):
+    return re.compile("|".join(fnmatch.translate(g) for g in globs))
+
+
+class PropertiesEnvironment(ComparableMixin):
+
+    """
+    Turns the build properties into environment variables for the shell
+    commands.
+
+    Only the properties matching the allow globs (all of them by default), and
+    not the deny globs, are exported. The internal properties of
+    buildbot_travis are always denied. The mapping is computed once per
+    build, and again only when the properties change.
+    """
+    compare_attrs = ('allow', 'deny')
+    DEFAULT_DENY = (TRAVIS_CONFIG_PROPERTY, TREE_HASH_PROPERTY, REUSE_KEY_PROPERTY,
+                    PHASES_PROPERTY, ALLOW_FAILURE_PROPERTY, MAX_PARALLEL_JOBS_PROPERTY)
+
+    def __init__(self, allow=None, deny=None):
+        self.allow = allow
+        self.deny = self.DEFAULT_DENY + tuple(deny or ())
+        self.allow_re = compileGlobs(allow) if allow is not None else None
+        self.deny_re = compileGlobs(self.deny) if self.deny else None
+
+    def isExported(self, name):
+        if self.allow_re is not None and not self.allow_re.match(name):
+            return False
+        return self.deny_re is None or not self.deny_re.match(name)
+
+    def getEnvironment(self, build):
+        properties = build.getProperties().properties
+        cached = getattr(build, "travisEnvironment", None)
+        # property values are replaced, not modified, so comparing the
+        # (value, source) tuples is enough, and cheap
+        if cached is not None and cached[0] is self and cached[1] == properties:
+            return cached[2]
+        env = {}
+        for k, v in properties.items():
+            if self.isExported(k):
+                env[str(k)] = str(v[0])
+        build.travisEnvironment = (self, dict(properties), env)
+        return env
+
+
+class TestSummaryObserver(LogLineObserver):
+
+    """
+    Parse test results out of common test harnesses, line by line as the log
+    comes, so that only counters are kept whatever the size of the log.
+
+    Currently supported are:
+
+     * Plone
+     * Nose
+     * Trial
+     * Something mitchell wrote in Java
+    """
+    # Example::
+    #     Ran 24 tests with 0 failures and 0 errors in 0.009 seconds
+    plone_re = re.compile(r"Ran (\d+) tests with (\d+) failures and (\d+) errors")
+    ran_in_re = re.compile(r"Ran (\d+) tests in ")
+    ran_re = re.compile(r"Ran (\d+)")
+    error_separator = "=" * 70
+
+    def __init__(self):
+        LogLineObserver.__init__(self)
+        # Plone
+        self.plone = None
+        # Trial
+        self.trial = False
+        self.trialWithoutSuccesses = False
+        self.ranIn = 0
+        # Nose and Django
+        self.ran = None
+        self.fails = 0
+        self.errors = 0
+        self.afterSeparator = False
+
+    def outLineReceived(self, line):
+        # Plone has lines starting "Ran" and "Total". Total is missing if
+        # there is only a single layer, so we total ourselves, which also
+        # works if someone runs 2 batches of plone tests from a single target
+        for count, fail, error in self.plone_re.findall(line):
+            total, fails, errors = self.plone or (0, 0, 0)
+            self.plone = (total + int(count), fails + int(fail), errors + int(error))
+
+        # Trial
+        # Example::
+        #    FAILED (errors=5, successes=11)
+        #    PASSED (successes=16)
+        if line.startswith("FAILED (") or line.startswith("PASSED ("):
+            self.trial = True
+            stats = [stat.split("=") for stat in line[8:][:-1].split(", ")]
+            if "successes" not in [stat[0] for stat in stats]:
+                self.trialWithoutSuccesses = True
+        for count in self.ran_in_re.findall(line):
+            self.ranIn += int(count)
+
+        # Nose and Django
+        # Example::
+        #     Ran 424 tests in 152.927s
+        #     FAILED (failures=1)
+        #     FAILED (errors=3)
+        for count in self.ran_re.findall(line):
+            self.ran = (self.ran or 0) + int(count)
+        self.fails += line.count("FAIL:")
+        if self.afterSeparator and line.startswith("ERROR:"):
+            self.errors += 1
+        self.afterSeparator = line.endswith(self.error_separator)
+
+    errLineReceived = outLineReceived
+
+    def getStatistics(self):
+        """ returns the test statistics, or None if no test summary was found """
+        if self.plone is not None:
+            total, fails, errors = self.plone
+        elif self.trial:
+            # trial only gives its total when the successes are not counted
+            total = self.ranIn if self.trialWithoutSuccesses else 0
+            fails = errors = 0
+        elif self.ran is not None:
+            total, fails, errors = self.ran, self.fails, self.errors
+        else:
+            return None
+        skipped = warnings = 0
+        # We work out passed at the end because most test runners dont tell us
+        # and we can't distinguish between different test systems easily so we
+        # might double count.
+        passed = total - (skipped + fails + errors + warnings)
+        return dict(total=total, fails=fails, errors=errors, warnings=warnings,
+                    skipped=skipped, passed=passed)
+
+
+# runs each of its arguments in a new "$0" shell, and stops at the first failure
+BATCH_SCRIPT = textwrap.dedent("""\
+    n=0
+    for cmd in "$@"; do
+        n=$((n + 1))
+        printf '=== [%d/%d] %s\\n' "$n" "$#" "${cmd%%$'\\n'*}"
+        "$0" -c "$cmd"
+        rc=$?
+        if [ $rc -ne 0 ]; then
+            printf '=== [%d/%d] failed with exit code %d\\n' "$n" "$#" "$rc"
+            exit $rc
+        fi
+    done
+    """)
+
+
+def batchCommand(commands, shell="bash"):
+    """ the command running all of commands, as BATCH_SCRIPT """
+    return [shell, "-c", BATCH_SCRIPT, shell] + commands
+
+
+class BatchObserver(LogLineObserver):
+
+    """ Find which command of a batchCommand() failed """
+    failed_re = re.compile(r"^=== \[(\d+)/\d+\] failed with exit code \d+$")
+
+    def __init__(self):
+        LogLineObserver.__init__(self)
+        self.failed = None
+
+    def outLineReceived(self, line):
+        m = self.failed_re.match(line)
+        if m:
+            self.failed = int(m.group(1)) - 1
+
+
 class ShellCommand(shell.ShellCommand):
 
     flunkOnFailure = True
     haltOnFailure = True
     warnOnWarnings = True
 
+    def __init__(self, environment=None, batchTitles=None, **kwargs):
+        self.environment = environment or PropertiesEnvironment()
+        self.batchTitles = batchTitles
+        shell.ShellCommand.__init__(self, **kwargs)
+        self.testSummary = TestSummaryObserver()
+        self.addLogObserver('stdio', self.testSummary)
+        if batchTitles is not None:
+            # the command is a batchCommand()
+            self.batch = BatchObserver()
+            self.addLogObserver('stdio', self.batch)
+
     def setupEnvironment(self, cmd):
-        """ Turn all build properties into environment variables """
+        """ Turn the build properties into environment variables """
         shell.ShellCommand.setupEnvironment(self, cmd)
-        env = {}
-        for k, v in self.build.getProperties().properties.items():
-            env[str(k)] = str(v[0])
         if cmd.args['env'] is None:
             cmd.args['env'] = {}
-        cmd.args['env'].update(env)
+        cmd.args['env'].update(self.environment.getEnvironment(self.build))
 
     def createSummary(self, stdio):
         self.updateStats(stdio)
@@ -102,102 +411,24 @@ class ShellCommand(shell.ShellCommand):
 
     def updateStats(self, log):
         """
-        Parse test results out of common test harnesses.
-
-        Currently supported are:
-
-         * Plone
-         * Nose
-         * Trial
-         * Something mitchell wrote in Java
+        Update the step statistics with the test results parsed from the log,
+        as it was received, by TestSummaryObserver
         """
-        stdio = log.getText()
-
-        total = passed = skipped = fails = warnings = errors = 0
-        hastests = False
-
-        # Plone? That has lines starting "Ran" and "Total". Total is missing if there is only a single layer.
-        # For this reason, we total ourselves which lets us work even if someone runes 2 batches of plone tests
-        # from a single target
-
-        # Example::
-        #     Ran 24 tests with 0 failures and 0 errors in 0.009 seconds
-
-        if not hastests:
-            outputs = re.findall(
-                "Ran (?P<count>[\d]+) tests with (?P<fail>[\d]+) failures and (?P<error>[\d]+) errors",
-                stdio)
-            for output in outputs:
-                total += int(output[0])
-                fails += int(output[1])
-                errors += int(output[2])
-                hastests = True
-
-        # Twisted
-
-        # Example::
-        #    FAILED (errors=5, successes=11)
-        #    PASSED (successes=16)
-        if not hastests:
-            for line in stdio.split("\n"):
-                if line.startswith("FAILED (") or line.startswith("PASSED ("):
-                    hastests = True
-
-                    line = line[8:][:-1]
-                    stats = line.split(", ")
-                    data = {}
-
-                    for stat in stats:
-                        k, v = stat.split("=")
-                        data[k] = int(v)
-
-                    if "successes" not in data:
-                        total = 0
-                        for number in re.findall(
-                                "Ran (?P<count>[\d]+) tests in ", stdio):
-                            total += int(number)
-                        data["successes"] = total - sum(data.values())
-
-        # This matches Nose and Django output
-
-        # Example::
-        #     Ran 424 tests in 152.927s
-        #     FAILED (failures=1)
-        #     FAILED (errors=3)
-
-        if not hastests:
-            fails += len(re.findall('FAIL:', stdio))
-            errors += len(
-                re.findall(
-                    '======================================================================\nERROR:',
-                    stdio))
-            for number in re.findall("Ran (?P<count>[\d]+)", stdio):
-                total += int(number)
-                hastests = True
-
-        # We work out passed at the end because most test runners dont tell us
-        # and we can't distinguish between different test systems easily so we
-        # might double count.
-        passed = total - (skipped + fails + errors + warnings)
-
-        # Update the step statistics with out shiny new totals
-        if hastests:
-            self.setStatistic('total', total)
-            self.setStatistic('fails', fails)
-            self.setStatistic('errors', errors)
-            self.setStatistic('warnings', warnings)
-            self.setStatistic('skipped', skipped)
-            self.setStatistic('passed', passed)
+        stats = self.testSummary.getStatistics()
+        if stats is not None:
+            for k in ('total', 'fails', 'errors', 'warnings', 'skipped', 'passed'):
+                self.setStatistic(k, stats[k])
 
     def describe(self, done=False):
         description = shell.ShellCommand.describe(self, done)
+        details = []
 
         if done and self.hasStatistic('total'):
 
             def append(stat, fmtstring):
                 val = self.getStatistic(stat, 0)
                 if val:
-                    description.append(fmtstring % val)
+                    details.append(fmtstring % val)
 
             append("total", "%d tests")
             append("fails", "%d fails")
@@ -206,7 +437,14 @@ class ShellCommand(shell.ShellCommand):
             append("skipped", "%d skipped")
             append("passed", "%d passed")
 
-        return description
+        if done and self.batchTitles is not None and self.batch.failed is not None:
+            if self.batch.failed < len(self.batchTitles):
+                details.append(u"failed at: %s" % self.batchTitles[self.batch.failed])
+
+        if not details:
+            return description
+        # the old-style ShellCommand does not describe itself
+        return list(description or [self.name]) + details
 
 
 class TravisSetupSteps(ConfigurableStep):
@@ -216,22 +454,46 @@ class TravisSetupSteps(ConfigurableStep):
     flunkOnFailure = True
     MAX_NAME_LENGTH = 47
     disable = False
+    conditionEvaluator = None
+
+    def __init__(self, environment=None, virtualenvCache=None, cacheStore=None, **kwargs):
+        self.environment = environment
+        self.virtualenvCache = virtualenvCache
+        self.cacheStore = cacheStore
+        self.phase = None
+        self.phases = []
+        ConfigurableStep.__init__(self, **kwargs)
+
+    def addSteps(self, steps, phase=None):
+        """ add steps to the build, tagged with their phase (by default, the current hook) """
+        phase = phase or self.phase
+        for step in steps:
+            step.travisPhase = phase
+        self.phases.extend([phase] * len(steps))
+        self.build.addStepsAfterLastStep(steps)
 
     def addSetupVirtualEnv(self, python):
-        step = SetupVirtualEnv(python, doStepIf=not self.disable)
-        self.build.addStepsAfterLastStep([step])
+        step = SetupVirtualEnv(python, cache=self.virtualenvCache, doStepIf=not self.disable)
+        self.addSteps([step], phase="virtualenv")
+
+    def addCacheStep(self, stepClass, cache):
+        step = stepClass(self.cacheStore, cache['directories'], key=cache['key'],
+                         doStepIf=not self.disable)
+        self.addSteps([step], phase="cache")
 
     def addBBTravisStep(self, command):
         name = None
         condition = None
         shell = "bash"
         step = None
+        reports = {}
         original_command = command
         if isinstance(command, dict):
             name = command.get("title")
             shell = command.get("shell", shell)
             condition = command.get("condition")
             step = command.get("step")
+            reports = command.get("reports") or {}
             command = command.get("cmd")
 
         if isinstance(command, BuildStep):
@@ -258,14 +520,55 @@ class TravisSetupSteps(ConfigurableStep):
             if not isinstance(command, list):
                 command = [shell, '-c', command]
             step = ShellCommand(
-                name=name, description=command, command=command, doStepIf=not self.disable)
-        self.build.addStepsAfterLastStep([step])
+                name=name, description=command, command=command, doStepIf=not self.disable,
+                environment=self.environment)
+        self.addSteps([step] + self.getReportSteps(reports, original_command))
+
+    def getReportSteps(self, reports, original_command):
+        """ one ParseTestReports step per parser and glob of the command's reports """
+        if not isinstance(reports, dict):
+            self.addCompleteLog("bbtravis.yml error",
+                                "reports should be a mapping of parser to globs: %r" %
+                                (original_command, ))
+            return []
+        steps = []
+        for parser, patterns in sorted(reports.items()):
+            if parser not in REPORT_PARSERS:
+                self.addCompleteLog("bbtravis.yml error",
+                                    "Unknown test report parser %r, should be one of %s" %
+                                    (parser, ", ".join(sorted(REPORT_PARSERS))))
+                continue
+            if not isinstance(patterns, list):
+                patterns = [patterns]
+            for pattern in patterns:
+                steps.append(ParseTestReports(parser, pattern, doStepIf=not self.disable))
+        return steps
+
+    def addBatchedSteps(self, hook, commands):
+        """ Merge the consecutive plain shell commands in a single step """
+        batch = []
+        for command in commands + [None]:
+            if isinstance(command, string_types):
+                batch.append(command)
+                continue
+            if len(batch) == 1:
+                self.addBBTravisStep(command=batch[0])
+            elif batch:
+                name = u"%s (%d commands)" % (hook, len(batch))
+                step = ShellCommand(
+                    name=name, description=[name], command=batchCommand(batch),
+                    doStepIf=not self.disable, environment=self.environment,
+                    batchTitles=[self.truncateName(c) for c in batch])
+                self.addSteps([step])
+            batch = []
+            if command is not None:
+                self.addBBTravisStep(command=command)
 
     def testCondition(self, condition):
-        l = dict(
-            (k, v)
-            for k, (v, s) in self.build.getProperties().properties.items())
-        return eval(condition, l)
+        if self.conditionEvaluator is None:
+            self.conditionEvaluator = ConditionEvaluator(
+                (k, v) for k, (v, s) in self.build.getProperties().properties.items())
+        return self.conditionEvaluator(condition)
 
     def truncateName(self, name):
         name = name.lstrip("#")
@@ -278,10 +581,25 @@ class TravisSetupSteps(ConfigurableStep):
     @defer.inlineCallbacks
     def run(self):
         config = yield self.getStepConfig()
+        # the conditions see the properties as they are when the steps are added
+        self.conditionEvaluator = None
+        # the generated steps come after those still pending
+        first = self.number + 1 + len(self.build.steps)
+        self.phases = []
         if 'python' in config.language:
             self.addSetupVirtualEnv(self.getProperty("python"))
+        cache = config.cache if self.cacheStore is not None else None
         for k in TRAVIS_HOOKS:
-            for command in getattr(config, k):
-                self.addBBTravisStep(command=command)
-
+            self.phase = k
+            if k == "before_install" and cache:
+                self.addCacheStep(RestoreCache, cache)
+            if config.batch_steps:
+                self.addBatchedSteps(k, getattr(config, k))
+            else:
+                for command in getattr(config, k):
+                    self.addBBTravisStep(command=command)
+            if k == "script" and cache:
+                self.addCacheStep(SaveCache, cache)
+
+        self.setProperty(PHASES_PROPERTY, [first, compressPhases(self.phases)], self.name)
         defer.returnValue(SUCCESS)
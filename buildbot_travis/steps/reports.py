@@ -0,0 +1,340 @@
+# Copyright 2012-2013 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import traceback
+from xml.etree import ElementTree
+
+from twisted.internet import defer
+from twisted.python import log
+
+import buildbot
+from buildbot import config
+from buildbot.process import buildstep
+from buildbot.process.results import SUCCESS, WARNINGS
+from buildbot.steps.worker import CompositeStepMixin
+from buildbot.util import unicode2bytes
+from buildbot.worker.protocols.base import FileWriterImpl
+
+PASSED, FAILED, ERROR, SKIPPED = "passed", "failed", "error", "skipped"
+OUTCOMES = (PASSED, FAILED, ERROR, SKIPPED)
+
+
+class ReportParser(object):
+
+    """
+    Base class of the test report parsers.
+
+    The report is fed by chunks, as it is uploaded from the worker, and the
+    parsed results are accumulated in self.results until the caller takes
+    them, so that whole reports are never held in memory.
+    """
+
+    def __init__(self):
+        self.results = []
+
+    def addResult(self, name, outcome, codePath=None, line=None):
+        self.results.append((name, codePath, line, outcome))
+
+    def popResults(self):
+        results, self.results = self.results, []
+        return results
+
+    def feed(self, data):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class JUnitParser(ReportParser):
+
+    """ JUnit XML, as written by most test runners (pytest --junitxml,
+    nose --with-xunit, maven surefire, ...)
+
+    The XML parser calls us back element by element, so no tree is built.
+    """
+
+    def __init__(self):
+        ReportParser.__init__(self)
+        self.parser = ElementTree.XMLParser(target=self)
+        self.testcase = None
+
+    def feed(self, data):
+        self.parser.feed(data)
+
+    def close(self):
+        # XMLParser.close() calls back our close(), as we are its target
+        parser, self.parser = self.parser, None
+        if parser is not None:
+            parser.close()
+
+    # XMLParser target interface
+    def start(self, tag, attrib):
+        if tag == "testcase":
+            self.testcase = dict(attrib, outcome=PASSED)
+        elif self.testcase is not None:
+            if tag in ("failure", "error"):
+                # an error wins over a failure of the same test
+                if self.testcase['outcome'] != ERROR:
+                    self.testcase['outcome'] = FAILED if tag == "failure" else ERROR
+            elif tag == "skipped" and self.testcase['outcome'] == PASSED:
+                self.testcase['outcome'] = SKIPPED
+
+    def end(self, tag):
+        if tag == "testcase" and self.testcase is not None:
+            testcase, self.testcase = self.testcase, None
+            name = testcase.get("name", "")
+            if testcase.get("classname"):
+                name = testcase["classname"] + "." + name
+            line = testcase.get("line")
+            self.addResult(name, testcase['outcome'], codePath=testcase.get("file"),
+                           line=int(line) if line and line.isdigit() else None)
+
+    def data(self, data):
+        pass
+
+
+class JsonLinesParser(ReportParser):
+
+    """ Base class for the reports made of a json document per line """
+
+    def __init__(self):
+        ReportParser.__init__(self)
+        self.pending = b""
+
+    def feed(self, data):
+        lines = (self.pending + data).split(b"\n")
+        self.pending = lines.pop()
+        for line in lines:
+            self.parseLine(line)
+
+    def close(self):
+        pending, self.pending = self.pending, b""
+        self.parseLine(pending)
+
+    def parseLine(self, line):
+        line = line.strip()
+        if line:
+            self.lineReceived(json.loads(line.decode("utf-8")))
+
+    def lineReceived(self, entry):
+        raise NotImplementedError
+
+
+class PytestReportLogParser(JsonLinesParser):
+
+    """ pytest-reportlog files (pytest --report-log) """
+
+    def lineReceived(self, entry):
+        if not isinstance(entry, dict) or entry.get("$report_type") != "TestReport":
+            return
+        when, outcome = entry.get("when"), entry.get("outcome")
+        if when == "call":
+            outcome = {"passed": PASSED, "failed": FAILED}.get(outcome, SKIPPED)
+        elif outcome == "failed":
+            # like pytest, a failing fixture is an error
+            outcome = ERROR
+        elif when == "setup" and outcome == "skipped":
+            outcome = SKIPPED
+        else:
+            return
+        codePath, line = None, None
+        location = entry.get("location")
+        if isinstance(location, list) and len(location) == 3:
+            codePath, line = location[0], location[1]
+        self.addResult(entry.get("nodeid", ""), outcome, codePath=codePath, line=line)
+
+
+class GoTestParser(JsonLinesParser):
+
+    """ go test -json output """
+    actions = {"pass": PASSED, "fail": FAILED, "skip": SKIPPED}
+
+    def lineReceived(self, entry):
+        if not isinstance(entry, dict) or not entry.get("Test"):
+            # the package level events only summarize the tests
+            return
+        outcome = self.actions.get(entry.get("Action"))
+        if outcome is not None:
+            self.addResult(entry["Test"], outcome, codePath=entry.get("Package"))
+
+
+REPORT_PARSERS = {}
+
+
+def registerReportParser(name, parser):
+    """ make a ReportParser class available as a `reports:` key of the commands """
+    REPORT_PARSERS[name] = parser
+
+
+registerReportParser("junit", JUnitParser)
+registerReportParser("pytest", PytestReportLogParser)
+registerReportParser("gotest", GoTestParser)
+
+
+class ReportWriter(FileWriterImpl):
+
+    """
+    Feeds the report uploaded from the worker to a parser, as it comes.
+
+    The worker waits for each write to be acknowledged before sending the next
+    block, so returning the flush Deferred throttles the upload to the database.
+    """
+
+    def __init__(self, parser, flush, batchSize):
+        self.parser = parser
+        self.flush = flush
+        self.batchSize = batchSize
+        self.error = None
+
+    def remote_write(self, data):
+        if self.error is not None:
+            return None
+        try:
+            self.parser.feed(unicode2bytes(data))
+        except Exception:
+            self.error = traceback.format_exc()
+            return None
+        if len(self.parser.results) >= self.batchSize:
+            return self.flush(self.parser.popResults())
+        return None
+
+    def remote_utime(self, accessed_modified):
+        pass
+
+    def remote_close(self):
+        if self.error is None:
+            try:
+                self.parser.close()
+            except Exception:
+                self.error = traceback.format_exc()
+
+
+class ParseTestReports(buildstep.BuildStep, CompositeStepMixin):
+
+    """
+    Parse the test report files written on the worker by a command, and store
+    the per test results as a test result set of the build.
+
+    Only the test names and outcomes end up in the database: the names are
+    stored once, and each build adds one row per test.
+    """
+    name = "test reports"
+    alwaysRun = True
+    flunkOnFailure = False
+    warnOnWarnings = True
+    batchSize = 500
+    blockSize = 32 * 1024
+    logEnviron = False
+
+    def __init__(self, parser, pattern, **kwargs):
+        self.parser = parser
+        self.pattern = pattern
+        kwargs.setdefault("name", u"{} reports".format(parser))
+        buildstep.BuildStep.__init__(self, **kwargs)
+        if parser not in REPORT_PARSERS:
+            config.error("unknown test report parser {!r}".format(parser))
+
+    @defer.inlineCallbacks
+    def run(self):
+        if not hasattr(self.master.data.updates, "addTestResultSet"):
+            # the test results are stored by buildbot 2.9+ only
+            log.msg("buildbot {} can't store the test results, skipping {}".format(
+                buildbot.version, self.name))
+            self.descriptionDone = u"test reports need buildbot 2.9"
+            defer.returnValue(buildstep.SKIPPED)
+        self.builderid = yield self.build.getBuilderId()
+        self.counts = dict((outcome, 0) for outcome in OUTCOMES)
+        self.setid = None
+        errors = []
+
+        files = yield self.runGlob(self.build.path_module.join(self.workdir, self.pattern))
+        for filename in sorted(files):
+            writer = ReportWriter(REPORT_PARSERS[self.parser](), self.flushResults,
+                                  self.batchSize)
+            ok = yield self.uploadReport(filename, writer)
+            if not ok:
+                errors.append("{}: could not be uploaded".format(filename))
+                continue
+            yield self.flushResults(writer.parser.popResults())
+            if writer.error is not None:
+                errors.append("{}:\n{}".format(filename, writer.error))
+        if self.setid is not None:
+            yield self.master.data.updates.completeTestResultSet(
+                self.setid, tests_passed=self.counts[PASSED],
+                tests_failed=self.counts[FAILED] + self.counts[ERROR])
+
+        if errors:
+            self.addCompleteLog("errors", "\n".join(errors))
+        self.updateStats()
+        if not files:
+            self.descriptionDone = u"no {} report matching {}".format(self.parser, self.pattern)
+            defer.returnValue(WARNINGS)
+        defer.returnValue(WARNINGS if errors else SUCCESS)
+
+    def uploadReport(self, filename, writer):
+        self.checkWorkerHasCommand("uploadFile")
+        args = {
+            'workdir': self.workdir,
+            'writer': writer,
+            'maxsize': None,
+            'blocksize': self.blockSize,
+        }
+        if self.workerVersionIsOlderThan('uploadFile', '3.0'):
+            args['slavesrc'] = filename
+        else:
+            args['workersrc'] = filename
+        return self.runRemoteCommand('uploadFile', args,
+                                     evaluateCommand=lambda cmd: not cmd.didFail())
+
+    @defer.inlineCallbacks
+    def flushResults(self, results):
+        if not results:
+            return
+        if self.setid is None:
+            self.setid = yield self.master.data.updates.addTestResultSet(
+                self.builderid, self.build.buildid, self.stepid,
+                description=u"{} {}".format(self.parser, self.pattern),
+                category=u"pass_fail", value_unit=u"outcome")
+        values = []
+        for name, codePath, line, outcome in results:
+            self.counts[outcome] += 1
+            value = dict(test_name=name, value=outcome)
+            if codePath:
+                value['test_code_path'] = codePath
+            if line is not None:
+                value['line'] = line
+            values.append(value)
+        yield self.master.data.updates.addTestResults(self.builderid, self.setid, values)
+
+    def updateStats(self):
+        counts = self.counts
+        total = sum(counts.values())
+        if not total:
+            return
+        self.setStatistic('total', total)
+        self.setStatistic('fails', counts[FAILED])
+        self.setStatistic('errors', counts[ERROR])
+        self.setStatistic('skipped', counts[SKIPPED])
+        self.setStatistic('passed', counts[PASSED])
+        description = [u"{} tests".format(total)]
+        for outcome in (FAILED, ERROR, SKIPPED):
+            if counts[outcome]:
+                description.append(u"{} {}".format(counts[outcome], outcome))
+        self.descriptionDone = u" ".join(description)
@@ -15,21 +15,43 @@
 from __future__ import absolute_import, division, print_function
 
 from twisted.internet import defer
+from twisted.python import log
 
 from buildbot.process.properties import Properties
+from buildbot.process.results import EXCEPTION, FAILURE
+from buildbot.reporters.utils import getURLForBuild
+from buildbot.schedulers.forcesched import ForceScheduler
 from buildbot.steps.trigger import Trigger
 
-from .base import ConfigurableStepMixin
+from ..reuse import (REUSE_KEY_PROPERTY, TREE_HASH_PROPERTY, cellReuseKey, getReusableResults,
+                     hooksSignature)
+from ..throttle import MAX_PARALLEL_JOBS_PROPERTY
+from .base import (ALLOW_FAILURE_PROPERTY, TRAVIS_CONFIG_PROPERTY, ConfigurableStepMixin,
+                   packConfig)
 
 
 class TravisTrigger(Trigger, ConfigurableStepMixin):
-    def __init__(self, scheduler, **kwargs):
+    # the reason of the buildsets of the rebuild button
+    REBUILD_REASON = "rebuild"
+    # number of matrix cells whose buildsets are created together
+    MATRIX_CHUNK = 50
+
+    def __init__(self, scheduler, waitForFinish=True, fastFinish=False, reuseResults=False,
+                 **kwargs):
         if "name" not in kwargs:
             kwargs['name'] = 'trigger'
         self.config = None
+        self.fastFinish = fastFinish
+        self.reuseResults = reuseResults
+        self.reused = []
+        self.unaffected = 0
+        # whether the matrix buildsets are still being created
+        self.spawning = False
+        # whether a fast_finish job failed
+        self.fastFinished = False
         Trigger.__init__(
             self,
-            waitForFinish=True,
+            waitForFinish=waitForFinish,
             schedulerNames=[scheduler],
             haltOnFailure=True,
             flunkOnFailure=True,
@@ -41,23 +63,229 @@ class TravisTrigger(Trigger, ConfigurableStepMixin):
     @defer.inlineCallbacks
     def run(self):
         self.config = yield self.getStepConfig()
+        self.matrixProperties = []
+        self.reused = []
+        self.unaffected = 0
+        # brid -> whether the cell is allowed to fail, for the jobs not complete yet
+        self.watchedBrids = {}
+        self.cancelledBrids = set()
+        self.fastFinishConsumers = []
+        self.fastFinished = False
 
-        rv = yield Trigger.run(self)
+        try:
+            rv = yield Trigger.run(self)
+        finally:
+            # buildsets created for the matrix but never triggered
+            for sch in self.schedulerNames:
+                sch = self.getSchedulerByName(sch)
+                if hasattr(sch, "forgetMatrix"):
+                    sch.forgetMatrix(self.matrixProperties)
+            self.spawning = False
+            # otherwise, keep watching the jobs after a fire and track spawner is done
+            if not self.watchedBrids:
+                self.stopFastFinish()
         defer.returnValue(rv)
 
+    def isFastFinish(self):
+        if self.config.fast_finish is not None:
+            return self.config.fast_finish
+        return self.fastFinish
+
+    @defer.inlineCallbacks
+    def startFastFinish(self):
+        # the build finished event comes before its request is completed, and
+        # thus before the builder can start the next request
+        consumer = yield self.master.mq.startConsuming(
+            self.buildFinished, ('builds', None, 'finished'))
+        self.fastFinishConsumers.append(consumer)
+        consumer = yield self.master.mq.startConsuming(
+            self.buildRequestComplete, ('buildrequests', None, 'complete'))
+        self.fastFinishConsumers.append(consumer)
+
+    def stopFastFinish(self):
+        for consumer in self.fastFinishConsumers:
+            consumer.stopConsuming()
+        self.fastFinishConsumers = []
+
+    def buildFinished(self, key, build):
+        brid = build['buildrequestid']
+        if self.watchedBrids.get(brid) is not False:
+            return
+        if build['results'] in (FAILURE, EXCEPTION):
+            del self.watchedBrids[brid]
+            self.fastFinished = True
+            # cancel the pending requests, and stop the running builds
+            for brid in self.watchedBrids:
+                self.cancelBuildRequest(brid)
+            self.watchedBrids = {}
+            self.stopFastFinish()
+
+    def buildRequestComplete(self, key, buildrequest):
+        self.watchedBrids.pop(buildrequest['buildrequestid'], None)
+        # the next matrix chunks are still to be watched
+        if not self.watchedBrids and not self.spawning:
+            self.stopFastFinish()
+
+    def cancelBuildRequest(self, brid):
+        self.cancelledBrids.add(brid)
+        d = self.master.data.control(
+            "cancel", {'reason': 'fast_finish: another matrix job failed'},
+            ("buildrequests", brid))
+        d.addErrback(log.err, "while cancelling build request {}".format(brid))
+
+    def worstStatus(self, overall_results, rclist, unimportant_brids):
+        # the jobs cancelled by fast_finish should not hide the failure
+        return Trigger.worstStatus(self, overall_results, rclist,
+                                   list(unimportant_brids) + list(self.cancelledBrids))
+
+    def getCurrentSummary(self):
+        summary = Trigger.getCurrentSummary(self)
+        extra = []
+        if self.reused:
+            extra.append(u"{} reused".format(len(self.reused)))
+        if self.unaffected:
+            extra.append(u"{} not affected".format(self.unaffected))
+        if extra:
+            if self.triggeredNames:
+                extra.insert(0, summary['step'])
+            summary = {'step': u", ".join(extra)}
+        return summary
+
+    def getResultSummary(self):
+        if (self.reused or self.unaffected) and not self.ended:
+            return self.getCurrentSummary()
+        return Trigger.getResultSummary(self)
+
     def createTriggerProperties(self, props):
         return props
 
+    def getTreeHashes(self):
+        """ returns the {codebase: tree hash} of the build, or None if some
+        codebases have no known tree
+        """
+        trees = self.getProperty(TREE_HASH_PROPERTY) or {}
+        if not isinstance(trees, dict):
+            trees = {'': trees}
+        hashes = {}
+        for ss in self.build.getAllSourceStamps():
+            if ss.patch is not None or ss.codebase not in trees:
+                return None
+            hashes[ss.codebase] = trees[ss.codebase]
+        return hashes or None
+
+    def getAffectedPredicate(self):
+        """ returns whether a cell is affected by the changes of the build, or
+        None if all the cells are
+        """
+        if not self.config.paths:
+            return None
+        files = [f for f in self.build.allFiles() if f]
+        # e.g. force builds, or branch creations
+        if not files:
+            return None
+        return self.config.paths.predicate(files)
+
+    def isForced(self):
+        """ whether the build was forced or rebuilt, in which case every job
+        is run again
+        """
+        if getattr(self.build, "reason", None) == self.REBUILD_REASON:
+            return True
+        try:
+            scheduler = self.master.scheduler_manager.getServiceNamed(
+                self.getProperty("scheduler"))
+        except KeyError:
+            return False
+        return isinstance(scheduler, ForceScheduler)
+
+    @defer.inlineCallbacks
+    def dropReusedCells(self, triggered_schedulers, keys):
+        """ drop the cells which already have a green build for the same tree """
+        try:
+            reusable = yield getReusableResults(
+                self.master, keys, pullRequest=bool(self.getProperty("TRAVIS_PULL_REQUEST")))
+        except Exception:
+            log.err(None, "while looking up the reusable matrix results")
+            defer.returnValue(triggered_schedulers)
+        remaining = []
+        for entry, key in zip(triggered_schedulers, keys):
+            build = reusable.get(key)
+            if build is None:
+                remaining.append(entry)
+                continue
+            self.reused.append(build)
+            url = getURLForBuild(self.master, build['builderid'], build['number'])
+            yield self.addURL(u"reused: {} #{}".format(
+                entry['props_to_set'].getProperty("virtual_builder_name"), build['number']), url)
+        defer.returnValue(remaining)
+
+    @defer.inlineCallbacks
+    def triggerCells(self, scheduler, entries, keys):
+        """ drop the reused cells of entries, and create the buildsets of the
+        others, for Trigger.run to pick them up
+        """
+        if keys:
+            entries = yield self.dropReusedCells(entries, keys)
+        if not entries or not hasattr(scheduler, "addMatrixBuildsets"):
+            defer.returnValue(entries)
+        propertiesList = [entry['props_to_set'] for entry in entries]
+        self.matrixProperties.extend(propertiesList)
+        ids = yield scheduler.addMatrixBuildsets(
+            waited_for=self.waitForFinish,
+            sourcestamps=self.prepareSourcestampListForTrigger(),
+            propertiesList=propertiesList,
+            parent_buildid=self.build.buildid,
+            parent_relationship=self.parent_relationship)
+        for (bsid, brids), entry in zip(ids, entries):
+            for brid in brids.values():
+                if self.fastFinished:
+                    # a job of the previous chunks already failed
+                    self.cancelBuildRequest(brid)
+                elif self.fastFinishConsumers:
+                    self.watchedBrids[brid] = entry['unimportant']
+        defer.returnValue(entries)
+
+    @defer.inlineCallbacks
     def getSchedulersAndProperties(self):
         sch = self.schedulerNames[0]
         reason_excluded_env = self.config.global_env.keys()
+        # ship the config to the jobs, so that they don't need to fetch and parse it again
+        shipped_config = packConfig(self.configFilename, self.configContent,
+                                    self.getGotRevisions())
+
+        treeHashes = self.getTreeHashes() if self.reuseResults else None
+        if treeHashes is not None:
+            hooks = hooksSignature(self.configContent)
+            # the forced builds are still recorded for the next ones
+            reuse = not self.isForced()
+
+        affected = self.getAffectedPredicate()
 
+        scheduler = self.getSchedulerByName(sch)
+        if hasattr(scheduler, "addMatrixBuildsets") and self.isFastFinish():
+            yield self.startFastFinish()
+
+        tags = [tag for tag in self.build.builder.config.tags if tag not in ("trunk", "try")]
+        # the buildsets are created chunk by chunk while the matrix is
+        # generated, Trigger.run then picks them up
         triggered_schedulers = []
+        chunk, keys = [], []
+        self.spawning = True
         for env in self.config.matrix:
+            if affected is not None and not affected(env):
+                self.unaffected += 1
+                continue
             props_to_set = Properties()
             props_to_set.setProperty("TRAVIS_PULL_REQUEST",
                                      self.getProperty("TRAVIS_PULL_REQUEST"),
                                      "inherit")
+            props_to_set.setProperty(TRAVIS_CONFIG_PROPERTY, shipped_config, "spawner")
+            allowFailure = self.config.allows_failure(env)
+            if allowFailure:
+                props_to_set.setProperty(ALLOW_FAILURE_PROPERTY, True, "spawner")
+            if self.config.max_parallel_jobs is not None:
+                props_to_set.setProperty(MAX_PARALLEL_JOBS_PROPERTY, self.config.max_parallel_jobs,
+                                         "spawner")
             flat_env = {}
             for k, v in env.items():
                 if k == "env":
@@ -66,10 +294,6 @@ class TravisTrigger(Trigger, ConfigurableStepMixin):
                 else:
                     props_to_set.setProperty(k, v, ".travis.yml")
                     flat_env[k] = v
-            tags = self.build.builder.config.tags
-            for tag in ["trunk", "try"]:
-                if tag in tags:
-                    tags.remove(tag)
             label_tags = sorted(
                 str(self.config.label_mapping.get(k, k)) + ':' +
                 str(self.config.label_mapping.get(v, v))
@@ -80,6 +304,26 @@ class TravisTrigger(Trigger, ConfigurableStepMixin):
                                      "spawner")
             props_to_set.setProperty("matrix_label", u"/".join(label_tags),
                                      "spawner")
+            if treeHashes is not None:
+                key = cellReuseKey(sch, treeHashes, env, hooks)
+                props_to_set.setProperty(REUSE_KEY_PROPERTY, key, "spawner")
+                if reuse:
+                    keys.append(key)
+
+            # the result of the jobs allowed to fail is ignored
+            chunk.append({
+                'sched_name': sch,
+                'props_to_set': props_to_set,
+                'unimportant': allowFailure})
+            if len(chunk) >= self.MATRIX_CHUNK:
+                entries = yield self.triggerCells(scheduler, chunk, keys)
+                triggered_schedulers.extend(entries)
+                chunk, keys = [], []
 
-            triggered_schedulers.append((sch, props_to_set))
-        return triggered_schedulers
+        if chunk:
+            entries = yield self.triggerCells(scheduler, chunk, keys)
+            triggered_schedulers.extend(entries)
+        self.spawning = False
+        if not self.watchedBrids:
+            self.stopFastFinish()
+        defer.returnValue(triggered_schedulers)
@@ -0,0 +1,194 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from buildbot.process.properties import Properties
+from buildbot.process.results import SKIPPED, SUCCESS
+from buildbot_travis.steps import cache, create_steps
+from buildbot_travis.travisyml import TravisYml
+
+
+class CacheStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.store = cache.CacheStore(os.path.abspath(self.mktemp()), max_size=1)
+        self.scope = cache.cacheScope("project-job", "python:3.6", ["~/.cache/pip"])
+
+    def addEntry(self, scope, digest, size, mtime):
+        path = self.store.entryPath(scope, digest)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_scope(self):
+        self.assertEqual(self.scope, cache.cacheScope("project-job", "python:3.6",
+                                                      ["~/.cache/pip"]))
+        self.assertNotEqual(self.scope, cache.cacheScope("project-job", "python:2.7",
+                                                         ["~/.cache/pip"]))
+        self.assertNotEqual(self.scope, cache.cacheScope("other-job", "python:3.6",
+                                                         ["~/.cache/pip"]))
+
+    def test_member_path(self):
+        self.assertEqual(cache.memberPath("~/.cache/pip"), "home/.cache/pip")
+        self.assertEqual(cache.memberPath("node_modules"), "build/node_modules")
+        self.assertEqual(cache.memberPath("a b/$(rm -rf /)"), "build/'a b/$(rm -rf /)'")
+
+    def test_lookup(self):
+        self.assertEqual(self.store.lookup(self.scope, "a" * 64), None)
+        old = self.addEntry(self.scope, "a" * 64, 10, 1000)
+        recent = self.addEntry(self.scope, "b" * 64, 10, 2000)
+        self.addEntry("other", "c" * 64, 10, 3000)
+        # an upload in progress
+        with open(os.path.join(os.path.dirname(old), "tmpabcd"), "wb") as f:
+            f.write(b"x")
+
+        self.assertEqual(self.store.lookup(self.scope, "a" * 64), old)
+        # the entry is now the most recently used one
+        self.assertTrue(os.stat(old).st_mtime > 2000)
+        self.assertEqual(self.store.lookup(self.scope, "d" * 64), old)
+        os.utime(old, (1000, 1000))
+        self.assertEqual(self.store.lookup(self.scope), recent)
+
+    def test_evict(self):
+        mb = 1024 * 1024
+        old = self.addEntry(self.scope, "a" * 64, mb // 2, 1000)
+        recent = self.addEntry("other", "b" * 64, mb // 2, 2000)
+        self.store.evict()
+        self.assertTrue(os.path.exists(old))
+
+        new = self.addEntry(self.scope, "c" * 64, mb // 4, 3000)
+        self.store.evict(keep=new)
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(recent))
+
+        # the tarball just saved is kept, even if it is too big
+        big = self.addEntry(self.scope, "d" * 64, 2 * mb, 500)
+        self.store.evict(keep=big)
+        self.assertEqual([path for mtime, size, path in self.store.listEntries()], [big])
+
+
+class FakeSetupBuild(object):
+
+    def __init__(self):
+        self.steps = []
+        self.properties = Properties()
+
+    def addStepsAfterLastStep(self, steps):
+        self.steps.extend(steps)
+
+    def getProperties(self):
+        return self.properties
+
+
+class FakeShellCommand(object):
+
+    def didFail(self):
+        return False
+
+
+class RestoreCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.store = cache.CacheStore(os.path.abspath(self.mktemp()))
+        self.step = step = cache.RestoreCache(self.store, ["~/.ccache"])
+        step.build = FakeSetupBuild()
+        step.build.properties.setProperty("buildername", "project-job", "test")
+        step.build.properties.setProperty("matrix_label", "", "test")
+        step.checkWorkerHasCommand = lambda command: None
+        step.transferArgs = lambda command, direction: {}
+        self.downloads = []
+        step.runRemoteCommand = self.runRemoteCommand
+        step.runShell = lambda script: defer.succeed(FakeShellCommand())
+
+    def runRemoteCommand(self, command, args, **kwargs):
+        self.downloads.append(command)
+        return defer.succeed(True)
+
+    def addEntry(self, digest):
+        path = self.store.entryPath(self.step.getScope(), digest)
+        os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as f:
+            f.write(b"x")
+        return path
+
+    @defer.inlineCallbacks
+    def test_hit_without_key(self):
+        self.addEntry("a" * 64)
+        results = yield self.step.run()
+        self.assertEqual(results, SUCCESS)
+        self.assertEqual(self.step.descriptionDone, u"restored previous cache")
+        self.assertEqual(self.downloads, ["downloadFile"])
+
+    @defer.inlineCallbacks
+    def test_evicted(self):
+        path = self.addEntry("a" * 64)
+        os.remove(path)
+        self.store.lookup = lambda scope, digest: path
+        results = yield self.step.run()
+        self.assertEqual(results, SUCCESS)
+        self.assertEqual(self.step.descriptionDone, u"cache miss")
+        self.assertEqual(self.downloads, [])
+
+
+class SaveCacheTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def test_pull_request(self):
+        step = cache.SaveCache(cache.CacheStore("/var/cache"), ["~/.ccache"])
+        step.build = FakeSetupBuild()
+        step.build.properties.setProperty("TRAVIS_PULL_REQUEST", 12, "test")
+        results = yield step.run()
+        self.assertEqual(results, SKIPPED)
+        self.assertEqual(step.descriptionDone, u"cache not saved for pull requests")
+
+
+class CacheStepsTestCase(unittest.TestCase):
+
+    def makeSteps(self, travis_yml, cacheStore):
+        config = TravisYml()
+        config.parse_dict(travis_yml)
+        self.step = step = create_steps.TravisSetupSteps(cacheStore=cacheStore)
+        step.build = FakeSetupBuild()
+        step.number = 2
+        step.getStepConfig = lambda: defer.succeed(config)
+        d = step.run()
+        d.addCallback(lambda _: step.build.steps)
+        return d
+
+    @defer.inlineCallbacks
+    def test_cache(self):
+        store = cache.CacheStore("/var/cache")
+        steps = yield self.makeSteps(dict(
+            language="c", cache=dict(directories=["~/.ccache"], key="configure.ac"),
+            before_install=["apt-get update"], install=["./configure"], script=["make"],
+            after_script=["make clean"]), store)
+        self.assertEqual([s.name for s in steps], [
+            "restore cache", "apt-get update", "./configure", "make", "save cache",
+            "make clean"])
+        self.assertEqual(steps[0].store, store)
+        self.assertEqual(steps[0].directories, ["~/.ccache"])
+        self.assertEqual(steps[4].key, ["configure.ac"])
+        self.assertEqual([s.travisPhase for s in steps], [
+            "cache", "before_install", "install", "script", "cache", "after_script"])
+        self.assertEqual(self.step.build.properties.getProperty("travis_phases"), [3, [
+            ["cache", 1], ["before_install", 1], ["install", 1], ["script", 1], ["cache", 1],
+            ["after_script", 1]]])
+
+    @defer.inlineCallbacks
+    def test_no_store(self):
+        steps = yield self.makeSteps(dict(language="c", cache="ccache", script=["make"]), None)
+        self.assertEqual([s.name for s in steps], ["make"])
+
+    @defer.inlineCallbacks
+    def test_no_cache(self):
+        steps = yield self.makeSteps(dict(language="c", script=["make"]),
+                                     cache.CacheStore("/var/cache"))
+        self.assertEqual([s.name for s in steps], ["make"])
@@ -0,0 +1,55 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from twisted.trial import unittest
+
+from buildbot.process.properties import Properties
+from buildbot_travis import conditions
+from buildbot_travis.steps import create_steps
+
+
+class ConditionEvaluatorTestCase(unittest.TestCase):
+
+    def test_evaluate(self):
+        variables = dict(python="3.6", TRAVIS_PULL_REQUEST=False)
+        testCondition = conditions.ConditionEvaluator(variables)
+        self.assertTrue(testCondition("python == '3.6'"))
+        self.assertFalse(testCondition("TRAVIS_PULL_REQUEST"))
+        self.assertTrue(testCondition("any(python.startswith(v) for v in ['2', '3'])"))
+        self.assertTrue(testCondition("len(python) == 3"))
+        # the variables are left alone
+        self.assertEqual(variables, dict(python="3.6", TRAVIS_PULL_REQUEST=False))
+
+    def test_errors(self):
+        testCondition = conditions.ConditionEvaluator({})
+        self.assertRaises(NameError, testCondition, "python == '3.6'")
+        self.assertRaises(SyntaxError, testCondition, "python ==")
+
+    def test_compiled_once(self):
+        code = conditions.compileCondition("python == '2.7'")
+        self.assertIs(conditions.compileCondition("python == '2.7'"), code)
+
+
+class FakeBuild(object):
+
+    def __init__(self, **properties):
+        self.properties = Properties(**properties)
+        self.steps = []
+
+    def getProperties(self):
+        return self.properties
+
+    def addStepsAfterLastStep(self, steps):
+        self.steps.extend(steps)
+
+
+class TravisSetupStepsConditionTestCase(unittest.TestCase):
+
+    def test_condition(self):
+        step = create_steps.TravisSetupSteps()
+        step.build = FakeBuild(python="2.7", TRAVIS_PULL_REQUEST=3)
+        step.addBBTravisStep(dict(cmd="make py2", condition="python == '2.7'"))
+        step.addBBTravisStep(dict(cmd="make py3", condition="python.startswith('3')"))
+        step.addBBTravisStep(dict(cmd="make pr", condition="TRAVIS_PULL_REQUEST"))
+        self.assertEqual([s.name for s in step.build.steps], ["make py2", "make pr"])
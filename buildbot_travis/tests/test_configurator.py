@@ -9,6 +9,7 @@ from twisted.trial import unittest
 from buildbot.plugins import util, worker
 from buildbot.test.util import config
 from buildbot_travis.configurator import TravisConfigurator
+from buildbot_travis.throttle import prioritizeBuilders
 
 
 class TravisConfiguratorTestCase(unittest.TestCase, config.ConfigErrorsMixin):
@@ -235,3 +236,66 @@ class TravisConfiguratorTestCase(unittest.TestCase, config.ConfigErrorsMixin):
         self.assertEqual(
             self.c.config['workers'][0].getConfigDict()['kwargs']['volumes'],
             ['/foo:/foo', '/bar:/bar'])
+
+    def test_virtualenv_cache(self):
+        self.c.cfgdict = {
+            'virtualenv_cache': {
+                'path': '/var/cache/virtualenvs',
+                'max_size': 512,
+            }
+        }
+        self.c.createVirtualEnvCacheConfig()
+        self.assertEqual(self.c.virtualenvCache.path, '/var/cache/virtualenvs')
+        self.assertEqual(self.c.virtualenvCache.max_size, 512)
+        self.assertEqual(self.c.virtualenvCache.requirements, ['requirements*.txt'])
+
+    def test_virtualenv_cache_default(self):
+        self.c.cfgdict = {'virtualenv_cache': True}
+        self.c.createVirtualEnvCacheConfig()
+        self.assertEqual(self.c.virtualenvCache.path, '~/.cache/buildbot_travis/virtualenvs')
+
+    def test_virtualenv_cache_no_cache(self):
+        self.c.cfgdict = {}
+        self.c.createVirtualEnvCacheConfig()
+        self.assertEqual(self.c.virtualenvCache, None)
+
+    def test_virtualenv_cache_bad_size(self):
+        self.c.cfgdict = {'virtualenv_cache': {'max_size': '1G'}}
+        self.assertRaisesConfigError("virtualenv_cache max_size should be a positive number of MB",
+                                     self.c.createVirtualEnvCacheConfig)
+
+    def test_fair_share(self):
+        self.c.cfgdict = {}
+        self.c.createFairShareConfig()
+        self.assertNotIn('prioritizeBuilders', self.c.config)
+        self.c.cfgdict = {'fair_share': True}
+        self.c.createFairShareConfig()
+        self.assertEqual(self.c.config['prioritizeBuilders'], prioritizeBuilders)
+
+    def test_fair_share_not_bool(self):
+        self.c.cfgdict = {'fair_share': 'yes'}
+        self.assertRaisesConfigError("fair_share should be true or false",
+                                     self.c.createFairShareConfig)
+
+    def test_cache_store(self):
+        self.c.vardir = "/var/lib/buildbot"
+        self.c.cfgdict = {'cache_store': {'path': 'caches', 'max_size': 512}}
+        self.c.createCacheStoreConfig()
+        self.assertEqual(self.c.cacheStore.path, '/var/lib/buildbot/caches')
+        self.assertEqual(self.c.cacheStore.max_size, 512)
+
+        self.c.cfgdict = {'cache_store': {'path': '/srv/caches'}}
+        self.c.createCacheStoreConfig()
+        self.assertEqual(self.c.cacheStore.path, '/srv/caches')
+
+    def test_cache_store_bad_key(self):
+        self.c.cfgdict = {'cache_store': {'directory': '/srv/caches'}}
+        self.assertRaisesConfigError("cache_store does not support directory",
+                                     self.c.createCacheStoreConfig)
+
+    def test_env_properties_not_globs(self):
+        self.assertRaisesConfigError(
+            "'env_properties' of project p should only have 'allow' and 'deny' lists of globs",
+            lambda: self.c.define_travis_builder(
+                "p", "git://example.com/p", vcs_type="git+poller",
+                env_properties={'deny': ["FOO", 1]}))
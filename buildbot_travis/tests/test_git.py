@@ -2,9 +2,21 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+import subprocess
+
+from twisted.internet import defer
 from twisted.trial import unittest
+
+from buildbot.plugins import changes
+from buildbot_travis.reuse import TREE_HASH_PROPERTY
+from buildbot_travis.steps.base import TRAVIS_CONFIG_PROPERTY, unpackConfig
 from buildbot_travis.vcs import git
 
+BUNDLE = os.path.join(os.path.dirname(__file__), "test.git.bundle")
+BUNDLE_REVISION = "c7cf0957c702eb08b229e152c6a6d8e350b1d1fa"
+BUNDLE_TREE = "01e29949b011066d5036de9825e3ed8efd8cb69a"
+
 
 class GitUrlParser(unittest.TestCase):
 
@@ -31,3 +43,88 @@ class GitUrlParser(unittest.TestCase):
         self.assertEqual(parsed.user, 'bla')
         self.assertEqual(parsed.passwd, 'secrit::!')
         self.assertEqual(parsed.path, '/tardyp/buildbot_travis')
+
+
+class FakeSourceStamp(object):
+
+    def __init__(self, branch, revision):
+        self.branch, self.revision = branch, revision
+
+
+class FakeSourceStep(object):
+    codebase = "buildbot_travis"
+
+    def __init__(self, branch, revision):
+        self.build = self
+        self.ss = FakeSourceStamp(branch, revision)
+        self.props = {}
+
+    def getSourceStamp(self, codebase):
+        return self.ss
+
+    def updateSourceProperty(self, name, value):
+        self.props[name] = {self.codebase: value}
+
+    def setProperty(self, name, value, source):
+        self.props[name] = value
+
+
+class TravisYmlFromPoller(unittest.TestCase):
+
+    def setUp(self):
+        self.vcs = git.GitPoller(name="buildbot_travis", repository=BUNDLE, branch="master")
+        self.vcs.pollerdir = pollerdir = os.path.abspath(self.mktemp())
+        subprocess.check_output(["git", "init", "--bare", pollerdir])
+        # where the poller fetches the branches
+        poller = changes.GitPoller(repourl=BUNDLE, workdir=pollerdir, branch="master")
+        subprocess.check_output(
+            ["git", "fetch", BUNDLE, "+refs/heads/master:" + poller._trackerBranch("master")],
+            cwd=pollerdir, stderr=subprocess.STDOUT)
+
+    @defer.inlineCallbacks
+    def test_branch(self):
+        revision, filename, travis_yml = yield self.vcs.getTravisYmlFromPoller("master", None)
+        self.assertEqual(revision, BUNDLE_REVISION)
+        self.assertEqual(filename, ".travis.yml")
+        self.assertIn("language: python", travis_yml)
+
+    @defer.inlineCallbacks
+    def test_full_ref(self):
+        res = yield self.vcs.getTravisYmlFromPoller("refs/heads/master", None)
+        self.assertEqual(res[0], BUNDLE_REVISION)
+
+    @defer.inlineCallbacks
+    def test_not_polled(self):
+        self.vcs.pollerdir = None
+        res = yield self.vcs.getTravisYmlFromPoller("master", None)
+        self.assertEqual(res, None)
+
+    @defer.inlineCallbacks
+    def test_revision(self):
+        res = yield self.vcs.getTravisYmlFromPoller("master", BUNDLE_REVISION[:12])
+        self.assertEqual(res[0], BUNDLE_REVISION)
+
+    @defer.inlineCallbacks
+    def test_unknown_revision(self):
+        res = yield self.vcs.getTravisYmlFromPoller("master", "0" * 40)
+        self.assertEqual(res, None)
+        res = yield self.vcs.getTravisYmlFromPoller("unknown", None)
+        self.assertEqual(res, None)
+
+    @defer.inlineCallbacks
+    def test_skip_checkout(self):
+        step = FakeSourceStep("master", None)
+        res = yield self.vcs.needsCheckout(step)
+        self.assertEqual(res, False)
+        self.assertEqual(step.props["got_revision"], {"buildbot_travis": BUNDLE_REVISION})
+        self.assertEqual(step.props[TREE_HASH_PROPERTY], {"buildbot_travis": BUNDLE_TREE})
+        filename, _, revisions = unpackConfig(step.props[TRAVIS_CONFIG_PROPERTY])
+        self.assertEqual(filename, ".travis.yml")
+        self.assertEqual(revisions, {"buildbot_travis": BUNDLE_REVISION})
+
+    @defer.inlineCallbacks
+    def test_checkout(self):
+        step = FakeSourceStep("master", "0" * 40)
+        res = yield self.vcs.needsCheckout(step)
+        self.assertEqual(res, True)
+        self.assertEqual(step.props, {})
@@ -0,0 +1,254 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import posixpath
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from buildbot.process.results import SKIPPED, SUCCESS, WARNINGS
+from buildbot_travis.steps import create_steps, reports
+
+JUNIT = b"""<?xml version="1.0" encoding="utf-8"?>
+<testsuites>
+  <testsuite name="pytest" errors="1" failures="1" skipped="1" tests="4">
+    <testcase classname="tests.test_a" name="test_ok" file="tests/test_a.py" line="3" time="0.1"/>
+    <testcase classname="tests.test_a" name="test_fail" file="tests/test_a.py" line="7">
+      <failure message="assert 1 == 2">a very long traceback</failure>
+      <system-out>some output</system-out>
+    </testcase>
+    <testcase classname="tests.test_a" name="test_error">
+      <failure message="assert 1 == 2"/>
+      <error message="fixture"/>
+    </testcase>
+    <testcase classname="tests.test_b" name="test_skip"><skipped message="no db"/></testcase>
+    <system-out>suite output</system-out>
+  </testsuite>
+</testsuites>
+"""
+
+PYTEST = [
+    {"$report_type": "SessionStart", "pytest_version": "6.2.2"},
+    {"$report_type": "TestReport", "nodeid": "test_a.py::test_ok", "when": "setup",
+     "outcome": "passed", "location": ["test_a.py", 2, "test_ok"]},
+    {"$report_type": "TestReport", "nodeid": "test_a.py::test_ok", "when": "call",
+     "outcome": "passed", "location": ["test_a.py", 2, "test_ok"]},
+    {"$report_type": "TestReport", "nodeid": "test_a.py::test_ok", "when": "teardown",
+     "outcome": "passed", "location": ["test_a.py", 2, "test_ok"]},
+    {"$report_type": "TestReport", "nodeid": "test_a.py::test_fail", "when": "call",
+     "outcome": "failed", "location": ["test_a.py", 5, "test_fail"]},
+    {"$report_type": "TestReport", "nodeid": "test_a.py::test_fixture", "when": "setup",
+     "outcome": "failed", "location": ["test_a.py", 9, "test_fixture"]},
+    {"$report_type": "TestReport", "nodeid": "test_a.py::test_skip", "when": "setup",
+     "outcome": "skipped", "location": ["test_a.py", 12, "test_skip"]},
+    {"$report_type": "SessionFinish", "exitstatus": 1},
+]
+
+GOTEST = [
+    {"Action": "run", "Package": "example.com/foo", "Test": "TestOk"},
+    {"Action": "output", "Package": "example.com/foo", "Test": "TestOk", "Output": "ok\n"},
+    {"Action": "pass", "Package": "example.com/foo", "Test": "TestOk", "Elapsed": 0.1},
+    {"Action": "fail", "Package": "example.com/foo", "Test": "TestFail", "Elapsed": 0.1},
+    {"Action": "skip", "Package": "example.com/foo", "Test": "TestSkip", "Elapsed": 0},
+    {"Action": "fail", "Package": "example.com/foo", "Elapsed": 0.3},
+]
+
+
+def jsonLines(entries):
+    return b"".join(json.dumps(entry).encode("utf-8") + b"\n" for entry in entries)
+
+
+def parse(parser, data, chunkSize=7):
+    for i in range(0, len(data), chunkSize):
+        parser.feed(data[i:i + chunkSize])
+    parser.close()
+    return parser.popResults()
+
+
+class ParsersTestCase(unittest.TestCase):
+
+    def test_junit(self):
+        self.assertEqual(parse(reports.JUnitParser(), JUNIT), [
+            ("tests.test_a.test_ok", "tests/test_a.py", 3, "passed"),
+            ("tests.test_a.test_fail", "tests/test_a.py", 7, "failed"),
+            ("tests.test_a.test_error", None, None, "error"),
+            ("tests.test_b.test_skip", None, None, "skipped"),
+        ])
+
+    def test_junit_invalid(self):
+        parser = reports.JUnitParser()
+        self.assertRaises(Exception, parse, parser, JUNIT[:-40])
+
+    def test_pytest(self):
+        self.assertEqual(parse(reports.PytestReportLogParser(), jsonLines(PYTEST)), [
+            ("test_a.py::test_ok", "test_a.py", 2, "passed"),
+            ("test_a.py::test_fail", "test_a.py", 5, "failed"),
+            ("test_a.py::test_fixture", "test_a.py", 9, "error"),
+            ("test_a.py::test_skip", "test_a.py", 12, "skipped"),
+        ])
+
+    def test_gotest_without_final_newline(self):
+        self.assertEqual(parse(reports.GoTestParser(), jsonLines(GOTEST).rstrip()), [
+            ("TestOk", "example.com/foo", None, "passed"),
+            ("TestFail", "example.com/foo", None, "failed"),
+            ("TestSkip", "example.com/foo", None, "skipped"),
+        ])
+
+    def test_registry(self):
+        self.assertEqual(sorted(reports.REPORT_PARSERS), ["gotest", "junit", "pytest"])
+
+
+class FakeUpdates(object):
+
+    def __init__(self):
+        self.sets = {}
+        self.results = []
+
+    def addTestResultSet(self, builderid, buildid, stepid, description, category, value_unit):
+        setid = len(self.sets) + 1
+        self.sets[setid] = dict(description=description, category=category,
+                                value_unit=value_unit, complete=False)
+        return defer.succeed(setid)
+
+    def addTestResults(self, builderid, test_result_setid, result_values):
+        self.results.append((test_result_setid, result_values))
+        return defer.succeed(None)
+
+    def completeTestResultSet(self, test_result_setid, tests_passed=None, tests_failed=None):
+        self.sets[test_result_setid].update(
+            complete=True, tests_passed=tests_passed, tests_failed=tests_failed)
+        return defer.succeed(None)
+
+
+class FakeBuild(object):
+    buildid = 12
+    path_module = posixpath
+
+    def getBuilderId(self):
+        return defer.succeed(3)
+
+
+class FakeParseTestReports(reports.ParseTestReports):
+    batchSize = 2
+
+    def __init__(self, files, *args, **kwargs):
+        reports.ParseTestReports.__init__(self, *args, **kwargs)
+        self.files = files
+        self.globs = []
+        self.logs = {}
+        self.stats = {}
+
+    def runGlob(self, path, **kwargs):
+        self.globs.append(path)
+        return defer.succeed(sorted(self.files))
+
+    @defer.inlineCallbacks
+    def uploadReport(self, filename, writer):
+        data = self.files[filename]
+        if data is None:
+            defer.returnValue(False)
+        for i in range(0, len(data), 64):
+            yield writer.remote_write(data[i:i + 64])
+        writer.remote_close()
+        defer.returnValue(True)
+
+    def addCompleteLog(self, name, text):
+        self.logs[name] = text
+
+    def setStatistic(self, name, value):
+        self.stats[name] = value
+
+
+class ParseTestReportsTestCase(unittest.TestCase):
+
+    def makeStep(self, files, parser="junit", pattern="reports/*.xml"):
+        step = FakeParseTestReports(files, parser, pattern)
+        step.build = FakeBuild()
+        step.workdir = "build"
+        step.stepid = 7
+        step.master = self
+        self.data = self
+        self.updates = FakeUpdates()
+        return step
+
+    @defer.inlineCallbacks
+    def test_junit(self):
+        step = self.makeStep({"/w/build/reports/a.xml": JUNIT,
+                              "/w/build/reports/b.xml": JUNIT.replace(b"tests.", b"other.")})
+        results = yield step.run()
+        self.assertEqual(results, SUCCESS)
+        self.assertEqual(step.name, "junit reports")
+        self.assertEqual(step.globs, ["build/reports/*.xml"])
+        self.assertEqual(self.updates.sets, {1: dict(
+            description="junit reports/*.xml", category="pass_fail", value_unit="outcome",
+            complete=True, tests_passed=2, tests_failed=4)})
+        # results are sent by batches, while the reports are uploaded
+        values = [value for setid, batch in self.updates.results for value in batch]
+        self.assertTrue(all(len(batch) <= 2 for setid, batch in self.updates.results))
+        self.assertEqual(len(values), 8)
+        self.assertEqual(values[1], dict(test_name="tests.test_a.test_fail", value="failed",
+                                         test_code_path="tests/test_a.py", line=7))
+        self.assertEqual(values[2], dict(test_name="tests.test_a.test_error", value="error"))
+        self.assertEqual(step.stats, dict(total=8, fails=2, errors=2, skipped=2, passed=2))
+        self.assertEqual(step.descriptionDone, "8 tests 2 failed 2 error 2 skipped")
+
+    @defer.inlineCallbacks
+    def test_no_report(self):
+        step = self.makeStep({})
+        results = yield step.run()
+        self.assertEqual(results, WARNINGS)
+        self.assertEqual(self.updates.sets, {})
+        self.assertEqual(step.descriptionDone, "no junit report matching reports/*.xml")
+
+    @defer.inlineCallbacks
+    def test_no_test_results(self):
+        step = self.makeStep({"/w/build/reports/a.xml": JUNIT})
+        # buildbot < 2.9
+        self.updates = object()
+        results = yield step.run()
+        self.assertEqual(results, SKIPPED)
+        self.assertEqual(step.descriptionDone, "test reports need buildbot 2.9")
+
+    @defer.inlineCallbacks
+    def test_broken_report(self):
+        step = self.makeStep({"/w/build/reports/a.xml": JUNIT[:-40],
+                              "/w/build/reports/b.xml": None})
+        results = yield step.run()
+        self.assertEqual(results, WARNINGS)
+        self.assertIn("/w/build/reports/a.xml:\nTraceback", step.logs["errors"])
+        self.assertIn("/w/build/reports/b.xml: could not be uploaded", step.logs["errors"])
+        # the tests parsed before the error are kept
+        self.assertEqual(self.updates.sets[1]['tests_passed'], 1)
+
+
+class FakeSetupBuild(object):
+
+    def __init__(self):
+        self.steps = []
+
+    def addStepsAfterLastStep(self, steps):
+        self.steps.extend(steps)
+
+
+class ReportsConfigTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.step = create_steps.TravisSetupSteps()
+        self.step.build = FakeSetupBuild()
+        self.logs = {}
+        self.step.addCompleteLog = self.logs.__setitem__
+
+    def test_reports(self):
+        self.step.addBBTravisStep(dict(cmd="make check", reports=dict(
+            pytest="report.json", junit=["reports/*.xml", "other/*.xml"])))
+        steps = self.step.build.steps
+        self.assertEqual([(s.__class__.__name__, getattr(s, "pattern", None)) for s in steps], [
+            ("ShellCommand", None), ("ParseTestReports", "reports/*.xml"),
+            ("ParseTestReports", "other/*.xml"), ("ParseTestReports", "report.json")])
+
+    def test_unknown_parser(self):
+        self.step.addBBTravisStep(dict(cmd="make check", reports=dict(nunit="*.xml")))
+        self.assertEqual(len(self.step.build.steps), 1)
+        self.assertIn("Unknown test report parser 'nunit'", self.logs["bbtravis.yml error"])
@@ -0,0 +1,137 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from buildbot.db.connector import DBConnector
+from buildbot.process.results import FAILURE, SUCCESS
+from buildbot.test.fake import fakemaster
+from buildbot_travis import reuse
+from buildbot_travis.reuse import (REUSE_KEY_PROPERTY, MatrixResultCache, cellReuseKey,
+                                   getReusableResults, hooksSignature, pruneResults)
+
+TREES = {"project": "abcd" * 10}
+CELL = dict(python="2.7", env=dict(FOO="1", BAR="2"))
+
+
+class ReuseKeyTestCase(unittest.TestCase):
+
+    def test_key(self):
+        key = cellReuseKey("project-job", TREES, CELL, "hooks")
+        self.assertEqual(key, cellReuseKey("project-job", dict(TREES), dict(CELL), "hooks"))
+        self.assertNotEqual(key, cellReuseKey("other-job", TREES, CELL, "hooks"))
+        self.assertNotEqual(key, cellReuseKey("project-job", {"project": "dcba" * 10}, CELL,
+                                              "hooks"))
+        self.assertNotEqual(key, cellReuseKey("project-job", TREES, dict(python="3.6"), "hooks"))
+        self.assertNotEqual(key, cellReuseKey("project-job", TREES, CELL, "other hooks"))
+
+    def test_hooks(self):
+        hooks = hooksSignature("language: python\nscript: [trial]\n")
+        self.assertEqual(hooksSignature("language: python\nscript:\n  - trial\nenv: [A=1]\n"),
+                         hooks)
+        self.assertNotEqual(hooksSignature("language: python\nscript: [trial]\n"
+                                           "install: [pip install .]\n"), hooks)
+        self.assertNotEqual(hooksSignature("language: c\nscript: [trial]\n"), hooks)
+
+    def test_plugin_steps(self):
+        travis_yml = "language: python\nscript:\n  - !ShellCommand {command: make}\n"
+        hooks = hooksSignature(travis_yml)
+        self.assertEqual(hooksSignature(travis_yml), hooks)
+        self.assertNotEqual(hooksSignature(travis_yml.replace("make", "make all")), hooks)
+
+
+class MatrixResultCacheTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        basedir = os.path.abspath(self.mktemp())
+        os.makedirs(basedir)
+        self.master = master = fakemaster.make_master(None, wantRealReactor=True)
+        master.config.db['db_url'] = "sqlite:///" + os.path.join(basedir, "state.sqlite")
+        master.db = DBConnector(basedir)
+        yield master.db.setServiceParent(master)
+        yield master.db.setup(check_version=False)
+        yield master.db.model.upgrade()
+        self.cache = MatrixResultCache()
+        self.cache.parent = master
+        self.properties = {}
+        master.data = self
+
+    def get(self, path):
+        return defer.succeed(self.properties)
+
+    def tearDown(self):
+        return self.master.db.pool.shutdown()
+
+    @defer.inlineCallbacks
+    def test_reuse(self):
+        key = cellReuseKey("project-job", TREES, CELL, "hooks")
+        found = yield getReusableResults(self.master, [key])
+        self.assertEqual(found, {})
+
+        self.properties[REUSE_KEY_PROPERTY] = (key, "spawner")
+        yield self.cache.buildFinished(None, dict(buildid=5, builderid=1, number=3,
+                                                  results=SUCCESS))
+        found = yield getReusableResults(self.master, [key, "other"])
+        self.assertEqual(found, {key: dict(buildid=5, builderid=1, number=3,
+                                           pull_request=False)})
+        # the pull requests trust the branches
+        found = yield getReusableResults(self.master, [key], pullRequest=True)
+        self.assertEqual(list(found), [key])
+
+    @defer.inlineCallbacks
+    def test_pull_request(self):
+        key = cellReuseKey("project-job", TREES, CELL, "hooks")
+        self.properties[REUSE_KEY_PROPERTY] = (key, "spawner")
+        self.properties["TRAVIS_PULL_REQUEST"] = (12, "inherit")
+        yield self.cache.buildFinished(None, dict(buildid=5, builderid=1, number=3,
+                                                  results=SUCCESS))
+        found = yield getReusableResults(self.master, [key])
+        self.assertEqual(found, {})
+        found = yield getReusableResults(self.master, [key], pullRequest=True)
+        self.assertEqual(list(found), [key])
+
+    @defer.inlineCallbacks
+    def test_not_green(self):
+        key = cellReuseKey("project-job", TREES, CELL, "hooks")
+        self.properties[REUSE_KEY_PROPERTY] = (key, "spawner")
+        yield self.cache.buildFinished(None, dict(buildid=5, builderid=1, number=3,
+                                                  results=FAILURE))
+        found = yield getReusableResults(self.master, [key])
+        self.assertEqual(found, {})
+
+    @defer.inlineCallbacks
+    def test_not_matrix_job(self):
+        yield self.cache.buildFinished(None, dict(buildid=5, builderid=1, number=3,
+                                                  results=SUCCESS))
+        objectid = yield self.master.db.state.getObjectId("TravisMatrixResults",
+                                                          "MatrixResultCache")
+        state = yield self.master.db.state.getState(objectid, "", None)
+        self.assertEqual(state, None)
+
+    @defer.inlineCallbacks
+    def test_many_keys(self):
+        keys = ["key%d" % i for i in range(1200)]
+        found = yield getReusableResults(self.master, keys)
+        self.assertEqual(found, {})
+
+    @defer.inlineCallbacks
+    def test_prune(self):
+        self.patch(reuse, "MAX_RESULTS", 3)
+        self.patch(reuse, "PRUNE_INTERVAL", 4)
+        for buildid in range(1, 10):
+            self.properties[REUSE_KEY_PROPERTY] = ("key%d" % buildid, "spawner")
+            yield self.cache.buildFinished(None, dict(buildid=buildid, builderid=1, number=1,
+                                                      results=SUCCESS))
+        keys = ["key%d" % buildid for buildid in range(1, 10)]
+        # pruned after the 4th and the 8th jobs
+        found = yield getReusableResults(self.master, keys)
+        self.assertEqual(sorted(found), ["key6", "key7", "key8", "key9"])
+        removed = yield pruneResults(self.master, 2)
+        self.assertEqual(removed, 2)
+        found = yield getReusableResults(self.master, keys)
+        self.assertEqual(sorted(found), ["key8", "key9"])
@@ -0,0 +1,137 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from twisted.trial import unittest
+
+from buildbot_travis import runner
+from buildbot_travis.matrix import TravisMatrix
+
+
+class FakeUi(object):
+
+    def __init__(self):
+        self.texts = []
+
+    def addTextForWindow(self, n, text):
+        self.texts.append(text)
+
+
+class RunnerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # the runner stops running commands once the reactor is stopped
+        self.patch(runner.reactor, "_stopped", False)
+        self.ui = FakeUi()
+        self.runner = runner.Runner(None, self.ui, 0)
+
+    def test_output_not_captured(self):
+        rc, out = self.runner.run("echo foo; exit 3")
+        self.assertEqual((rc, out), (3, ""))
+        self.assertEqual("".join(self.ui.texts), "foo\n")
+
+    def test_capture_is_bounded(self):
+        self.patch(runner, "CAPTURED_SIZE", 8)
+        rc, out = self.runner.run("seq 1 10; echo -n end", capture=True)
+        self.assertEqual((rc, out), (0, "9\n10\nend"))
+        self.assertEqual("".join(self.ui.texts), "".join("%d\n" % i for i in range(1, 11)) + "end")
+
+    def test_truncated_character(self):
+        rc, out = self.runner.run("printf 'end\\303'", capture=True)
+        # the incomplete last character is not lost
+        self.assertEqual(out, u"end\ufffd")
+        self.assertEqual("".join(self.ui.texts), u"end\ufffd")
+
+    def test_chunks(self):
+        self.patch(runner, "OUTPUT_CHUNK_SIZE", 4)
+        rc, out = self.runner.run("printf '\\303\\251123456789'", capture=True)
+        # the characters split between two reads are decoded as a whole
+        self.assertEqual(out, u"\xe9123456789")
+        self.assertTrue(all(len(text) <= 4 for text in self.ui.texts))
+
+    def test_chunks_truncated_end(self):
+        self.patch(runner, "OUTPUT_CHUNK_SIZE", 2)
+        rc, out = self.runner.run("printf '1\\303\\251\\342\\202'", capture=True)
+        # the last read ends in the middle of a character, which is flushed at
+        # the end of the output, and nothing is sent for the empty reads
+        self.assertEqual(out, u"1\xe9\ufffd")
+        self.assertEqual("".join(self.ui.texts), u"1\xe9\ufffd")
+        self.assertTrue(all(self.ui.texts))
+
+
+class FakeConfig(object):
+    pass
+
+
+class FilterConfigTestCase(unittest.TestCase):
+
+    def filter(self, *filters):
+        config = FakeConfig()
+        config.matrix = TravisMatrix([("python", ["2.7", "3.6"])])
+        args = FakeConfig()
+        args.filters = list(filters)
+        runner.filter_config(config, args)
+        return list(config.matrix)
+
+    def test_equal(self):
+        self.assertEqual(self.filter(("python", "==", "2.7")), [dict(python="2.7")])
+
+    def test_not_equal(self):
+        self.assertEqual(self.filter(("python", "!=", "2.7")), [dict(python="3.6")])
+
+    def test_unknown_operator(self):
+        self.assertEqual(self.filter(("python", "~", "2.7")), [])
+
+
+class FakeWindow(object):
+
+    def __init__(self):
+        self.texts = []
+
+    def add_text(self, text):
+        self.texts.append(text)
+
+
+class FakeLoop(object):
+    draws = 0
+
+    def draw_screen(self):
+        self.draws += 1
+
+
+class UiTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # the urwid loop is not needed to buffer the output
+        self.ui = ui = runner.Ui.__new__(runner.Ui)
+        ui.maxwindow = 2
+        ui.windows = [FakeWindow(), FakeWindow()]
+        ui.loop = FakeLoop()
+        ui.lock = runner.Lock()
+        ui.redrawing = False
+        ui.resetPending()
+        self.calls = []
+        self.patch(runner.reactor, "callFromThread", lambda *args: self.calls.append(args))
+
+    def test_coalesced(self):
+        for i in range(100):
+            self.ui.addTextForWindow(i % 2, "%d\n" % i)
+        # a single redraw tick is scheduled
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.ui.windows[0].texts, [])
+
+        self.ui._redraw()
+        self.assertEqual(self.ui.windows[0].texts, ["".join("%d\n" % i for i in range(0, 100, 2))])
+        self.assertEqual(self.ui.windows[1].texts, ["".join("%d\n" % i for i in range(1, 100, 2))])
+        self.assertEqual(self.ui.loop.draws, 1)
+
+        self.ui.addTextForWindow(0, "more")
+        self.assertEqual(len(self.calls), 2)
+
+    def test_skipped(self):
+        self.patch(runner, "MAX_PENDING_SIZE", 10)
+        for i in range(5):
+            self.ui.addTextForWindow(0, "abcd")
+        self.ui._redraw()
+        self.assertEqual(self.ui.windows[0].texts, ["\n[... 12 characters skipped ...]\n",
+                                                    "abcdabcd"])
@@ -0,0 +1,141 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+
+from buildbot.data.connector import DataConnector
+from buildbot.db.connector import DBConnector
+from buildbot.mq.simple import SimpleMQ
+from buildbot.process.properties import Properties
+from buildbot.test.fake import fakemaster
+from buildbot_travis.schedulers import TravisTriggerable
+
+SOURCESTAMPS = [dict(codebase="project", repository="git://example.com/project",
+                     branch="master", revision="abcd" * 10, project="project")]
+
+
+class TravisTriggerableTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        basedir = os.path.abspath(self.mktemp())
+        os.makedirs(basedir)
+        self.master = master = fakemaster.make_master(None, wantRealReactor=True)
+        master.config.db['db_url'] = "sqlite:///" + os.path.join(basedir, "state.sqlite")
+        master.db = DBConnector(basedir)
+        yield master.db.setServiceParent(master)
+        yield master.db.setup(check_version=False)
+        yield master.db.model.upgrade()
+        master.mq = SimpleMQ()
+        yield master.mq.setServiceParent(master)
+        master.data = DataConnector()
+        yield master.data.setServiceParent(master)
+        self.builderid = yield master.data.updates.findBuilderId(u"project-job")
+        self.scheduler = TravisTriggerable(
+            name="project-job", builderNames=["project-job"],
+            codebases={"project": {"repository": "git://example.com/project"}})
+        yield self.scheduler.setServiceParent(master)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        # let the pending notifications go before closing the database
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        yield self.master.db.pool.shutdown()
+
+    def makeMatrix(self, cells):
+        matrix = []
+        for i in range(cells):
+            props = Properties()
+            props.setProperty("TESTS", "t%d" % i, ".travis.yml")
+            matrix.append(props)
+        return matrix
+
+    @defer.inlineCallbacks
+    def getBuildsets(self, ids):
+        """ what the data API tells of the buildsets, but their ids and dates """
+        buildsets = []
+        for bsid, brids in ids:
+            buildset = yield self.master.data.get(("buildsets", bsid))
+            properties = yield self.master.db.buildsets.getBuildsetProperties(bsid)
+            requests = []
+            for brid in brids.values():
+                request = yield self.master.data.get(("buildrequests", brid))
+                requests.append(dict((k, v) for k, v in request.items()
+                                     if k not in ("buildrequestid", "buildsetid",
+                                                  "submitted_at")))
+            buildset = dict((k, v) for k, v in buildset.items()
+                            if k not in ("bsid", "submitted_at"))
+            for ss in buildset["sourcestamps"]:
+                ss.pop("created_at")
+            buildsets.append((buildset, properties, requests))
+        defer.returnValue(buildsets)
+
+    @defer.inlineCallbacks
+    def test_matrix(self):
+        matrix = self.makeMatrix(3)
+        yield self.scheduler.addMatrixBuildsets(True, SOURCESTAMPS, matrix)
+        seen = set()
+        for i, props in enumerate(matrix):
+            ids, _ = self.scheduler.trigger(True, sourcestamps=SOURCESTAMPS, set_props=props)
+            bsid, brids = yield ids
+            self.assertEqual(list(brids), [self.builderid])
+            seen.add(bsid)
+            bsprops = yield self.master.db.buildsets.getBuildsetProperties(bsid)
+            self.assertEqual(bsprops["TESTS"], ("t%d" % i, ".travis.yml"))
+            buildset = yield self.master.data.get(("buildsets", bsid))
+            self.assertEqual(buildset["sourcestamps"][0]["revision"], "abcd" * 10)
+        self.assertEqual(len(seen), 3)
+        self.assertEqual(self.scheduler._matrix, {})
+
+    @defer.inlineCallbacks
+    def test_not_batched(self):
+        props, = self.makeMatrix(1)
+        ids, _ = self.scheduler.trigger(True, sourcestamps=SOURCESTAMPS, set_props=props)
+        bsid, brids = yield ids
+        bsprops = yield self.master.db.buildsets.getBuildsetProperties(bsid)
+        self.assertEqual(bsprops["TESTS"], ("t0", ".travis.yml"))
+
+    @defer.inlineCallbacks
+    def test_forget(self):
+        matrix = self.makeMatrix(2)
+        yield self.scheduler.addMatrixBuildsets(True, SOURCESTAMPS, matrix)
+        self.scheduler.forgetMatrix(matrix)
+        self.assertEqual(self.scheduler._matrix, {})
+
+    @defer.inlineCallbacks
+    def test_same_as_trigger(self):
+        ids = yield self.scheduler.addMatrixBuildsets(True, SOURCESTAMPS, self.makeMatrix(2))
+        batched = yield self.getBuildsets(ids)
+        ids = []
+        for props in self.makeMatrix(2):
+            idsDeferred, _ = self.scheduler.trigger(True, sourcestamps=SOURCESTAMPS,
+                                                    set_props=props)
+            ids.append((yield idsDeferred))
+        triggered = yield self.getBuildsets(ids)
+        self.assertEqual(batched, triggered)
+
+    @defer.inlineCallbacks
+    def test_concurrent(self):
+        requested = []
+        pending = []
+        addBuildset = self.scheduler.addBuildsetForSourceStampsWithDefaults
+
+        def addBuildsetForSourceStampsWithDefaults(*args, **kwargs):
+            requested.append(args)
+            d = defer.Deferred()
+            pending.append(d)
+            d.addCallback(lambda _: addBuildset(*args, **kwargs))
+            return d
+        self.scheduler.addBuildsetForSourceStampsWithDefaults = \
+            addBuildsetForSourceStampsWithDefaults
+        d = self.scheduler.addMatrixBuildsets(True, SOURCESTAMPS, self.makeMatrix(3))
+        # the buildsets are all requested before any of them is created
+        self.assertEqual(len(requested), 3)
+        for p in pending:
+            p.callback(None)
+        ids = yield d
+        self.assertEqual(len(set(bsid for bsid, brids in ids)), 3)
@@ -0,0 +1,525 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from twisted.application.service import MultiService
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from buildbot.process import buildstep
+from buildbot.process.properties import Properties
+from buildbot.process.results import CANCELLED, FAILURE, RETRY, SUCCESS
+from buildbot.schedulers.basic import AnyBranchScheduler
+from buildbot.schedulers.forcesched import ForceScheduler
+from buildbot_travis.steps.base import (NO_CONFIG_RC, TRAVIS_CONFIG_PROPERTY,
+                                        ConfigurableStepMixin, packConfig, unpackConfig)
+from buildbot_travis.steps import create_steps
+from buildbot_travis.steps.create_steps import PropertiesEnvironment
+from buildbot_travis.steps.spawner import TravisTrigger
+from buildbot_travis.travisyml import TravisYml
+
+
+class FakeConfigurableStep(ConfigurableStepMixin):
+    worker = None
+    workdir = "build"
+
+    def __init__(self, **props):
+        self.props = props
+        self.commands = []
+        self.logs = {}
+        self.files = {}
+        self.rc = None
+
+    def getProperty(self, name, default=None):
+        return self.props.get(name, default)
+
+    def workerVersion(self, command):
+        return "3.0"
+
+    def addCompleteLog(self, name, text):
+        self.logs[name] = text
+
+    def runCommand(self, cmd):
+        self.commands.append(cmd.remote_command)
+        if self.rc is None:
+            for filename in self.TRAVIS_FILENAMES:
+                if filename in self.files:
+                    cmd.rc, cmd.stdout = 0, filename + "\n" + self.files[filename]
+                    break
+            else:
+                cmd.rc = NO_CONFIG_RC
+        else:
+            cmd.rc = self.rc
+        return defer.succeed(None)
+
+    def getFileContentFromWorker(self, filename, abandonOnFailure=False):
+        self.commands.append("uploadFile")
+        if filename in self.files:
+            return defer.succeed(self.files[filename])
+        return defer.fail(buildstep.BuildStepFailed())
+
+
+class ShippedConfigTestCase(unittest.TestCase):
+    travis_yml = u"language: python\nscript: echo \u00e9\n"
+
+    def test_roundtrip(self):
+        payload = packConfig(".travis.yml", self.travis_yml, {'': 'abcd'})
+        self.assertEqual(unpackConfig(payload), (".travis.yml", self.travis_yml, {'': 'abcd'}))
+
+    def test_corrupted(self):
+        payload = packConfig(".travis.yml", self.travis_yml, {})
+        payload['digest'] = 'foo'
+        self.assertEqual(unpackConfig(payload), None)
+        self.assertEqual(unpackConfig(None), None)
+        self.assertEqual(unpackConfig({'version': 0}), None)
+
+    def test_shipped(self):
+        step = FakeConfigurableStep(
+            got_revision={'proj': 'abcd', 'subrepo': '1234'},
+            **{TRAVIS_CONFIG_PROPERTY: packConfig(".bbtravis.yml", self.travis_yml,
+                                                  {'proj': 'abcd'})})
+        self.assertEqual(step.getShippedConfig(), (".bbtravis.yml", self.travis_yml))
+
+    def test_shipped_stale(self):
+        step = FakeConfigurableStep(
+            got_revision='1234',
+            **{TRAVIS_CONFIG_PROPERTY: packConfig(".travis.yml", self.travis_yml,
+                                                  {'': 'abcd'})})
+        self.assertEqual(step.getShippedConfig(), (None, None))
+
+    def test_not_shipped(self):
+        step = FakeConfigurableStep(got_revision='1234')
+        self.assertEqual(step.getShippedConfig(), (None, None))
+
+
+class ConfigFromWorkerTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def test_single_command(self):
+        step = FakeConfigurableStep()
+        step.files[".travis.yml"] = "language: python\n"
+        res = yield step.getConfigFromWorker()
+        self.assertEqual(res, (".travis.yml", "language: python\n"))
+        self.assertEqual(step.commands, ["shell"])
+
+    @defer.inlineCallbacks
+    def test_precedence(self):
+        step = FakeConfigurableStep()
+        step.files[".travis.yml"] = "language: python\n"
+        step.files[".bbtravis.yml"] = "language: c\n"
+        res = yield step.getConfigFromWorker()
+        self.assertEqual(res, (".bbtravis.yml", "language: c\n"))
+
+    @defer.inlineCallbacks
+    def test_no_config(self):
+        step = FakeConfigurableStep()
+        yield self.assertFailure(step.getConfigFromWorker(), buildstep.BuildStepFailed)
+        self.assertEqual(step.commands, ["shell"])
+        self.assertIn("Please put a file named .travis.yml", step.logs["error"])
+        self.assertIn("none of .bbtravis.yml, .travis.yml found in build", step.logs["error"])
+        self.assertIn("help.txt", step.logs)
+
+    @defer.inlineCallbacks
+    def test_no_config_fallback(self):
+        step = FakeConfigurableStep()
+        step.rc = 127
+        error = yield self.assertFailure(step.getConfigFromWorker(), buildstep.BuildStepFailed)
+        self.assertEqual(step.commands, ["shell", "uploadFile", "uploadFile"])
+        self.assertIn(str(error), step.logs["error"])
+        self.assertIn("none of .bbtravis.yml, .travis.yml found in build", step.logs["error"])
+
+    @defer.inlineCallbacks
+    def test_fallback(self):
+        step = FakeConfigurableStep()
+        step.rc = 127
+        step.files[".travis.yml"] = "language: python\n"
+        res = yield step.getConfigFromWorker()
+        self.assertEqual(res, (".travis.yml", "language: python\n"))
+        self.assertEqual(step.commands, ["shell", "uploadFile", "uploadFile"])
+
+
+class FakeConsumer(object):
+    stopped = False
+
+    def stopConsuming(self):
+        self.stopped = True
+
+
+class FakeControlData(object):
+
+    def __init__(self):
+        self.cancelled = []
+        self.data = self
+
+    def control(self, action, args, path):
+        self.cancelled.append(path[1])
+        return defer.succeed(None)
+
+
+class FastFinishTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.step = TravisTrigger(scheduler="job", fastFinish=True)
+        self.step.master = self.data = FakeControlData()
+        self.consumer = FakeConsumer()
+        self.step.fastFinishConsumers = [self.consumer]
+        self.step.watchedBrids = {1: False, 2: True, 3: False, 4: False}
+        self.step.cancelledBrids = set()
+
+    def complete(self, brid, results):
+        self.step.buildFinished(None, dict(buildrequestid=brid, results=results))
+        self.step.buildRequestComplete(None, dict(buildrequestid=brid, results=results))
+
+    def test_failure(self):
+        self.complete(1, SUCCESS)
+        self.assertEqual(self.data.cancelled, [])
+        self.complete(3, FAILURE)
+        self.assertEqual(sorted(self.data.cancelled), [2, 4])
+        self.assertEqual(self.step.cancelledBrids, set([2, 4]))
+        self.assertTrue(self.consumer.stopped)
+        # the cancelled jobs complete later on
+        self.complete(4, CANCELLED)
+        self.assertEqual(sorted(self.data.cancelled), [2, 4])
+
+    def test_allowed_failure(self):
+        self.complete(2, FAILURE)
+        self.assertEqual(self.data.cancelled, [])
+        self.assertFalse(self.consumer.stopped)
+
+    def test_retried(self):
+        # a retried request gets a new build
+        self.step.buildFinished(None, dict(buildrequestid=1, results=RETRY))
+        self.complete(1, FAILURE)
+        self.assertEqual(sorted(self.data.cancelled), [2, 3, 4])
+
+    def test_all_complete(self):
+        for brid in (1, 2, 3, 4):
+            self.complete(brid, SUCCESS)
+        self.assertEqual(self.data.cancelled, [])
+        self.assertTrue(self.consumer.stopped)
+
+    def test_spawning(self):
+        # the next matrix chunks are not created yet
+        self.step.spawning = True
+        for brid in (1, 2, 3, 4):
+            self.complete(brid, SUCCESS)
+        self.assertFalse(self.consumer.stopped)
+
+
+class FakeMatrixScheduler(object):
+
+    def __init__(self, step):
+        self.step = step
+        self.calls = []
+        self.brid = 0
+
+    def addMatrixBuildsets(self, waited_for, sourcestamps, propertiesList, **kwargs):
+        # the cells generated so far
+        self.calls.append((len(propertiesList), self.step.generated))
+        ids = []
+        for _ in propertiesList:
+            self.brid += 1
+            ids.append((self.brid, {'job': self.brid}))
+        return defer.succeed(ids)
+
+
+class MatrixChunksTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.step = TravisTrigger(scheduler="job")
+        self.step.MATRIX_CHUNK = 2
+        self.step.build = self
+        self.step.master = self.data = FakeControlData()
+        self.step.config = TravisYml()
+        self.step.config.parse_dict(dict(language="python", env=["A=%d" % i for i in range(5)]))
+        self.step.configFilename, self.step.configContent = ".travis.yml", "language: python"
+        self.step.getGotRevisions = lambda: {}
+        self.step.getProperty = lambda name, default=None: default
+        self.step.prepareSourcestampListForTrigger = lambda: []
+        self.step.matrixProperties = []
+        self.step.watchedBrids = {}
+        self.step.fastFinishConsumers = []
+        self.step.cancelledBrids = set()
+        self.scheduler = FakeMatrixScheduler(self.step)
+        self.step.getSchedulerByName = lambda name: self.scheduler
+        self.buildid = 1
+        self.builder = self
+        self.config = self
+        self.tags = []
+        self.step.generated = 0
+        matrix = self.step.config.matrix
+
+        def countingMatrix():
+            for cell in matrix:
+                self.step.generated += 1
+                yield cell
+        self.step.config.matrix = countingMatrix()
+
+    @defer.inlineCallbacks
+    def test_chunks(self):
+        entries = yield self.step.getSchedulersAndProperties()
+        self.assertEqual(len(entries), 5)
+        self.assertEqual(self.scheduler.calls, [(2, 2), (2, 4), (1, 5)])
+        self.assertEqual(len(self.step.matrixProperties), 5)
+        self.assertFalse(self.step.spawning)
+
+    @defer.inlineCallbacks
+    def test_fast_finished(self):
+        # a job of the first chunk fails while the next ones are created
+        self.step.fastFinishConsumers = [FakeConsumer()]
+        self.step.fastFinished = True
+        yield self.step.getSchedulersAndProperties()
+        self.assertEqual(sorted(self.data.cancelled), [1, 2, 3, 4, 5])
+        self.assertEqual(self.step.watchedBrids, {})
+
+
+class FakeSourceStamp(object):
+
+    def __init__(self, codebase, patch=None):
+        self.codebase = codebase
+        self.patch = patch
+
+
+class TreeHashesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.step = TravisTrigger(scheduler="job")
+        self.step.build = self
+        self.sourcestamps = [FakeSourceStamp("project"), FakeSourceStamp("lib")]
+        self.trees = {"project": "1" * 40, "lib": "2" * 40}
+        self.step.getProperty = lambda name, default=None: self.trees
+
+    def getAllSourceStamps(self):
+        return self.sourcestamps
+
+    def test_tree_hashes(self):
+        self.assertEqual(self.step.getTreeHashes(), self.trees)
+
+    def test_missing_codebase(self):
+        del self.trees["lib"]
+        self.assertEqual(self.step.getTreeHashes(), None)
+
+    def test_patch(self):
+        self.sourcestamps[1].patch = "diff"
+        self.assertEqual(self.step.getTreeHashes(), None)
+
+
+class ForcedBuildTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.step = TravisTrigger(scheduler="job")
+        self.step.build = self
+        self.step.master = self
+        self.scheduler_manager = MultiService()
+        ForceScheduler(name="force", builderNames=["project"]).setServiceParent(
+            self.scheduler_manager)
+        AnyBranchScheduler(name="project", builderNames=["project"]).setServiceParent(
+            self.scheduler_manager)
+        self.reason = "changes"
+        self.props = {}
+        self.step.getProperty = lambda name, default=None: self.props.get(name, default)
+
+    def test_changes(self):
+        self.props["scheduler"] = "project"
+        self.assertFalse(self.step.isForced())
+
+    def test_forced(self):
+        self.props["scheduler"] = "force"
+        self.assertTrue(self.step.isForced())
+
+    def test_rebuild(self):
+        self.props["scheduler"] = "project"
+        self.reason = "rebuild"
+        self.assertTrue(self.step.isForced())
+
+    def test_unknown_scheduler(self):
+        self.assertFalse(self.step.isForced())
+
+
+class AffectedCellsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.step = TravisTrigger(scheduler="job")
+        self.step.build = self
+        self.step.config = TravisYml()
+        self.step.config.parse_dict(dict(language="python", env=["C=web", "C=db"], matrix=dict(
+            paths=[dict(env="C=web", paths=["web/*"])])))
+        self.files = []
+
+    def allFiles(self):
+        return self.files
+
+    def test_affected(self):
+        self.files = ["db/schema.sql"]
+        affected = self.step.getAffectedPredicate()
+        self.assertEqual([affected(cell) for cell in self.step.config.matrix], [False, True])
+
+    def test_no_files(self):
+        # e.g. force builds
+        self.assertEqual(self.step.getAffectedPredicate(), None)
+        self.files = [""]
+        self.assertEqual(self.step.getAffectedPredicate(), None)
+
+    def test_no_paths(self):
+        self.files = ["db/schema.sql"]
+        self.step.config.parse_dict(dict(language="python"))
+        self.assertEqual(self.step.getAffectedPredicate(), None)
+
+
+class FakeBuild(object):
+
+    def __init__(self, **props):
+        self.properties = Properties()
+        self.properties.update(props, "test")
+
+    def getProperties(self):
+        return self.properties
+
+
+class PropertiesEnvironmentTestCase(unittest.TestCase):
+
+    def test_environment(self):
+        build = FakeBuild(FOO="1", python=2.7, travis_config="...", tree_hash={"p": "1" * 40})
+        env = PropertiesEnvironment().getEnvironment(build)
+        self.assertEqual(env, dict(FOO="1", python="2.7"))
+
+    def test_allow_deny(self):
+        build = FakeBuild(FOO="1", FOOBAR="2", BAR="3", travis_config="...", travis_foo="4")
+        env = PropertiesEnvironment(allow=["FOO*", "travis_*"], deny=["*BAR"]).getEnvironment(build)
+        # the internal properties are denied anyway
+        self.assertEqual(env, dict(FOO="1", travis_foo="4"))
+
+    def test_internal_properties(self):
+        build = FakeBuild(FOO="1", travis_phases=[3, []], allow_failure=True,
+                          max_parallel_jobs=2)
+        self.assertEqual(PropertiesEnvironment().getEnvironment(build), dict(FOO="1"))
+        self.assertEqual(PropertiesEnvironment(deny=[]).getEnvironment(build), dict(FOO="1"))
+
+    def test_cached(self):
+        build = FakeBuild(FOO="1")
+        environment = PropertiesEnvironment()
+        env = environment.getEnvironment(build)
+        self.assertIs(environment.getEnvironment(build), env)
+        build.properties.setProperty("FOO", "2", "test")
+        self.assertEqual(environment.getEnvironment(build), dict(FOO="2"))
+        build.properties.setProperty("BAR", "3", "test")
+        self.assertEqual(environment.getEnvironment(build), dict(FOO="2", BAR="3"))
+        # another filter does not get the cached environment
+        self.assertEqual(PropertiesEnvironment(deny=["BAR"]).getEnvironment(build), dict(FOO="2"))
+
+
+class TestSummaryObserverTestCase(unittest.TestCase):
+
+    def parse(self, text, chunk=3):
+        observer = create_steps.TestSummaryObserver()
+        lines = text.split("\n")
+        for i in range(0, len(lines), chunk):
+            observer.outReceived("\n".join(lines[i:i + chunk]) + "\n")
+        return observer.getStatistics()
+
+    def assertStats(self, text, total, fails=0, errors=0):
+        self.assertEqual(self.parse(text), dict(
+            total=total, fails=fails, errors=errors, warnings=0, skipped=0,
+            passed=total - fails - errors))
+
+    def test_plone(self):
+        self.assertStats("Running layer\n"
+                         "Ran 24 tests with 1 failures and 2 errors in 0.009 seconds\n"
+                         "Ran 6 tests with 0 failures and 1 errors in 0.003 seconds\n", 30, 1, 3)
+
+    def test_trial(self):
+        self.assertStats("Ran 16 tests in 0.3s\n\nPASSED (successes=16)\n", 0)
+        self.assertStats("Ran 16 tests in 0.3s\n\nFAILED (errors=5)\n", 16)
+
+    def test_nose(self):
+        text = "\n".join([
+            "=" * 70,
+            "ERROR: test_bar (tests.Bar)",
+            "-" * 70,
+            "=" * 70,
+            "FAIL: test_foo (tests.Foo)",
+            "-" * 70,
+            "Ran 424 tests in 152.927s",
+            "",
+            "OK"])
+        self.assertStats(text, 424, 1, 1)
+
+    def test_no_tests(self):
+        self.assertEqual(self.parse("make: Nothing to be done for 'all'.\n"), None)
+
+    def test_stderr(self):
+        observer = create_steps.TestSummaryObserver()
+        observer.errReceived("Ran 3 tests in 0.1s\n\nOK\n")
+        self.assertEqual(observer.getStatistics()['total'], 3)
+
+
+class FakeSetupBuild(object):
+
+    def __init__(self):
+        self.steps = []
+
+    def addStepsAfterLastStep(self, steps):
+        self.steps.extend(steps)
+
+
+class BatchedStepsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.step = create_steps.TravisSetupSteps()
+        self.step.build = FakeSetupBuild()
+
+    def test_batch(self):
+        self.step.addBatchedSteps("install", [
+            "pip install a", "pip install b", dict(title="c", cmd="pip install c"),
+            "pip install d", "pip install e", "pip install f"])
+        steps = self.step.build.steps
+        self.assertEqual([step.name for step in steps],
+                         ["install (2 commands)", "c", "install (3 commands)"])
+        self.assertEqual(steps[0].batchTitles, ["pip install a", "pip install b"])
+        self.assertEqual(steps[0].command[:2], ["bash", "-c"])
+        self.assertEqual(steps[0].command[3:], ["bash", "pip install a", "pip install b"])
+
+    def test_single_command(self):
+        self.step.addBatchedSteps("script", ["make check"])
+        steps = self.step.build.steps
+        self.assertEqual(len(steps), 1)
+        self.assertEqual(steps[0].batchTitles, None)
+
+    def test_failed_command(self):
+        self.step.addBatchedSteps("install", ["pip install a", "pip install b\n# retry"])
+        observer = self.step.build.steps[0].batch
+        observer.outReceived("=== [1/2] pip install a\n=== [2/2] pip install b\n"
+                             "No matching distribution found for b\n"
+                             "=== [2/2] failed with exit code 1\n")
+        self.assertEqual(observer.failed, 1)
+        self.assertEqual(self.step.build.steps[0].batchTitles[observer.failed], "pip install b")
+
+
+class VirtualEnvCacheTestCase(unittest.TestCase):
+
+    def test_no_cache(self):
+        command = create_steps.SetupVirtualEnv("2.7").buildCommand()
+        self.assertIn('virtualenv -p $PYTHON "$VE"', command)
+        self.assertIn("pip install -U pip", command)
+
+    def test_cache(self):
+        cache = create_steps.VirtualEnvCache(path="~/venv cache", max_size=1.5,
+                                             requirements=["requirements*.txt", "dev.txt"])
+        command = create_steps.SetupVirtualEnv("3.6", cache=cache).buildCommand()
+        self.assertIn("PYTHON='python3.6'", command)
+        self.assertIn("CACHE=\"$HOME\"/'venv cache'", command)
+        self.assertIn("for f in requirements*.txt dev.txt; do", command)
+        self.assertIn('[ "$total" -gt 1536 ]', command)
+        # the pip upgrade is part of the creation of the cached virtualenv
+        self.assertEqual(command.count("pip install -U pip"), 1)
+        self.assertTrue(command.index("pip install -U pip") <
+                        command.index('if ! test -e "$ENTRY"'))
+        # the cache is copied, not linked, and renamed before it is removed
+        self.assertNotIn("cp -al", command)
+        self.assertIn('cp -a --reflink=auto "$ENTRY/venv" "$VE"', command)
+        self.assertIn('mv "$entry" "$trash/" && rm -rf "$trash"', command)
+
+    def test_shell_path(self):
+        self.assertEqual(create_steps.shellPath("/var/cache"), "/var/cache")
+        self.assertEqual(create_steps.shellPath("~/.cache"), '"$HOME"/.cache')
+        self.assertEqual(create_steps.shellPath("$(rm -rf /)"), "'$(rm -rf /)'")
@@ -0,0 +1,66 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from datetime import datetime
+
+from dateutil.tz import tzutc
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from buildbot.process.properties import Properties
+from buildbot_travis.throttle import MAX_PARALLEL_JOBS_PROPERTY, JobThrottle, prioritizeBuilders
+
+
+class FakeBuilder(object):
+
+    def __init__(self, name, building=0, oldest=None):
+        self.name = name
+        self.building = [None] * building
+        self.oldest = oldest
+
+    def getOldestRequestTime(self):
+        return defer.succeed(self.oldest)
+
+
+class FakeBuildRequest(object):
+
+    def __init__(self, **props):
+        self.properties = Properties(**props)
+
+
+class JobThrottleTestCase(unittest.TestCase):
+
+    def test_no_limit(self):
+        throttle = JobThrottle()
+        self.assertTrue(throttle(FakeBuilder("job", 100), None, FakeBuildRequest()))
+
+    def test_project_limit(self):
+        throttle = JobThrottle(2)
+        self.assertTrue(throttle(FakeBuilder("job", 1), None, FakeBuildRequest()))
+        self.assertFalse(throttle(FakeBuilder("job", 2), None, FakeBuildRequest()))
+
+    def test_travis_yml_limit(self):
+        throttle = JobThrottle(4)
+        breq = FakeBuildRequest(**{MAX_PARALLEL_JOBS_PROPERTY: 2})
+        self.assertFalse(throttle(FakeBuilder("job", 2), None, breq))
+        breq = FakeBuildRequest(**{MAX_PARALLEL_JOBS_PROPERTY: 8})
+        self.assertTrue(throttle(FakeBuilder("job", 3), None, breq))
+        self.assertFalse(throttle(FakeBuilder("job", 4), None, breq))
+        self.assertFalse(JobThrottle()(FakeBuilder("job", 8), None, breq))
+
+    def test_compare(self):
+        self.assertEqual(JobThrottle(2), JobThrottle(2))
+        self.assertNotEqual(JobThrottle(2), JobThrottle(3))
+
+
+class PrioritizeBuildersTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def test_fair_share(self):
+        old = datetime(2020, 1, 1, tzinfo=tzutc())
+        new = datetime(2020, 1, 2, tzinfo=tzutc())
+        builders = [FakeBuilder("big", 10, old), FakeBuilder("small", 1, new),
+                    FakeBuilder("idle", 0, None), FakeBuilder("other", 1, old)]
+        res = yield prioritizeBuilders(None, builders)
+        self.assertEqual([b.name for b in res], ["idle", "other", "small", "big"])
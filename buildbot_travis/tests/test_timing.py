@@ -0,0 +1,150 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import datetime
+import os
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from buildbot.db.connector import DBConnector
+from buildbot.process.results import SKIPPED, SUCCESS
+from buildbot.test.fake import fakemaster
+from buildbot.util import UTC, epoch2datetime
+from buildbot_travis import timing
+
+RUNS = [["virtualenv", 1], ["install", 2], ["script", 1]]
+
+
+def makeStep(number, started, complete, results=SUCCESS):
+    return dict(number=number, started_at=epoch2datetime(started),
+                complete_at=epoch2datetime(complete), results=results)
+
+
+STEPS = [
+    makeStep(0, 1010, 1011),
+    makeStep(1, 1011, 1015),
+    makeStep(2, 1015, 1016),
+    makeStep(3, 1016, 1046),
+    makeStep(4, 1046, 1050),
+    makeStep(5, 1050, 1050, results=SKIPPED),
+    makeStep(6, 1050, 1110),
+]
+
+
+class PhaseTimesTestCase(unittest.TestCase):
+
+    def test_compress(self):
+        self.assertEqual(timing.compressPhases(
+            ["virtualenv", "install", "install", "script"]), RUNS)
+        self.assertEqual(timing.compressPhases([]), [])
+
+    def test_times(self):
+        times = timing.phaseTimes(STEPS, 3, RUNS)
+        self.assertEqual(times, {
+            "setup": 6,
+            "virtualenv": 30,
+            "install": 4,
+            "script": 60,
+        })
+
+    def test_queue_time(self):
+        build = dict(started_at=epoch2datetime(1010))
+        self.assertEqual(timing.queueTime(build, dict(submitted_at=epoch2datetime(1000))), 10)
+        self.assertEqual(timing.queueTime(build, dict(submitted_at=epoch2datetime(1020))), 0)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(timing.percentile(values, 50), 50)
+        self.assertEqual(timing.percentile(values, 99), 99)
+        self.assertEqual(timing.percentile([3], 90), 3)
+
+
+class PhaseHistoryTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        basedir = os.path.abspath(self.mktemp())
+        os.makedirs(basedir)
+        self.master = master = fakemaster.make_master(None, wantRealReactor=True)
+        master.config.db['db_url'] = "sqlite:///" + os.path.join(basedir, "state.sqlite")
+        master.db = DBConnector(basedir)
+        yield master.db.setServiceParent(master)
+        yield master.db.setup(check_version=False)
+        yield master.db.model.upgrade()
+        self.history = timing.PhaseHistory()
+        self.history.parent = master
+        self.history.locks = {}
+        self.properties = {}
+        master.data = self
+
+    def get(self, path):
+        if path[-1] == 'properties':
+            return defer.succeed(self.properties)
+        if path[-1] == 'steps':
+            return defer.succeed(STEPS)
+        return defer.succeed(dict(submitted_at=datetime.datetime(1970, 1, 1, 0, 16, 40,
+                                                                 tzinfo=UTC)))
+
+    def tearDown(self):
+        return self.master.db.pool.shutdown()
+
+    @defer.inlineCallbacks
+    def finishBuild(self, label):
+        self.properties = {
+            timing.PHASES_PROPERTY: ([3, RUNS], "setup-steps"),
+            "project": ("buildbot_travis", "Build"),
+            "matrix_label": (label, "spawner"),
+        }
+        yield self.history.buildFinished(None, dict(buildid=5, buildrequestid=4,
+                                                    started_at=epoch2datetime(1010)))
+
+    @defer.inlineCallbacks
+    def test_history(self):
+        for i in range(3):
+            yield self.finishBuild("python:2.7")
+        yield self.finishBuild("python:3.6")
+        durations = yield timing.getPhaseDurations(self.master, project="buildbot_travis",
+                                                   label="python:2.7")
+        self.assertEqual(len(durations), 1)
+        self.assertEqual(sorted(durations[0]['phases']),
+                         ["install", "script", "setup", "virtualenv"])
+        self.assertEqual(durations[0]['phases']['script'], dict(
+            count=3, wall=dict(p50=60, p90=60, p99=60)))
+        # once per build, not per phase
+        self.assertEqual(durations[0]['queue'], dict(p50=10, p90=10, p99=10))
+        self.assertEqual(durations[0]['count'], 3)
+
+        durations = yield timing.getPhaseDurations(self.master)
+        self.assertEqual([(d['label'], d['count']) for d in durations],
+                         [("python:2.7", 3), ("python:3.6", 1)])
+        durations = yield timing.getPhaseDurations(self.master, project="other")
+        self.assertEqual(durations, [])
+
+    @defer.inlineCallbacks
+    def test_history_size(self):
+        self.patch(timing, "HISTORY_SIZE", 2)
+        for i in range(3):
+            yield self.finishBuild("")
+        durations = yield timing.getPhaseDurations(self.master)
+        self.assertEqual(durations[0]['count'], 2)
+        self.assertEqual(set(p['count'] for p in durations[0]['phases'].values()), set([2]))
+
+    @defer.inlineCallbacks
+    def test_concurrent_builds(self):
+        # the builds of a label finish at the same time, none of them is lost
+        times = timing.phaseTimes(STEPS, 3, RUNS)
+        yield defer.gatherResults(
+            [self.history.addTimes("buildbot_travis", label, times, 10)
+             for label in ["python:2.7"] * 5 + ["python:3.6"] * 3])
+        durations = yield timing.getPhaseDurations(self.master)
+        self.assertEqual(set((d['label'], d['count']) for d in durations),
+                         set([("python:2.7", 5), ("python:3.6", 3)]))
+        self.assertEqual(self.history.locks, {})
+
+    @defer.inlineCallbacks
+    def test_not_travis_job(self):
+        yield self.history.buildFinished(None, dict(buildid=5, buildrequestid=4))
+        durations = yield timing.getPhaseDurations(self.master)
+        self.assertEqual(durations, [])
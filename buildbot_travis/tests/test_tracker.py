@@ -0,0 +1,193 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from collections import namedtuple
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from buildbot.process.results import CANCELLED, FAILURE, SUCCESS
+from buildbot_travis import tracker
+from buildbot_travis.tracker import MATRIX_RESULTS_PROPERTY, MatrixTracker
+
+Child = namedtuple("Child", "complete results allow_failure")
+Child.__new__.__defaults__ = (False, )
+
+
+class FakeData(object):
+
+    def __init__(self):
+        self.updates = self
+        self.builds = {}
+        self.properties = {}
+        self.finished = []
+        self.state_strings = {}
+
+    def get(self, path):
+        if path[0] == 'builders':
+            return defer.succeed(dict(builderid=path[1], name={1: "spawner"}.get(path[1], "job")))
+        if len(path) == 3:
+            return defer.succeed(dict(self.properties.get(path[1], {})))
+        build = self.builds.get(path[1])
+        return defer.succeed(dict(build) if build is not None else None)
+
+    def findBuilderId(self, name):
+        return defer.succeed({"spawner": 1, "spawner-job": 2}[name])
+
+    def setBuildStateString(self, buildid, state_string):
+        self.state_strings[buildid] = state_string
+        return defer.succeed(None)
+
+    def setBuildProperty(self, buildid, name, value, source):
+        self.properties.setdefault(buildid, {})[name] = (value, source)
+        return defer.succeed(None)
+
+    def finishBuild(self, buildid, results):
+        self.finished.append((buildid, results))
+        return defer.succeed(None)
+
+
+class FakeBuildsets(object):
+
+    def __init__(self):
+        self.buildsets = self
+
+    def getBuildset(self, bsid):
+        return defer.succeed(dict(bsid=bsid, parent_buildid=bsid // 10))
+
+
+class FakeMQ(object):
+
+    def __init__(self):
+        self.produced = []
+
+    def produce(self, routingKey, data):
+        self.produced.append((routingKey, data))
+
+
+class FakeMaster(object):
+
+    def __init__(self):
+        self.data = FakeData()
+        self.db = FakeBuildsets()
+        self.mq = FakeMQ()
+        self.master = self
+
+
+class MatrixTrackerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tracker = MatrixTracker(["spawner"])
+        self.tracker.reconfigService(["spawner"])
+        self.tracker.parent = self.master = FakeMaster()
+        self.tracker.lock = defer.DeferredLock()
+        self.children = {}
+        self.tracker.getChildBuildsets = lambda buildid: defer.succeed(
+            self.children.get(buildid, []))
+        self.master.data.builds[10] = dict(buildid=10, builderid=1, complete=True, results=SUCCESS)
+        self.master.data.builds[11] = dict(buildid=11, builderid=2, complete=True, results=FAILURE)
+
+    def assertReported(self, *reports):
+        self.assertEqual([(key, build['buildid'], build['results'])
+                          for key, build in self.master.mq.produced],
+                         [(('builds', str(buildid), 'matrix_finished'), buildid, results)
+                          for buildid, results in reports])
+        for buildid, results in reports:
+            self.assertEqual(self.master.data.properties[buildid][MATRIX_RESULTS_PROPERTY],
+                             (results, "MatrixTracker"))
+        # the spawner builds are never finished again
+        self.assertEqual(self.master.data.finished, [])
+
+    @defer.inlineCallbacks
+    def test_pending(self):
+        self.children[10] = [Child(1, SUCCESS), Child(0, None)]
+        yield self.tracker.buildsetComplete(None, dict(bsid=100))
+        self.assertReported()
+
+    @defer.inlineCallbacks
+    def test_complete(self):
+        self.children[10] = [Child(1, SUCCESS), Child(1, FAILURE)]
+        yield self.tracker.buildsetComplete(None, dict(bsid=100))
+        self.assertReported((10, FAILURE))
+        self.assertEqual(self.master.data.state_strings[10], u"2 matrix jobs: failure")
+
+    @defer.inlineCallbacks
+    def test_reported_once(self):
+        self.children[10] = [Child(1, SUCCESS), Child(1, SUCCESS)]
+        yield self.tracker.buildsetComplete(None, dict(bsid=100))
+        yield self.tracker.buildsetComplete(None, dict(bsid=101))
+        yield self.tracker.buildFinished(None, dict(buildid=10, builderid=1))
+        self.assertReported((10, SUCCESS))
+
+    @defer.inlineCallbacks
+    def test_allow_failures(self):
+        self.children[10] = [Child(1, SUCCESS), Child(1, FAILURE, True)]
+        yield self.tracker.buildsetComplete(None, dict(bsid=100))
+        self.assertReported((10, SUCCESS))
+
+    @defer.inlineCallbacks
+    def test_fast_finish(self):
+        self.children[10] = [Child(1, FAILURE), Child(1, CANCELLED)]
+        yield self.tracker.buildsetComplete(None, dict(bsid=100))
+        self.assertReported((10, FAILURE))
+
+    @defer.inlineCallbacks
+    def test_cancelled(self):
+        self.children[10] = [Child(1, SUCCESS), Child(1, CANCELLED)]
+        yield self.tracker.buildsetComplete(None, dict(bsid=100))
+        self.assertReported((10, CANCELLED))
+
+    @defer.inlineCallbacks
+    def test_jobs_done_before_spawner(self):
+        self.children[10] = [Child(1, SUCCESS)]
+        self.master.data.builds[10]['complete'] = False
+        yield self.tracker.buildsetComplete(None, dict(bsid=100))
+        self.assertReported()
+        self.master.data.builds[10]['complete'] = True
+        yield self.tracker.buildFinished(None, dict(buildid=10, builderid=1))
+        self.assertReported((10, SUCCESS))
+
+    @defer.inlineCallbacks
+    def test_no_jobs(self):
+        self.master.data.builds[10]['results'] = FAILURE
+        yield self.tracker.buildFinished(None, dict(buildid=10, builderid=1))
+        self.assertReported((10, FAILURE))
+        self.assertEqual(self.master.data.state_strings[10], u"0 matrix jobs: failure")
+
+    @defer.inlineCallbacks
+    def test_untracked_builder(self):
+        self.children[11] = [Child(1, SUCCESS)]
+        yield self.tracker.buildsetComplete(None, dict(bsid=110))
+        yield self.tracker.buildFinished(None, dict(buildid=11, builderid=2))
+        self.assertReported()
+
+
+class MatrixStartEndStatusGeneratorTestCase(unittest.TestCase):
+
+    if tracker.BuildStartEndStatusGenerator is None:
+        skip = "buildbot < 2.10 has no report generators"
+
+    def setUp(self):
+        self.master = FakeMaster()
+        self.generator = tracker.MatrixStartEndStatusGenerator(["spawner"])
+        self.generated = []
+
+        def generate(generator, master, reporter, key, build):
+            self.generated.append((key[2], build['builderid']))
+            return defer.succeed({})
+        self.patch(tracker.BuildStartEndStatusGenerator, "generate", generate)
+
+    @defer.inlineCallbacks
+    def test_spawner(self):
+        build = dict(buildid=10, builderid=1)
+        for event in ('new', 'finished', 'matrix_finished'):
+            yield self.generator.generate(self.master, None, ('builds', '10', event), build)
+        self.assertEqual(self.generated, [('new', 1), ('matrix_finished', 1)])
+
+    @defer.inlineCallbacks
+    def test_job(self):
+        build = dict(buildid=11, builderid=2)
+        for event in ('new', 'finished'):
+            yield self.generator.generate(self.master, None, ('builds', '11', event), build)
+        self.assertEqual(self.generated, [('new', 2), ('finished', 2)])
@@ -16,11 +16,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import textwrap
+
 import yaml
 from twisted.trial import unittest
 
 from buildbot.plugins import steps, util
-from buildbot_travis.travisyml import TravisYml, TravisYmlInvalid
+from buildbot_travis import travisyml
+from buildbot_travis.travisyml import TravisYml, TravisYmlCache, TravisYmlInvalid
 
 
 class TravisYmlTestCase(unittest.TestCase):
@@ -83,12 +86,102 @@ class TestYamlParsing(TravisYmlTestCase):
             - !CMake [ tar:get ]
         """)
 
+    def test_with_unknown_step(self):
+        self.assertRaises(TravisYmlInvalid, self.t.parse, """
+        language: python
+        script:
+            - !NoSuchStep target
+        """)
+
+    def test_with_lazy_plugin_step(self):
+        self.t.parse("""
+        language: python
+        script:
+            - !ShellSequence
+                commands: []
+        """)
+        self.assertIsInstance(self.t.script[0], steps.ShellSequence)
+        self.assertIn(u'!ShellSequence', travisyml.TravisLoader.yaml_constructors)
+
     def test_yaml_not_polluted(self):
         """yaml.load should not recognise Interpolate contruct"""
         self.assertRaises(yaml.constructor.ConstructorError, yaml.load, """
             - !i foo
             """)
 
+
+class TestLoaders(unittest.TestCase):
+
+    def test_same_result(self):
+        yml = """
+        script:
+          - !i echo %(prop:foo)s
+          - step: !ShellCommand
+                command: "true"
+        """
+        results = [yaml.load(yml, Loader=loader)
+                   for loader in (travisyml.TravisLoader, travisyml.PureTravisLoader)]
+        self.assertEqual(results[0]['script'][0], results[1]['script'][0])
+        self.assertEqual(type(results[0]['script'][1]['step']),
+                         type(results[1]['script'][1]['step']))
+
+    def test_accelerated(self):
+        if not yaml.__with_libyaml__:
+            raise unittest.SkipTest("libyaml is not available")
+        self.assertTrue(issubclass(travisyml.TravisLoader, yaml.CSafeLoader))
+
+
+class TestParseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = TravisYmlCache(maxsize=2)
+
+    def test_hit(self):
+        yml = "language: python\nscript: echo ok\n"
+        c1 = self.cache.parse(yml)
+        c2 = self.cache.parse(yml)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(c2.script, ["echo ok"])
+        self.assertIs(c1, c2)
+
+    def test_read_only(self):
+        yml = "language: python\nenv: [FOO=1, FOO=2]\n"
+        c1 = self.cache.parse(yml)
+        self.assertRaises(AttributeError, setattr, c1, "matrix", [])
+        self.assertEqual(len(self.cache.parse(yml).matrix), 2)
+
+    def test_regexes(self):
+        # the compiled regexes are shared, not copied
+        yml = textwrap.dedent("""\
+            language: python
+            branches:
+              only: [/^release-.*$/]
+            env: [FOO=1]
+            matrix:
+              paths:
+                - env: FOO=1
+                  paths: [docs/*]
+            """)
+        c1 = self.cache.parse(yml)
+        c2 = self.cache.parse(yml)
+        self.assertTrue(c2.can_build_branch("release-1.0"))
+        self.assertIs(c1.branch_matcher, c2.branch_matcher)
+
+    def test_lru(self):
+        ymls = ["language: %s\n" % lang for lang in ("c", "python", "java")]
+        for yml in ymls:
+            self.cache.parse(yml)
+        self.assertEqual(len(self.cache), 2)
+        self.cache.parse(ymls[0])
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 4))
+        self.cache.parse(ymls[2])
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_invalid_not_cached(self):
+        self.assertRaises(TravisYmlInvalid, self.cache.parse, "script: true\n")
+        self.assertEqual(len(self.cache), 0)
+
+
 class TestEnv(TravisYmlTestCase):
 
     def test_noenv(self):
@@ -179,6 +272,197 @@ class TestMatrix(TravisYmlTestCase):
             dict(python="python2.6", env=dict(FOO='2', BAR='1')),
         ])
 
+    def test_exclude_consecutive(self):
+        self.t.config["env"] = ["FOO=1 BAR=2", "FOO=1 BAR=3", "FOO=2 BAR=1"]
+        m = self.t.config["matrix"] = {}
+        m['exclude'] = [dict(env="FOO=1")]
+
+        self.t.parse_envs()
+        self.t.parse_matrix()
+
+        self.assertEqual(self.t.matrix, [
+            dict(python="python2.6", env=dict(FOO='2', BAR='1')),
+        ])
+
+    def test_exclude_large(self):
+        self.t.config["env"] = ["FOO=%d BAR=%d" % (i, i % 10) for i in range(5000)]
+        m = self.t.config["matrix"] = {}
+        m['exclude'] = [dict(env="FOO=%d" % i) for i in range(0, 5000, 2)]
+        m['exclude'].append(dict(python="python2.6", env="BAR=1"))
+
+        self.t.parse_envs()
+        self.t.parse_matrix()
+
+        self.assertEqual(len(self.t.matrix), 2000)
+
+    def test_include_duplicate(self):
+        self.t.config["env"] = ["FOO=1 BAR=2", "FOO=2 BAR=1"]
+        m = self.t.config["matrix"] = {}
+        m['include'] = [dict(python="python2.6", env="BAR=2 FOO=1"),
+                        dict(python="python2.7", env="BAR=2 FOO=1"),
+                        dict(python="python2.7", env="BAR=2 FOO=1")]
+
+        self.t.parse_envs()
+        self.t.parse_matrix()
+
+        self.assertEqual(self.t.matrix, [
+            dict(python="python2.6", env=dict(FOO='1', BAR='2')),
+            dict(python="python2.6", env=dict(FOO='2', BAR='1')),
+            dict(python="python2.7", env=dict(FOO='1', BAR='2')),
+        ])
+
+    def test_axes(self):
+        self.t.config["env"] = ["FOO=1"]
+        self.t.config["python"] = "python2.7"
+        self.t.config["compiler"] = ["gcc", "clang"]
+        self.t.config["os"] = ["linux", "osx"]
+        m = self.t.config["matrix"] = {}
+        m['exclude'] = [dict(compiler="clang", os="linux")]
+        m['include'] = [dict(python="python2.7", compiler="gcc", os="osx", env="FOO=1"),
+                        dict(python="python2.7", compiler="icc", os="linux", env="FOO=1")]
+
+        self.t.parse_envs()
+        self.t.parse_matrix()
+
+        self.assertEqual(self.t.matrix, [
+            dict(python="python2.7", compiler="gcc", os="linux", env=dict(FOO='1')),
+            dict(python="python2.7", compiler="gcc", os="osx", env=dict(FOO='1')),
+            dict(python="python2.7", compiler="clang", os="osx", env=dict(FOO='1')),
+            dict(python="python2.7", compiler="icc", os="linux", env=dict(FOO='1')),
+        ])
+
+    def test_custom_axes(self):
+        self.t.config["env"] = ["FOO=1"]
+        self.t.config["arch"] = ["x86", "arm"]
+        self.t.config["matrix"] = {'axes': ["arch"]}
+
+        self.t.parse_envs()
+        self.t.parse_matrix()
+
+        self.assertEqual(self.t.matrix, [
+            dict(python="python2.6", arch="x86", env=dict(FOO='1')),
+            dict(python="python2.6", arch="arm", env=dict(FOO='1')),
+        ])
+
+    def test_lazy(self):
+        # 6**6 cells, they are never all generated
+        for axis in ("python", "compiler", "os", "image", "jdk"):
+            self.t.config[axis] = [axis + str(i) for i in range(6)]
+        self.t.config["env"] = ["FOO=%d" % i for i in range(6)]
+        m = self.t.config["matrix"] = {}
+        m['exclude'] = [dict(python="python%d" % i) for i in range(1, 6)]
+        m['exclude'] += [dict(compiler="compiler%d" % i) for i in range(1, 6)]
+
+        self.t.parse_envs()
+        self.t.parse_matrix()
+
+        first = next(iter(self.t.matrix))
+        self.assertEqual(first, dict(python="python0", compiler="compiler0", os="os0",
+                                     image="image0", jdk="jdk0", env=dict(FOO='0')))
+        self.assertEqual(len(self.t.matrix), 6 ** 4)
+        matrix = self.t.matrix.filter(lambda cell: cell["os"] == "os1")
+        self.assertEqual(len(matrix), 6 ** 3)
+        self.assertEqual(len(self.t.matrix), 6 ** 4)
+
+    def test_not_kept(self):
+        self.t.config["python"] = ["2.7", "3.6"]
+        self.t.config["env"] = ["FOO=1", "FOO=2"]
+        self.t.config["matrix"] = {
+            'exclude': [dict(python="2.7", env="FOO=1")],
+            'include': [dict(python="3.7", env="FOO=1")],
+        }
+
+        self.t.parse_envs()
+        self.t.parse_matrix()
+
+        generated = []
+        product = self.t.matrix._product
+
+        def countingProduct(depth, cell, matched):
+            if depth == 0:
+                generated.append(cell)
+            return product(depth, cell, matched)
+        self.patch(self.t.matrix, "_product", countingProduct)
+        # len() counts the cells without generating them
+        self.assertEqual(len(self.t.matrix), 4)
+        self.assertEqual(generated, [])
+        self.assertEqual(len(list(self.t.matrix)), 4)
+        self.assertEqual(len(list(self.t.matrix)), 4)
+        self.assertEqual(len(generated), 2)
+
+    def test_unhashable(self):
+        self.t.config["env"] = ["FOO=1"]
+
+        self.t.parse_envs()
+        self.t.parse_matrix()
+
+        self.assertRaises(TypeError, hash, self.t.matrix)
+
+    def test_exclude_all(self):
+        self.t.config["env"] = ["FOO=1"]
+        self.t.config["matrix"] = {'exclude': [{}]}
+
+        self.t.parse_envs()
+        self.t.parse_matrix()
+
+        self.assertFalse(self.t.matrix)
+        self.assertEqual(self.t.matrix, [])
+
+    def test_allow_failures(self):
+        self.t.config["env"] = {'global': "CI=true", 'matrix': ["FOO=1", "FOO=2"]}
+        self.t.config["python"] = ["2.7", "3.6"]
+        m = self.t.config["matrix"] = {}
+        m['allow_failures'] = [dict(python="3.6", env="FOO=2")]
+
+        self.t.parse_envs()
+        self.t.parse_matrix()
+
+        allowed = [cell for cell in self.t.matrix if self.t.allows_failure(cell)]
+        self.assertEqual(allowed, [dict(python="3.6", env=dict(FOO='2', CI='true'))])
+        self.assertEqual(self.t.fast_finish, None)
+
+    def test_fast_finish(self):
+        self.t.config["matrix"] = {'fast_finish': True}
+        self.t.parse_envs()
+        self.t.parse_matrix()
+        self.assertEqual(self.t.fast_finish, True)
+
+        self.t.config["matrix"] = {'fast_finish': "yes"}
+        self.assertRaises(TravisYmlInvalid, self.t.parse_matrix)
+
+    def test_paths(self):
+        self.t.config["env"] = {'global': "CI=true", 'matrix': ["COMPONENT=web", "COMPONENT=db"]}
+        m = self.t.config["matrix"] = {}
+        m['paths'] = [dict(env="COMPONENT=web", paths=["web/*", "common/*"]),
+                      dict(env="COMPONENT=db", paths="db/*")]
+        m['include'] = [dict(python="python2.6", env="COMPONENT=docs", paths=["docs/*"]),
+                        dict(python="python2.6", env="COMPONENT=all")]
+
+        self.t.parse_envs()
+        self.t.parse_matrix()
+
+        def affected(files):
+            predicate = self.t.paths.predicate(files)
+            return [cell['env']['COMPONENT'] for cell in self.t.matrix if predicate(cell)]
+
+        self.assertEqual(affected(["web/index.html"]), ["web", "all"])
+        self.assertEqual(affected(["db/schema.sql", "docs/index.rst"]), ["db", "docs", "all"])
+        self.assertEqual(affected(["common/a/b.py"]), ["web", "all"])
+        self.assertEqual(affected(["README"]), ["all"])
+        # paths are not part of the cells
+        self.assertNotIn("paths", list(self.t.matrix)[2])
+
+    def test_no_paths(self):
+        self.t.parse_envs()
+        self.t.parse_matrix()
+        self.assertFalse(self.t.paths)
+
+    def test_invalid_paths(self):
+        for paths in ([], [1], {"web": "*"}):
+            self.t.config["matrix"] = {'paths': [dict(env="FOO=1", paths=paths)]}
+            self.t.parse_envs()
+            self.assertRaises(TravisYmlInvalid, self.t.parse_matrix)
+
     def test_include(self):
         self.t.config["env"] = ["FOO=1 BAR=2", "FOO=2 BAR=1"]
         m = self.t.config["matrix"] = {}
@@ -255,6 +539,28 @@ class TestBranches(TravisYmlTestCase):
         self.assertEqual(
             self.t.can_build_branch("deploy-cool-regex"), True)
 
+    def test_whitelist_regexes(self):
+        self.t.config["branches"] = {"only": ['/^deploy-.*$/', '/-stable$/', '/(?i)^RELEASE/']}
+        self.t.parse_branches()
+        self.assertEqual(self.t.can_build_branch("deploy-cool-regex"), True)
+        self.assertEqual(self.t.can_build_branch("1.0-stable"), True)
+        self.assertEqual(self.t.can_build_branch("release-1.0"), True)
+        self.assertEqual(self.t.can_build_branch("1.0-stable-fix"), False)
+        self.assertEqual(self.t.branch_matcher.memo, {
+            "deploy-cool-regex": True, "1.0-stable": True, "release-1.0": True,
+            "1.0-stable-fix": False})
+
+    def test_whitelist_regex_backreference(self):
+        self.t.config["branches"] = {"only": ['/^(a+)-\\1$/', '/^(b+)-\\1$/']}
+        self.t.parse_branches()
+        self.assertEqual(self.t.can_build_branch("aa-aa"), True)
+        self.assertEqual(self.t.can_build_branch("bb-bb"), True)
+        self.assertEqual(self.t.can_build_branch("bb-aa"), False)
+
+    def test_invalid_regex(self):
+        self.t.config["branches"] = {"only": ['/[/']}
+        self.assertRaises(TravisYmlInvalid, self.t.parse_branches)
+
     def test_blacklist(self):
         self.t.config["branches"] = {"except": ['master']}
         self.t.parse_branches()
@@ -276,6 +582,78 @@ class TestBranches(TravisYmlTestCase):
             self.t.can_build_branch("feature-new-stuff"), False)
 
 
+class TestMaxParallelJobs(TravisYmlTestCase):
+
+    def test_default(self):
+        self.t.parse_max_parallel_jobs()
+        self.assertEqual(self.t.max_parallel_jobs, None)
+
+    def test_max_parallel_jobs(self):
+        self.t.config["max_parallel_jobs"] = 4
+        self.t.parse_max_parallel_jobs()
+        self.assertEqual(self.t.max_parallel_jobs, 4)
+
+    def test_invalid(self):
+        for value in (0, "4", True):
+            self.t.config["max_parallel_jobs"] = value
+            self.assertRaises(TravisYmlInvalid, self.t.parse_max_parallel_jobs)
+
+
+class TestBatchSteps(TravisYmlTestCase):
+
+    def test_default(self):
+        self.t.parse_batch_steps()
+        self.assertEqual(self.t.batch_steps, False)
+
+    def test_batch_steps(self):
+        self.t.config["batch_steps"] = True
+        self.t.parse_batch_steps()
+        self.assertEqual(self.t.batch_steps, True)
+
+    def test_invalid(self):
+        self.t.config["batch_steps"] = "yes please"
+        self.assertRaises(TravisYmlInvalid, self.t.parse_batch_steps)
+
+
+class TestCache(TravisYmlTestCase):
+
+    def test_default(self):
+        self.t.parse_cache()
+        self.assertEqual(self.t.cache, None)
+
+    def test_directories(self):
+        self.t.config["cache"] = dict(directories=["node_modules", "~/.m2"], key="pom.xml")
+        self.t.parse_cache()
+        self.assertEqual(self.t.cache, dict(directories=["node_modules", "~/.m2"],
+                                            key=["pom.xml"]))
+
+    def test_shorthand(self):
+        self.t.config["cache"] = "pip"
+        self.t.parse_cache()
+        self.assertEqual(self.t.cache, dict(directories=["~/.cache/pip"], key=[]))
+
+        self.t.config["cache"] = dict(pip=True, directories=".tox",
+                                      key=["requirements*.txt", "tox.ini"])
+        self.t.parse_cache()
+        self.assertEqual(self.t.cache, dict(directories=[".tox", "~/.cache/pip"],
+                                            key=["requirements*.txt", "tox.ini"]))
+
+    def test_unsupported_shorthand(self):
+        self.t.config["cache"] = ["bundler"]
+        self.t.parse_cache()
+        self.assertEqual(self.t.cache, None)
+
+    def test_invalid(self):
+        for cache in (dict(directories=[1]), dict(directories="x", key=dict(a=1)), 42):
+            self.t.config["cache"] = cache
+            self.assertRaises(TravisYmlInvalid, self.t.parse_cache)
+
+    def test_outside_directories(self):
+        for directory in ("/var/cache", "../cache", "~/../cache"):
+            self.t.config["cache"] = dict(directories=[directory])
+            self.assertRaises(TravisYmlInvalid, self.t.parse_cache)
+
+
 class TestMailNotifications(TravisYmlTestCase):
 
     def test_nomail(self):
@@ -0,0 +1,70 @@
+# Copyright 2012-2013 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from datetime import datetime
+
+from dateutil.tz import tzutc
+from twisted.internet import defer
+
+from buildbot.util import ComparableMixin
+
+# set by the spawner on the jobs, from the .travis.yml max_parallel_jobs
+MAX_PARALLEL_JOBS_PROPERTY = "max_parallel_jobs"
+
+
+class JobThrottle(ComparableMixin):
+
+    """
+    canStartBuild for the job builders: caps the number of jobs of a project
+    running at the same time.
+
+    The cap is the project's max_parallel_jobs, or the one of the .travis.yml
+    which triggered the job, whichever is lower.
+    """
+    compare_attrs = ('max_parallel_jobs', )
+
+    def __init__(self, max_parallel_jobs=None):
+        self.max_parallel_jobs = max_parallel_jobs
+
+    def getLimit(self, buildrequest):
+        limits = [self.max_parallel_jobs,
+                  buildrequest.properties.getProperty(MAX_PARALLEL_JOBS_PROPERTY)]
+        limits = [limit for limit in limits if limit]
+        if limits:
+            return min(limits)
+        return None
+
+    def __call__(self, builder, workerforbuilder, buildrequest):
+        limit = self.getLimit(buildrequest)
+        return limit is None or len(builder.building) < limit
+
+
+@defer.inlineCallbacks
+def prioritizeBuilders(master, builders):
+    """
+    Fair share between projects: the builders with the fewest running builds
+    come first, then the ones with the oldest request, like buildbot's default
+    ordering.
+    """
+    latest = datetime.max.replace(tzinfo=tzutc())
+    oldest = yield defer.gatherResults(
+        [defer.maybeDeferred(builder.getOldestRequestTime) for builder in builders])
+    keyed = [((len(builder.building), time or latest, builder.name), builder)
+             for time, builder in zip(oldest, builders)]
+    keyed.sort(key=lambda k: k[0])
+    defer.returnValue([builder for _, builder in keyed])
@@ -0,0 +1,190 @@
+# Copyright 2012-2013 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import math
+
+import sqlalchemy as sa
+from twisted.internet import defer
+from twisted.python import log
+
+from buildbot.process.results import SKIPPED
+from buildbot.util import datetime2epoch, service
+
+# set by TravisSetupSteps: [number of its first step, [[phase, number of steps], ...]]
+PHASES_PROPERTY = "travis_phases"
+# the steps before the generated ones: checkout, setup-steps, ...
+SETUP_PHASE = "setup"
+HISTORY_SIZE = 100
+
+STATE_NAME, STATE_CLASS = "TravisPhaseHistory", "PhaseHistory"
+
+
+def compressPhases(phases):
+    """ ["install", "install", "script"] -> [["install", 2], ["script", 1]] """
+    runs = []
+    for phase in phases:
+        if runs and runs[-1][0] == phase:
+            runs[-1][1] += 1
+        else:
+            runs.append([phase, 1])
+    return runs
+
+
+def stepPhases(first, runs):
+    """ {step number: phase} of the generated steps """
+    phases = {}
+    number = first
+    for phase, count in runs:
+        for i in range(count):
+            phases[number] = phase
+            number += 1
+    return phases
+
+
+def phaseTimes(steps, first, runs):
+    """ {phase: wall time} of a build: the time spent in the steps of each phase """
+    phases = stepPhases(first, runs)
+    times = {}
+    for step in sorted(steps, key=lambda s: s['number']):
+        if step['number'] < first:
+            phase = SETUP_PHASE
+        else:
+            phase = phases.get(step['number'])
+        if (phase is None or step['results'] == SKIPPED or step['started_at'] is None or
+                step['complete_at'] is None):
+            continue
+        wall = datetime2epoch(step['complete_at']) - datetime2epoch(step['started_at'])
+        times[phase] = times.get(phase, 0) + wall
+    return dict((phase, round(wall, 1)) for phase, wall in times.items())
+
+
+def queueTime(build, buildrequest):
+    """ time from the build request to the start of its build """
+    queue = datetime2epoch(build['started_at']) - datetime2epoch(buildrequest['submitted_at'])
+    return round(max(queue, 0), 1)
+
+
+def percentile(values, p):
+    """ nearest-rank percentile of sorted values """
+    rank = int(math.ceil(p / 100. * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def percentiles(values, ps):
+    """ {"p50": ..., ...} of values """
+    values = sorted(values)
+    return dict(("p%d" % p, percentile(values, p)) for p in ps)
+
+
+@defer.inlineCallbacks
+def getPhaseDurations(master, project=None, label=None, ps=(50, 90, 99)):
+    """
+    Percentiles of the queue times of the jobs, and of the wall times of their
+    phases, per project and matrix label
+    """
+    objectid = yield master.db.state.getObjectId(STATE_NAME, STATE_CLASS)
+
+    def thd(conn):
+        tbl = master.db.model.object_state
+        q = sa.select([tbl.c.name, tbl.c.value_json]).where(tbl.c.objectid == objectid)
+        return [(row.name, row.value_json) for row in conn.execute(q)]
+    rows = yield master.db.pool.do(thd)
+
+    durations = []
+    for name, value_json in sorted(rows):
+        row_project, row_label = json.loads(name)
+        if project is not None and row_project != project:
+            continue
+        if label is not None and row_label != label:
+            continue
+        history = json.loads(value_json)
+        queue = history.get("queue", [])
+        if not queue:
+            continue
+        phases = dict((phase, dict(count=len(samples), wall=percentiles(samples, ps)))
+                      for phase, samples in history.get("phases", {}).items())
+        durations.append(dict(project=row_project, label=row_label, count=len(queue),
+                              queue=percentiles(queue, ps), phases=phases))
+    defer.returnValue(durations)
+
+
+class PhaseHistory(service.BuildbotService):
+
+    """
+    Records the queue time of the jobs, and the time spent in each of their
+    phases (setup, virtualenv, cache, and the travis hooks), keeping the last
+    HISTORY_SIZE builds of each project and matrix label.
+    """
+    name = "TravisPhaseHistory"
+
+    @defer.inlineCallbacks
+    def startService(self):
+        yield service.BuildbotService.startService(self)
+        # the history of a project and label is read, then written back: the
+        # updates of each are serialized, {name: DeferredLock}
+        self.locks = {}
+        self.consumer = yield self.master.mq.startConsuming(
+            self.buildFinished, ('builds', None, 'finished'))
+
+    def stopService(self):
+        self.consumer.stopConsuming()
+        return service.BuildbotService.stopService(self)
+
+    @defer.inlineCallbacks
+    def buildFinished(self, key, build):
+        try:
+            properties = yield self.master.data.get(('builds', build['buildid'], 'properties'))
+            if PHASES_PROPERTY not in properties:
+                return
+            first, runs = properties[PHASES_PROPERTY][0]
+            project = properties.get("project", (None, None))[0]
+            if not project:
+                project = properties.get("buildername", (None, None))[0]
+            label = properties.get("matrix_label", (u"", None))[0]
+
+            steps = yield self.master.data.get(('builds', build['buildid'], 'steps'))
+            buildrequest = yield self.master.data.get(
+                ('buildrequests', build['buildrequestid']))
+            times = phaseTimes(steps, first, runs)
+            if times:
+                yield self.addTimes(project, label, times, queueTime(build, buildrequest))
+        except Exception:
+            log.err(None, "while recording the phase times of build {}".format(
+                build['buildid']))
+
+    @defer.inlineCallbacks
+    def addTimes(self, project, label, times, queue):
+        name = json.dumps([project, label])
+        lock = self.locks.setdefault(name, defer.DeferredLock())
+        try:
+            yield lock.run(self.updateHistory, name, times, queue)
+        finally:
+            if not lock.locked and not lock.waiting:
+                del self.locks[name]
+
+    @defer.inlineCallbacks
+    def updateHistory(self, name, times, queue):
+        objectid = yield self.master.db.state.getObjectId(STATE_NAME, STATE_CLASS)
+        # {"queue": [queue time, ...], "phases": {phase: [wall time, ...]}}
+        history = yield self.master.db.state.getState(objectid, name, {})
+        history["queue"] = (history.get("queue", []) + [queue])[-HISTORY_SIZE:]
+        phases = history.setdefault("phases", {})
+        for phase, wall in times.items():
+            phases[phase] = (phases.get(phase, []) + [wall])[-HISTORY_SIZE:]
+        yield self.master.db.state.setState(objectid, name, history)
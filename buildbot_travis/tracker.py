@@ -0,0 +1,191 @@
+# Copyright 2012-2013 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sqlalchemy as sa
+from twisted.internet import defer
+from twisted.python import log
+
+from buildbot.process.results import (CANCELLED, EXCEPTION, FAILURE, SUCCESS, statusToString,
+                                      worst_status)
+from buildbot.util import service
+
+from .steps.base import ALLOW_FAILURE_PROPERTY
+
+try:
+    from buildbot.reporters.generators.build import BuildStartEndStatusGenerator
+    from buildbot.reporters.message import MessageFormatterRenderable
+except ImportError:  # buildbot < 2.10, without the report generators
+    BuildStartEndStatusGenerator = None
+
+# set on a fire and track spawner build once its matrix jobs are all done
+MATRIX_RESULTS_PROPERTY = "matrix_results"
+# the event then produced for the spawner build, with the matrix results
+MATRIX_FINISHED_EVENT = "matrix_finished"
+
+
+class MatrixTracker(service.BuildbotService):
+
+    """
+    Collects the results of the matrix jobs triggered by the fire and track
+    spawners.
+
+    Those spawners finish as soon as the jobs are triggered, so that they release
+    their worker. Once all the jobs are complete, the worst of their results is
+    recorded in the matrix_results property of the spawner build, and reported
+    with a ('builds', buildid, 'matrix_finished') event.
+    The spawner build itself is never finished again.
+    """
+    name = "TravisMatrixTracker"
+
+    def checkConfig(self, builderNames):
+        pass
+
+    def reconfigService(self, builderNames):
+        self.builderNames = builderNames
+        self.builderids = None
+
+    @defer.inlineCallbacks
+    def startService(self):
+        yield service.BuildbotService.startService(self)
+        self.lock = defer.DeferredLock()
+        self.consumers = []
+        consumer = yield self.master.mq.startConsuming(
+            self.buildsetComplete, ('buildsets', None, 'complete'))
+        self.consumers.append(consumer)
+        consumer = yield self.master.mq.startConsuming(
+            self.buildFinished, ('builds', None, 'finished'))
+        self.consumers.append(consumer)
+
+    def stopService(self):
+        for consumer in self.consumers:
+            consumer.stopConsuming()
+        self.consumers = []
+        return service.BuildbotService.stopService(self)
+
+    @defer.inlineCallbacks
+    def getBuilderIds(self):
+        if self.builderids is None:
+            builderids = set()
+            for name in self.builderNames:
+                builderid = yield self.master.data.updates.findBuilderId(name)
+                builderids.add(builderid)
+            self.builderids = builderids
+        defer.returnValue(self.builderids)
+
+    @defer.inlineCallbacks
+    def buildsetComplete(self, key, buildset):
+        # the completion message does not tell the parent build
+        bsdict = yield self.master.db.buildsets.getBuildset(buildset['bsid'])
+        if bsdict is not None and bsdict['parent_buildid'] is not None:
+            yield self.lock.run(self.collectResults, bsdict['parent_buildid'])
+
+    @defer.inlineCallbacks
+    def buildFinished(self, key, build):
+        # the jobs might all be done before the spawner itself finishes
+        builderids = yield self.getBuilderIds()
+        if build['builderid'] in builderids:
+            yield self.lock.run(self.collectResults, build['buildid'])
+
+    def getChildBuildsets(self, buildid):
+        """ returns the (complete, results, allow_failure) of the jobs of the build """
+        def thd(conn):
+            tbl = self.master.db.model.buildsets
+            props_tbl = self.master.db.model.buildset_properties
+            allowed = sa.exists().where(sa.and_(
+                props_tbl.c.buildsetid == tbl.c.id,
+                props_tbl.c.property_name == ALLOW_FAILURE_PROPERTY))
+            q = sa.select([tbl.c.complete, tbl.c.results, allowed.label('allow_failure')])
+            q = q.where(tbl.c.parent_buildid == buildid)
+            return conn.execute(q).fetchall()
+        return self.master.db.pool.do(thd)
+
+    @defer.inlineCallbacks
+    def collectResults(self, buildid):
+        try:
+            builderids = yield self.getBuilderIds()
+            build = yield self.master.data.get(('builds', buildid))
+            if build is None or build['builderid'] not in builderids or not build['complete']:
+                return
+            properties = yield self.master.data.get(('builds', buildid, 'properties'))
+            if MATRIX_RESULTS_PROPERTY in properties:
+                # already collected
+                return
+            # without jobs (the spawner failed, or reused all of their results),
+            # the matrix results are the spawner's
+            children = yield self.getChildBuildsets(buildid)
+            if not all(child.complete for child in children):
+                return
+            results = build['results'] or SUCCESS
+            required = [child.results for child in children if not child.allow_failure]
+            # the jobs cancelled by fast_finish should not hide the failure
+            if FAILURE in required or EXCEPTION in required:
+                required = [r for r in required if r != CANCELLED]
+            for child_results in required:
+                results = worst_status(results, child_results)
+            yield self.master.data.updates.setBuildProperty(
+                buildid, MATRIX_RESULTS_PROPERTY, results, "MatrixTracker")
+            yield self.master.data.updates.setBuildStateString(
+                buildid, u"{} matrix jobs: {}".format(len(children), statusToString(results)))
+            build = yield self.master.data.get(('builds', buildid))
+            build['results'] = results
+            self.master.mq.produce(('builds', str(buildid), MATRIX_FINISHED_EVENT), build)
+        except Exception:
+            log.err(None, "while collecting the matrix results of build {}".format(buildid))
+
+
+if BuildStartEndStatusGenerator is not None:
+    class MatrixStartEndStatusGenerator(BuildStartEndStatusGenerator):
+
+        """
+        Reports the start and end of the builds, but with the matrix results in
+        place of the end of the fire and track spawner builds.
+        """
+        wanted_event_keys = BuildStartEndStatusGenerator.wanted_event_keys + [
+            ('builds', None, MATRIX_FINISHED_EVENT),
+        ]
+
+        compare_attrs = ['trackedBuilders']
+
+        def __init__(self, trackedBuilders, **kwargs):
+            super(MatrixStartEndStatusGenerator, self).__init__(**kwargs)
+            self.trackedBuilders = trackedBuilders
+
+        @defer.inlineCallbacks
+        def generate(self, master, reporter, key, build):
+            if key[2] == 'finished':
+                builder = yield master.data.get(('builders', build['builderid']))
+                if builder is not None and builder['name'] in self.trackedBuilders:
+                    # its jobs are still running
+                    defer.returnValue(None)
+            report = yield super(MatrixStartEndStatusGenerator, self).generate(
+                master, reporter, key, build)
+            defer.returnValue(report)
+
+
+def matrixStatusGenerators(trackedBuilders):
+    """
+    The generators of the build status reporters, or None when buildbot does
+    not have them: the fire and track spawners are then reported when they
+    finish, before their jobs.
+    """
+    if BuildStartEndStatusGenerator is None:
+        return None
+    return [MatrixStartEndStatusGenerator(
+        trackedBuilders,
+        start_formatter=MessageFormatterRenderable('Build started.'),
+        end_formatter=MessageFormatterRenderable('Build done.'))]
@@ -17,15 +17,30 @@ from __future__ import division
 from __future__ import print_function
 from future.utils import string_types
 
+import hashlib
 import re
+from collections import OrderedDict
 
 import yaml
 from buildbot.plugins import util
 from buildbot.plugins.db import get_plugins
 
+from .matrix import CellPaths, MatrixExcluder, TravisMatrix, cell_signature
+
 TRAVIS_HOOKS = ("before_install", "install", "after_install", "before_script",
                 "script", "after_script")
 
+# the directories of the travis cache shorthands, e.g. cache: pip
+CACHE_SHORTHANDS = {
+    "pip": ["~/.cache/pip"],
+    "ccache": ["~/.ccache"],
+    "npm": ["node_modules"],
+}
+
+# the keys crossed into the implicit build matrix, in nesting order (env is
+# always the innermost axis). More can be listed in matrix.axes
+MATRIX_AXES = ("python", "compiler", "os", "image", "jdk")
+
 
 class TravisYmlInvalid(Exception):
     pass
@@ -51,14 +66,75 @@ def interpolate_constructor(loader, node):
     return util.Interpolate(value)
 
 
-class TravisLoader(yaml.SafeLoader):
+class PureTravisLoader(yaml.SafeLoader):
     pass
 
-TravisLoader.add_constructor(u'!Interpolate', interpolate_constructor)
-TravisLoader.add_constructor(u'!i', interpolate_constructor)
 
+if getattr(yaml, '__with_libyaml__', False):
+    # libyaml is way faster on large configs
+    class TravisLoader(yaml.CSafeLoader):
+        pass
+else:
+    TravisLoader = PureTravisLoader
 
-def registerStepClass(name, step):
+
+def addConstructor(tag, constructor):
+    for loader in (TravisLoader, PureTravisLoader):
+        loader.add_constructor(tag, constructor)
+
+
+addConstructor(u'!Interpolate', interpolate_constructor)
+addConstructor(u'!i', interpolate_constructor)
+
+
+class TravisYmlCache(object):
+    """
+    Size bounded LRU cache of parsed TravisYml objects, keyed by the digest of
+    the raw yaml data.
+
+    The spawner and every job of its matrix parse the very same file, so we
+    only pay for the yaml parsing once. The parsed objects are shared between
+    the builds, so they are frozen: their attributes can't be set anymore.
+    """
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def digest(config_input):
+        if not isinstance(config_input, bytes):
+            config_input = config_input.encode("utf-8")
+        return hashlib.sha1(config_input).hexdigest()
+
+    def parse(self, config_input):
+        key = self.digest(config_input)
+        config = self._entries.pop(key, None)
+        if config is None:
+            self.misses += 1
+            config = TravisYml()
+            config.parse(config_input)
+            config.freeze()
+        else:
+            self.hits += 1
+        self._entries[key] = config
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return config
+
+    def clear(self):
+        self._entries.clear()
+
+
+parse_cache = TravisYmlCache()
+
+
+def makeStepConstructor(step):
     def step_constructor(loader, node):
         args = []
         kwargs = {}
@@ -80,32 +156,119 @@ def registerStepClass(name, step):
             raise Exception("Could not parse steps arguments: {}".format(
                 " ".join([str(x) for x in exceptions])))
         return step(*args, **kwargs)
+    return step_constructor
+
+
+def registerStepClass(name, step):
+    addConstructor(u'!' + name, makeStepConstructor(step))
+    # already parsed configs might reference the previous step class
+    parse_cache.clear()
+
+
+step_plugins = None
+
+
+def plugin_step_constructor(loader, tag_suffix, node):
+    """ Resolve unknown !StepName tags from the buildbot step plugins.
+
+    Plugins are only loaded on first use of their tag, so that we don't import
+    every buildbot step at startup.
+    """
+    global step_plugins
+    if step_plugins is None:
+        step_plugins = get_plugins('steps', None, load_now=False)
+    if tag_suffix not in step_plugins.names:
+        raise yaml.constructor.ConstructorError(
+            None, None, "could not determine a constructor for the tag %r" % (u'!' + tag_suffix),
+            node.start_mark)
+    step_constructor = makeStepConstructor(step_plugins.get(tag_suffix))
+    addConstructor(u'!' + tag_suffix, step_constructor)
+    return step_constructor(loader, node)
 
-    TravisLoader.add_constructor(u'!' + name, step_constructor)
 
-steps = get_plugins('steps', None, load_now=True)
-for step in steps.names:
-    registerStepClass(step, steps.get(step))
+for loader in (TravisLoader, PureTravisLoader):
+    loader.add_multi_constructor(u'!', plugin_step_constructor)
+
+
+class BranchMatcher(object):
+    """
+    Matches branch names against a branches.only or branches.except list.
+
+    Exact names are looked up in a set, and the /regex/ entries are compiled
+    once into a single alternation. Results are memoized per branch name.
+    """
+    maxMemo = 1024
+
+    def __init__(self, branches):
+        self.names = set()
+        patterns = []
+        for b in branches:
+            if b.startswith("/") and b.endswith("/"):
+                patterns.append(b[1:-1])
+            else:
+                self.names.add(b)
+        self.regexes = []
+        try:
+            for p in patterns:
+                self.regexes.append(re.compile(p))
+        except re.error as e:
+            raise TravisYmlInvalid("invalid branch regex '%s': %s" % (p, e))
+        # group numbers would be shifted in the alternation, which would break
+        # backreferences, and group names might clash
+        if len(patterns) > 1 and not any(r.groups for r in self.regexes):
+            try:
+                self.regexes = [re.compile("|".join("(?:%s)" % p for p in patterns))]
+            except re.error:
+                pass
+        self.memo = {}
+
+    def match(self, branch):
+        try:
+            return self.memo[branch]
+        except KeyError:
+            pass
+        res = branch in self.names or any(r.search(branch) for r in self.regexes)
+        if len(self.memo) >= self.maxMemo:
+            self.memo.clear()
+        self.memo[branch] = res
+        return res
 
 
 class TravisYml(object):
     """
     Loads a .travis.yml file and parses it.
     """
+    _frozen = False
 
     def __init__(self):
         self.language = None
         self.image = None
         self.environments = [{}]
         self.matrix = []
+        self.allow_failures = MatrixExcluder([])
+        self.paths = CellPaths()
+        self.fast_finish = None
         for hook in TRAVIS_HOOKS:
             setattr(self, hook, [])
         self.branch_whitelist = None
         self.branch_blacklist = None
+        self.branch_matcher = None
+        self.max_parallel_jobs = None
+        self.batch_steps = False
+        self.cache = None
         self.email = TravisYmlEmail()
         self.irc = TravisYmlIrc()
         self.config = None
 
+    def freeze(self):
+        """ make the parsed object read-only, so that it can be shared """
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if self._frozen:
+            raise AttributeError("this TravisYml is shared, and read-only")
+        object.__setattr__(self, name, value)
+
     def parse(self, config_input):
         try:
             d = yaml.load(config_input, Loader=TravisLoader)
@@ -121,6 +284,9 @@ class TravisYml(object):
         self.parse_matrix()
         self.parse_hooks()
         self.parse_branches()
+        self.parse_max_parallel_jobs()
+        self.parse_batch_steps()
+        self.parse_cache()
         self.parse_notifications_email()
         self.parse_notifications_irc()
 
@@ -173,53 +339,131 @@ class TravisYml(object):
             if not isinstance(branches['only'], list):
                 raise TravisYmlInvalid('branches.only should be a list')
             self.branch_whitelist = branches['only']
+            self.branch_matcher = BranchMatcher(self.branch_whitelist)
             return
 
         if "except" in branches:
             if not isinstance(branches['except'], list):
                 raise TravisYmlInvalid('branches.except should be a list')
             self.branch_blacklist = branches['except']
+            self.branch_matcher = BranchMatcher(self.branch_blacklist)
             return
 
         raise TravisYmlInvalid(
             "'branches' parameter contains neither 'only' nor 'except'")
 
-    def parse_matrix(self):
-        matrix = []
-        python = self.config.get("python", ["python2.6"])
-        if not isinstance(python, list):
-            python = [python]
-        # First of all, build the implicit matrix
-        for lang in python:
-            for env in self.environments:
-                matrix.append(dict(
-                    python=lang,
-                    env=env, ))
+    def parse_max_parallel_jobs(self):
+        max_parallel_jobs = self.config.get("max_parallel_jobs", None)
+        if max_parallel_jobs is None:
+            return
+        if (not isinstance(max_parallel_jobs, int) or isinstance(max_parallel_jobs, bool) or
+                max_parallel_jobs < 1):
+            raise TravisYmlInvalid("'max_parallel_jobs' should be a positive integer")
+        self.max_parallel_jobs = max_parallel_jobs
+
+    def parse_batch_steps(self):
+        batch_steps = self.config.get("batch_steps", False)
+        if not isinstance(batch_steps, bool):
+            raise TravisYmlInvalid("'batch_steps' should be true or false")
+        self.batch_steps = batch_steps
+
+    def parse_cache(self):
+        self.cache = None
+        cache = self.config.get("cache", None)
+        if not cache:
+            return
+        if isinstance(cache, string_types):
+            cache = {cache: True}
+        elif isinstance(cache, list):
+            cache = dict((c, True) for c in cache)
+        if not isinstance(cache, dict):
+            raise TravisYmlInvalid("'cache' parameter is invalid")
+
+        directories = self.parse_cache_globs(cache, 'directories')
+        for name, name_directories in sorted(CACHE_SHORTHANDS.items()):
+            if cache.get(name) is True:
+                directories.extend(name_directories)
+        # the other travis shorthands (bundler, yarn, ...) are not supported
+        for directory in directories:
+            if directory.startswith("/") or ".." in directory.split("/"):
+                raise TravisYmlInvalid("'cache.directories' should be relative to the build "
+                                       "directory or to ~/, got %r" % (directory, ))
+        if directories:
+            self.cache = dict(directories=directories,
+                              key=self.parse_cache_globs(cache, 'key'))
+
+    def parse_cache_globs(self, cache, name):
+        globs = cache.get(name, [])
+        if isinstance(globs, string_types):
+            globs = [globs]
+        if not isinstance(globs, list) or not all(isinstance(g, string_types) for g in globs):
+            raise TravisYmlInvalid("'cache.%s' should be a path or a list of paths" % (name, ))
+        return list(globs)
 
+    def parse_matrix(self):
         cfg = self.config.get("matrix", {})
 
-        def env_to_set(env):
-            env = env.copy()
-            env.update(env.get('env', {}))
-            if 'env' in env:
-                del env['env']
-            return set("{}={}".format(k, v) for k, v in env.items())
+        # First of all, the implicit matrix is the product of all the axes
+        axes = []
+        for name in MATRIX_AXES + tuple(cfg.get("axes", ())):
+            if name == "python":
+                values = self.config.get("python", ["python2.6"])
+            elif name in self.config:
+                values = self.config[name]
+            else:
+                continue
+            if not isinstance(values, list):
+                values = [values]
+            axes.append((name, values))
+        axes.append(("env", self.environments))
 
+        excludes = []
         for env in cfg.get("exclude") or []:
             matchee = env.copy()
             matchee['env'] = parse_env_string(matchee.get('env', ''))
-            matchee_set = env_to_set(matchee)
-            for matrix_line in matrix:
-                matrix_line_set = env_to_set(matrix_line)
-                if matrix_line_set.issuperset(matchee_set):
-                    matrix.remove(matrix_line)
+            excludes.append(matchee)
+
+        allow_failures = []
+        for env in cfg.get("allow_failures") or []:
+            matchee = env.copy()
+            matchee['env'] = parse_env_string(matchee.get('env', ''))
+            allow_failures.append(cell_signature(matchee))
+        self.allow_failures = MatrixExcluder(allow_failures)
+
+        self.fast_finish = cfg.get("fast_finish", None)
+        if self.fast_finish is not None and not isinstance(self.fast_finish, bool):
+            raise TravisYmlInvalid("'matrix.fast_finish' should be a boolean")
+
+        paths = []
+        for env in cfg.get("paths") or []:
+            matchee = env.copy()
+            globs = self.parse_paths(matchee.pop('paths', None))
+            matchee['env'] = parse_env_string(matchee.get('env', ''))
+            paths.append((cell_signature(matchee), globs))
 
+        includes = []
         for env in cfg.get("include") or []:
             e = env.copy()
+            globs = e.pop('paths', None)
             e['env'] = parse_env_string(e.get('env', ''), self.global_env)
-            matrix.append(e)
+            if globs is not None:
+                paths.append((cell_signature(e), self.parse_paths(globs)))
+            includes.append(e)
+        self.paths = CellPaths(paths)
 
-        self.matrix = matrix
+        self.matrix = TravisMatrix(axes, excludes, includes)
+
+    def parse_paths(self, globs):
+        if isinstance(globs, string_types):
+            globs = [globs]
+        if (not isinstance(globs, list) or not globs or
+                not all(isinstance(g, string_types) for g in globs)):
+            raise TravisYmlInvalid("'paths' should be a list of globs")
+        return globs
+
+    def allows_failure(self, cell):
+        """ whether the cell matches one of matrix.allow_failures """
+        return self.allow_failures.matches(cell_signature(cell))
 
     def parse_notifications_irc(self):
         notifications = self.config.get("notifications", {})
@@ -229,26 +473,12 @@ class TravisYml(object):
         notifications = self.config.get("notifications", {})
         self.email.parse(notifications.get("email", {}))
 
-    def _match_branch(self, branch, lst):
-        for b in lst:
-            if b.startswith("/") and b.endswith("/"):
-                if re.search(b[1:-1], branch):
-                    return True
-            else:
-                if b == branch:
-                    return True
-        return False
-
     def can_build_branch(self, branch):
-        if self.branch_whitelist is not None:
-            if self._match_branch(branch, self.branch_whitelist):
-                return True
-            return False
-        if self.branch_blacklist is not None:
-            if self._match_branch(branch, self.branch_blacklist):
-                return False
+        if self.branch_matcher is None:
             return True
-        return True
+        if self.branch_whitelist is not None:
+            return self.branch_matcher.match(branch)
+        return not self.branch_matcher.match(branch)
 
 
 class _NotificationsMixin(object):
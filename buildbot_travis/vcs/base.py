@@ -51,6 +51,8 @@ class VCSBase(object):
     branches = None
     repository = None
     treeStableTimer = None
+    # the fire and track spawners, set by the configurator
+    trackedBuilders = ()
 
     def __init__(self, **kw):
         # takes all configuration from the yaml
@@ -78,6 +80,10 @@ class VCSBase(object):
                 **subrepo
             )
 
+    def addSpawnerSourceSteps(self, factory):
+        # the spawner only needs the source to read .travis.yml
+        self.addSourceSteps(factory)
+
     def createCodebaseParams(self, codebases):
         codebases_params = []
         for name, codebase in codebases.items():
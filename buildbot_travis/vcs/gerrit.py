@@ -24,7 +24,11 @@ from buildbot.steps.source.gerrit import Gerrit as GerritStep
 from buildbot.util import ComparableMixin
 from twisted.internet import defer
 
-from .git import GitBase, ParsedGitUrl
+from .git import GitBase, ParsedGitUrl, TreeHashMixin
+
+
+class TravisGerritStep(TreeHashMixin, GerritStep):
+    pass
 
 
 class RepoMatcher(ComparableMixin):
@@ -109,7 +113,7 @@ class Gerrit(GitBase):
             getDescription={'tags': True, 'always': True}
         ))
 
-        factory.addStep(GerritStep(**kwargs))
+        factory.addStep(TravisGerritStep(**kwargs))
 
     def parseServerURL(self):
         parsed = ParsedGitUrl(self.repository)
@@ -17,9 +17,16 @@ from __future__ import division
 from __future__ import print_function
 from future.moves.urllib.parse import urlparse
 
+import os
+
+from twisted.internet import defer, utils
+from twisted.python import log
+
 from buildbot.plugins import changes
 from buildbot.steps.source.git import Git
 
+from ..reuse import TREE_HASH_PROPERTY
+from ..steps.base import TRAVIS_CONFIG_PROPERTY, ConfigurableStepMixin, packConfig
 from .base import PollerMixin, VCSBase
 
 
@@ -40,8 +47,27 @@ class ParsedGitUrl(object):
             self.port = int(self.port)
 
 
+class TreeHashMixin(object):
+
+    """
+    Git source steps which also record the tree hash of the checkout, which
+    keys the matrix results reuse
+    """
+
+    @defer.inlineCallbacks
+    def parseGotRevision(self, _=None):
+        rc = yield super(TreeHashMixin, self).parseGotRevision(_)
+        stdout = yield self._dovccmd(['rev-parse', 'HEAD^{tree}'], collectStdout=True)
+        self.updateSourceProperty(TREE_HASH_PROPERTY, stdout.strip())
+        defer.returnValue(rc)
+
+
+class TravisGit(TreeHashMixin, Git):
+    pass
+
+
 class GitBase(VCSBase):
-    GitStep = Git
+    GitStep = TravisGit
     shallow = False
     method = "clone"
     mode = "incremental"
@@ -68,15 +94,112 @@ class GitBase(VCSBase):
 class GitPoller(GitBase, PollerMixin):
     description = "Source code hosted on git, with detection of changes using poll method"
 
+    gitbin = "git"
+    pollerdir = None
+
     def setupChangeSource(self, changeSources):
-        pollerdir = self.makePollerDir(self.name)
+        # the poller kept by a reconfig is not this one, but it uses the same
+        # directory, so that is all we remember
+        self.pollerdir = self.makePollerDir(self.name)
         changeSources.append(changes.GitPoller(
             repourl=self.repository,
-            workdir=pollerdir,
+            workdir=self.pollerdir,
             project=self.name,
-            branch=self.branch
+            branch=self.branch,
+            gitbin=self.gitbin
         ))
 
+    def addSpawnerSourceSteps(self, factory):
+        # subrepos are not polled, so they still need a checkout
+        if self.subrepos:
+            return self.addSourceSteps(factory)
+        self.addRepository(factory, self.name, self.repository, self.branches,
+                           doStepIf=self.needsCheckout)
+
+    @defer.inlineCallbacks
+    def _git(self, *args):
+        out, err, code = yield utils.getProcessOutputAndValue(
+            self.gitbin, args, path=self.pollerdir, env=os.environ)
+        defer.returnValue(out if code == 0 else None)
+
+    @defer.inlineCallbacks
+    def getPolledRevision(self, branch):
+        """ The tip of branch, as last fetched by the poller. It fetches the
+        branches of its repository to refs/buildbot/<quoted url>/<branch>
+        """
+        if branch.startswith("refs/heads/"):
+            branch = branch[len("refs/heads/"):]
+        refs = yield self._git("for-each-ref", "--format=%(objectname) %(refname)",
+                               "refs/buildbot/")
+        if refs is None:
+            defer.returnValue(None)
+        for line in refs.decode("utf-8", "replace").splitlines():
+            sha, _, ref = line.partition(" ")
+            parts = ref.split("/", 3)
+            if len(parts) == 4 and parts[3] == branch:
+                defer.returnValue(sha)
+        defer.returnValue(None)
+
+    @defer.inlineCallbacks
+    def getTravisYmlFromPoller(self, branch, revision):
+        """ Read the travis config at revision (or at the tip of branch) from the
+        poller's repository. returns (revision, filename, travis_yml), or None
+        if it is not there
+        """
+        if self.pollerdir is None or not os.path.isdir(self.pollerdir):
+            defer.returnValue(None)
+        if revision is None:
+            branch = branch or self.branch
+            if branch is None:
+                defer.returnValue(None)
+            revision = yield self.getPolledRevision(branch)
+            if revision is None:
+                defer.returnValue(None)
+        sha = yield self._git("rev-parse", "--verify", "--quiet", revision + "^{commit}")
+        if sha is None:
+            defer.returnValue(None)
+        sha = sha.decode("ascii").strip()
+        for filename in ConfigurableStepMixin.TRAVIS_FILENAMES:
+            travis_yml = yield self._git("cat-file", "blob", "{}:{}".format(sha, filename))
+            if travis_yml is not None:
+                try:
+                    defer.returnValue((sha, filename, travis_yml.decode("utf-8")))
+                except UnicodeDecodeError:
+                    defer.returnValue(None)
+        defer.returnValue(None)
+
+    @defer.inlineCallbacks
+    def getTreeHash(self, revision):
+        tree = yield self._git("rev-parse", "--verify", "--quiet", revision + "^{tree}")
+        defer.returnValue(tree.decode("ascii").strip() if tree is not None else None)
+
+    @defer.inlineCallbacks
+    def needsCheckout(self, step):
+        """ doStepIf of the spawner's source step: the checkout is skipped if the
+        travis config can be read from the poller's repository, in which case
+        it is shipped to the TravisTrigger step like the spawner ships it to
+        the jobs
+        """
+        ss = step.build.getSourceStamp(step.codebase)
+        if ss is None:
+            defer.returnValue(True)
+        try:
+            found = yield self.getTravisYmlFromPoller(ss.branch, ss.revision)
+        except Exception:
+            log.err(None, "while reading the travis config from the poller")
+            found = None
+        if found is None:
+            defer.returnValue(True)
+        revision, filename, travis_yml = found
+        step.updateSourceProperty("got_revision", revision)
+        tree = yield self.getTreeHash(revision)
+        if tree is not None:
+            step.updateSourceProperty(TREE_HASH_PROPERTY, tree)
+        step.setProperty(TRAVIS_CONFIG_PROPERTY,
+                         packConfig(filename, travis_yml, {step.codebase: revision}),
+                         "GitPoller")
+        defer.returnValue(False)
+
 
 class GitPb(GitBase):
     description = "Source code hosted on git, with detection of changes using git hooks method"
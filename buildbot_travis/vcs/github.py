@@ -20,8 +20,9 @@ import os
 
 from buildbot.plugins import reporters, steps, util
 
+from ..tracker import matrixStatusGenerators
 from .base import getCodebaseForRepository
-from .git import GitBase
+from .git import GitBase, TreeHashMixin
 
 
 def getCodebaseForGitHubChange(payload):
@@ -35,6 +36,11 @@ def makeContext(props):
     return "buildbot" + ":" + props.getProperty("reason")
 
 
+if hasattr(steps, "GitHub"):
+    class GitHubStep(TreeHashMixin, steps.GitHub):
+        pass
+
+
 class GitHub(GitBase):
     description = "Source code hosted on github, with detection of changes using github web hooks"
     supportsTry = True
@@ -44,7 +50,7 @@ class GitHub(GitBase):
 
     # GitHub is only in 0.9.1+
     if hasattr(steps, "GitHub"):
-        GitStep = steps.GitHub
+        GitStep = GitHubStep
 
     def getPushChangeFilter(self):
         filt = dict(repository=self.repository)
@@ -73,6 +79,11 @@ class GitHub(GitBase):
                 token = os.environ[token.split(":", 2)[1]]
             if not self.reporter_context:
                 self.reporter_context = self.default_reporter_context
+            kwargs = {}
+            # the fire and track spawners are reported once their jobs are done
+            generators = matrixStatusGenerators(self.trackedBuilders)
+            if generators is not None:
+                kwargs['generators'] = generators
             _reporters.append(
                 reporters.GitHubStatusPush(token, context=util.Interpolate(self.reporter_context),
-                                           verbose=True))
+                                           verbose=True, **kwargs))
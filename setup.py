@@ -38,7 +38,10 @@ setup_www_plugin(
     },
     install_requires=[
         'setuptools',
-        'buildbot>=0.9.6',  # for virtual builders features
+        # for virtual builders features. The fire and track spawners are
+        # reported once their jobs are done with buildbot 2.10+ only, and the
+        # test reports are stored with buildbot 2.9+ only
+        'buildbot>=0.9.6',
         'buildbot-www',
         'buildbot-console-view',
         'buildbot-waterfall-view',